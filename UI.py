@@ -1,7 +1,10 @@
+import contextlib
+import hashlib
 import streamlit as st
-import json
+import cbir_methods
 import relevance_feedback as rf
-import pandas as pd
+import data_layer
+import metrics
 
 def get_image_path(img_num):
     """
@@ -20,21 +23,21 @@ def get_image_path(img_num):
 
     return "images/" + str(int(img_num)) + ".jpg"
 
-# Import intensity data
-with open('intensity_data.json') as f:
-    intensity_data = json.load(f)
+def set_recording():
+    """
+    Starts or stops recording metrics when the checkbox is changed.
+    """
 
-# Import color code data
-with open('color_code_data.json') as f:
-    color_code_data = json.load(f)
+    if st.session_state.record_metrics:
+        metrics.enable()
+    else:
+        metrics.disable()
 
-# Import normalization matrix
-normalized_matrix = pd.read_csv('normalized_matrix.csv', index_col=0).T
+# Number of results shown across all pages
+MAX_RESULTS = 100
 
-# Store these data so we only load them once
-st.session_state.intensity = intensity_data
-st.session_state.color_code = color_code_data
-st.session_state.normalized_matrix = normalized_matrix
+# Loads the data the first time a method needs it, once per process
+data = data_layer.get_data_layer()
 
 # Set page title
 st.set_page_config(page_title='CBIR Tool')
@@ -55,7 +58,7 @@ if 'page_number' not in st.session_state:
     st.session_state.page_number = 0
 
 if 'relevant_imgs' not in st.session_state:
-    st.session_state.relevant_imgs = set()
+    st.session_state.relevant_imgs = rf.RelevantImages()
 
 if 'curr_img_num' not in st.session_state:
         st.session_state.curr_img_num = -1
@@ -69,13 +72,20 @@ with left_col:
     img_num = st.number_input("Type a number between 1 - 100 to select an image", \
                               min_value=1, max_value=100, step=1)
     img_path = get_image_path(img_num)
-    st.image(image=img_path, use_column_width='always')
-    if img_num != st.session_state.curr_img_num:
-        keys_to_skip = ['intensty', 'color_code', 'normalized_matrix', \
-                        'results', 'page_number', 'relevant_imgs', \
-                        'curr_img_num']
-        st.session_state.curr_img_num = img_num
-        st.session_state.relevant_imgs = set()
+
+    # An uploaded image is searched instead, without adding it to the database
+    uploaded = st.file_uploader("Or upload your own image", \
+                                type=['jpg', 'jpeg', 'png', 'bmp', 'gif'])
+    upload = uploaded.getvalue() if uploaded is not None else None
+    query_id = img_num if upload is None else hashlib.sha256(upload).hexdigest()
+
+    st.image(image=img_path if upload is None else upload, use_column_width='always')
+    if query_id != st.session_state.curr_img_num:
+        keys_to_skip = ['results', 'page_number', 'relevant_imgs', \
+                        'curr_img_num', 'record_metrics', 'profile_query', \
+                        'profile_text']
+        st.session_state.curr_img_num = query_id
+        st.session_state.relevant_imgs = rf.RelevantImages()
         for key in st.session_state.keys():
             if key not in keys_to_skip:
                 del st.session_state[key]
@@ -83,14 +93,29 @@ with left_col:
         
 
 with right_col:
-    # Set up the select box for the color codes
-    methods = ['-', "Intensity", "Color-Code", "Intensity + Color-Code"]
+    # Set up the select box with every stored feature
+    feature_names = dict((cbir_methods.FEATURES[name].label, name) for name \
+                         in cbir_methods.get_configured_features())
+    methods = ['-'] + list(feature_names) + ["Intensity + Color-Code"]
     option = st.selectbox('Choose a method', methods)
     use_rf = st.checkbox('Use Relevance Feedback', key='use_rf')
 
     # Set up the run button
     run_checked = st.button("Retrieve Images")
 
+    # Report how long the data took to load
+    if data.load_times:
+        st.caption("Data loaded in %.2fs" % data.total_load_time())
+
+# Timers and counters of each stage. Recording is shared by every session
+# of the process (and can be started with CBIR_METRICS=1), so it is only
+# changed when the checkbox is
+with st.sidebar:
+    st.header("Performance")
+    st.checkbox("Record metrics", value=metrics.ENABLED,
+                key='record_metrics', on_change=set_recording)
+    profile_query = st.checkbox("Profile each query", key='profile_query')
+
 # Display these items in a container
 with st.container():
     # If the button has been pressed
@@ -105,26 +130,28 @@ with st.container():
         
         # Get results based on chosen method
         else:
-            if option == "Intensity":
-                results = st.session_state.intensity[img_path]
-                st.session_state.relevant_imgs = set() # clear RF choices upon method switch
-
-            if option == "Color-Code":
-                results = st.session_state.color_code[img_path]
-                st.session_state.relevant_imgs = set() # clear RF choices upon method switch
-
-            if option == "Intensity + Color-Code":
-                if len(st.session_state.relevant_imgs) == 0: # if doing I + CC for the first time
-                    results = rf.calculate_distance(st.session_state.normalized_matrix, \
-                            st.session_state.curr_img_num, 1/89)
-                else:
-                    results = rf.calculate_updated_weight(st.session_state.relevant_imgs, \
-                            st.session_state.normalized_matrix, \
-                            st.session_state.curr_img_num)
+            # Results of a query asked for before come from the result cache
+            query = img_path if upload is None else upload
+            profiler = metrics.capture_profile() if profile_query \
+                else contextlib.nullcontext()
+            with profiler as capture, metrics.timer('query'):
+                if option in feature_names:
+                    results = data.search(query, feature_names[option], MAX_RESULTS)
+                    st.session_state.relevant_imgs = rf.RelevantImages() # clear RF choices upon method switch
+
+                if option == "Intensity + Color-Code":
+                    results = data.search(query, 'combined', MAX_RESULTS, \
+                            st.session_state.relevant_imgs)
+            if profile_query:
+                st.session_state.profile_text = capture.text()
 
             # Update session state so it remembers results
             st.session_state.results = results
     
+    # The relevant images are looked up in the normalization matrix
+    if option == "Intensity + Color-Code" and use_rf:
+        st.session_state.relevant_imgs.normalized_matrix = data.normalized_matrix
+
     # If the results exist
     if st.session_state.results != -1:
         #Get the image paths for the results     
@@ -152,24 +179,32 @@ with st.container():
         end_idx = ((1 + st.session_state.page_number) * N)
 
         # Display results in a grid
-        rel_img = set()
-        while start_idx < end_idx:
-            if end_idx == 100:
-                end_idx -= 1
-            for _ in range(end_idx):
-                cols = st.columns(5)
-                for col_num in range(5):
-                    if start_idx < end_idx:
-                        cols[col_num].image(img_results[start_idx], use_column_width='always', caption=img_results[start_idx])
-                        # If using I + CC and RF, show a checkbox under images
-                        if option == "Intensity + Color-Code" and use_rf:
-                            checked = cols[col_num].checkbox('Relevant', key=img_results[start_idx])
-                            if checked:
-                                st.session_state.relevant_imgs.add(img_results[start_idx])
-                            if img_results[start_idx] in st.session_state.relevant_imgs and not checked:
-                                st.session_state.relevant_imgs.remove(img_results[start_idx])
-                    start_idx += 1
-             
-
-
-
+        with metrics.timer('render'):
+            rel_img = set()
+            while start_idx < end_idx:
+                if end_idx == 100:
+                    end_idx -= 1
+                for _ in range(end_idx):
+                    cols = st.columns(5)
+                    for col_num in range(5):
+                        if start_idx < end_idx:
+                            cols[col_num].image(data.thumbnails.get(img_results[start_idx]), use_column_width='always', caption=img_results[start_idx])
+                            # If using I + CC and RF, show a checkbox under images
+                            if option == "Intensity + Color-Code" and use_rf:
+                                checked = cols[col_num].checkbox('Relevant', key=img_results[start_idx])
+                                if checked:
+                                    st.session_state.relevant_imgs.add(img_results[start_idx])
+                                if img_results[start_idx] in st.session_state.relevant_imgs and not checked:
+                                    st.session_state.relevant_imgs.remove(img_results[start_idx])
+                        start_idx += 1
+
+# Show the metrics and the profile of the last profiled query
+with st.sidebar:
+    if metrics.ENABLED:
+        with st.expander("Metrics"):
+            st.json(metrics.snapshot())
+            st.download_button("Download (Prometheus)", metrics.to_prometheus(), \
+                               file_name='cbir_metrics.txt')
+    if 'profile_text' in st.session_state:
+        with st.expander("Profile of the last query"):
+            st.code(st.session_state.profile_text)
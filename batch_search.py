@@ -0,0 +1,413 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import data_layer
+import feature_format
+import ingest
+import search
+
+COMBINED = data_layer.COMBINED
+OUTPUT_FORMATS = ('jsonl', 'parquet')
+# Queries scored together, each block of rows is read once for all of them
+QUERY_BLOCK = 64
+# Most distances computed at a time for a block of queries, so the memory
+# used does not grow with the number of images
+CHUNK_ELEMENTS = 1 << 20
+
+
+def iter_query_paths(sources):
+    """
+    Yields the query images given as image files or folders. The images
+    anywhere under a folder are visited in sorted order.
+
+    Parameters
+    ----------
+    sources : iterable
+        The file paths of images or folders
+
+    Yields
+    ------
+    str
+        The file path of each query image
+    """
+
+    for source in sources:
+        if os.path.isdir(source):
+            yield from ingest.iter_images(source)
+        else:
+            yield source
+
+
+def read_query_list(list_path):
+    """
+    Reads a list of query images, one file path per line. Empty lines are
+    skipped.
+
+    Parameters
+    ----------
+    list_path : str
+        The file path of the list
+
+    Returns
+    -------
+    list
+        The file paths of the query images
+    """
+
+    with open(list_path) as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def get_method_matrix(data, method):
+    """
+    Returns the matrix searched by a method and the weight of its
+    features, the same as the UI and the service use.
+
+    Parameters
+    ----------
+    data : data_layer.DataLayer
+        The data layer
+    method : str
+        The name of a feature in cbir_methods.FEATURES, or 'combined'
+
+    Returns
+    -------
+    tuple
+        The (images x features) matrix, the image path of each row and the
+        weight of each feature
+    """
+
+    if method == COMBINED:
+        normalized_matrix = data.normalized_matrix
+        matrix = normalized_matrix.T.to_numpy(dtype=np.float64)
+        paths = ['images/' + str(img_num) + '.jpg'
+                 for img_num in normalized_matrix.columns]
+        return matrix, paths, np.full(matrix.shape[1], 1 / matrix.shape[1])
+    store = data.engine.store
+    matrix = store.feature_matrix(method)
+    return matrix, store.paths, np.ones(matrix.shape[1])
+
+
+def get_query_vector(data, method, matrix, rows, query):
+    """
+    Returns the feature vector of a query image. Images in the database
+    use their stored row, other images are decoded.
+
+    Parameters
+    ----------
+    data : data_layer.DataLayer
+        The data layer
+    method : str
+        The name of a feature in cbir_methods.FEATURES, or 'combined'
+    matrix : numpy.ndarray
+        The matrix searched by the method
+    rows : dict
+        Maps the normalized path of each database image to its row
+    query : str
+        The file path of the query image
+
+    Returns
+    -------
+    tuple
+        The feature vector and the row of the query image in the matrix
+        (None if it is not in the database)
+    """
+
+    row = rows.get(os.path.normpath(query))
+    if row is not None:
+        return np.asarray(matrix[row], dtype=np.float64), row
+    if method == COMBINED:
+        features = [name for name, dim in feature_format.COMBINED_FEATURES]
+        return data.engine.normalized_example(query, features), None
+    return data.engine.example_vector(query, method), None
+
+
+def merge_top_k(best, distances, rows, k):
+    """
+    Adds the distances of a chunk of rows to the closest rows found so far
+    for a query. Every row tied with the k-th closest is kept, so the
+    final order of ties is the same as sorting every distance.
+
+    Parameters
+    ----------
+    best : tuple
+        The distances and rows kept so far
+    distances : numpy.ndarray
+        The distance of each row of the chunk
+    rows : numpy.ndarray
+        The row numbers of the chunk
+    k : int
+        The number of results
+
+    Returns
+    -------
+    tuple
+        The distances and rows kept
+    """
+
+    best_distances, best_rows = best
+    if len(best_distances) >= k:
+        keep = distances <= best_distances.max()
+        distances, rows = distances[keep], rows[keep]
+    distances = np.concatenate([best_distances, distances])
+    rows = np.concatenate([best_rows, rows])
+    if len(distances) > k:
+        kth = np.partition(distances, k - 1)[k - 1]
+        keep = distances <= kth
+        distances, rows = distances[keep], rows[keep]
+    return distances, rows
+
+
+def score_block(matrix, paths, weight, vectors, excludes, k):
+    """
+    Finds the k closest images of a block of queries. The matrix is
+    scored against all the queries a chunk of rows at a time (see
+    search.weighted_l1_distances), keeping only the closest rows of each
+    query between chunks.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) matrix searched
+    paths : list
+        The image path of each row of the matrix
+    weight : numpy.ndarray
+        The weight of each feature
+    vectors : numpy.ndarray
+        The (queries x features) query vectors
+    excludes : list
+        The row of each query left out of its results, or None
+    k : int
+        The number of results
+
+    Returns
+    -------
+    list
+        The sorted (distance, image path) results of each query, the same
+        as search.top_k returns
+    """
+
+    empty = (np.zeros(0), np.zeros(0, dtype=np.int64))
+    best = [empty] * len(vectors)
+    rows = max(k, CHUNK_ELEMENTS // len(vectors))
+    for start in range(0, len(matrix), rows):
+        chunk_rows = np.arange(start, min(start + rows, len(matrix)))
+        distances = search.weighted_l1_distances(matrix[start:start + rows],
+                                                 vectors, weight)
+        for query, exclude in enumerate(excludes):
+            if exclude is not None and start <= exclude < start + rows:
+                keep = chunk_rows != exclude
+                best[query] = merge_top_k(best[query],
+                                          distances[query][keep],
+                                          chunk_rows[keep], k)
+            else:
+                best[query] = merge_top_k(best[query], distances[query],
+                                          chunk_rows, k)
+    return [search.top_k(distances, [paths[row] for row in best_rows], k)
+            for distances, best_rows in best]
+
+
+def search_batch(data, queries, method, k=10, block_size=QUERY_BLOCK):
+    """
+    Finds the k closest images of every query image. The queries are
+    scored a block at a time as one matrix against matrix computation, and
+    the results are yielded as soon as their block is done, so they are
+    never all held in memory.
+
+    Images in the database are left out of their own results by the
+    Intensity and Color-Code methods, the same as the UI.
+
+    Parameters
+    ----------
+    data : data_layer.DataLayer
+        The data layer
+    queries : iterable
+        The file paths of the query images
+    method : str
+        The name of a feature in cbir_methods.FEATURES, or 'combined'
+    k : int
+        The number of results of each query
+    block_size : int
+        The number of queries scored together
+
+    Yields
+    ------
+    tuple
+        The file path of each query image and its sorted list of
+        (distance, image path) results. Images that cannot be read are
+        skipped
+    """
+
+    matrix, paths, weight = get_method_matrix(data, method)
+    rows = dict((os.path.normpath(path), row)
+                for row, path in enumerate(paths))
+
+    def score(block):
+        vectors = np.array([vector for query, vector, row in block])
+        excludes = [row for query, vector, row in block]
+        found = score_block(matrix, paths, weight, vectors, excludes, k)
+        return zip([query for query, vector, row in block], found)
+
+    block = list()
+    for query in queries:
+        try:
+            vector, row = get_query_vector(data, method, matrix, rows, query)
+        except ingest.READ_ERRORS:
+            print("Error, could not read " + query, file=sys.stderr)
+            continue
+        block.append((query, vector, None if method == COMBINED else row))
+        if len(block) >= block_size:
+            yield from score(block)
+            block = list()
+    if block:
+        yield from score(block)
+
+
+def write_jsonl(results, file, method):
+    """
+    Writes batch results as JSON lines, one query per line:
+    {"query": ..., "method": ..., "results": [[distance, path], ...]}.
+
+    Parameters
+    ----------
+    results : iterable
+        The (query, results) pairs yielded by search_batch
+    file : file object
+        The text file written to
+    method : str
+        The method the results were found with
+
+    Returns
+    -------
+    int
+        The number of queries written
+    """
+
+    count = 0
+    for query, found in results:
+        file.write(json.dumps({'query': query, 'method': method,
+                               'results': found}) + '\n')
+        count += 1
+    return count
+
+
+def write_parquet(results, output_path, method, block_size=QUERY_BLOCK):
+    """
+    Writes batch results as a Parquet table with one row per result
+    (query, method, rank, distance, path). The rows of block_size queries
+    are written at a time. Needs pyarrow.
+
+    Parameters
+    ----------
+    results : iterable
+        The (query, results) pairs yielded by search_batch
+    output_path : str
+        The file path of the Parquet file
+    method : str
+        The method the results were found with
+    block_size : int
+        The number of queries written at a time
+
+    Returns
+    -------
+    int
+        The number of queries written, or -1 if pyarrow is not installed
+    """
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("Error, writing Parquet needs pyarrow (pip install pyarrow)",
+              file=sys.stderr)
+        return -1
+
+    schema = pa.schema([('query', pa.string()), ('method', pa.string()),
+                        ('rank', pa.int32()), ('distance', pa.float64()),
+                        ('path', pa.string())])
+    count = 0
+    columns = dict((name, list()) for name in schema.names)
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for query, found in results:
+            for rank, (distance, path) in enumerate(found):
+                columns['query'].append(query)
+                columns['method'].append(method)
+                columns['rank'].append(rank)
+                columns['distance'].append(distance)
+                columns['path'].append(path)
+            count += 1
+            if count % block_size == 0:
+                writer.write_table(pa.table(columns, schema=schema))
+                columns = dict((name, list()) for name in schema.names)
+        if columns['query']:
+            writer.write_table(pa.table(columns, schema=schema))
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Find the closest images of many query images and "
+                    "write them as JSON lines or Parquet.")
+    parser.add_argument('queries', nargs='*',
+                        help="query images, or folders of query images")
+    parser.add_argument('--query-list',
+                        help="a file listing query images, one per line")
+    parser.add_argument('--method', default=COMBINED,
+                        help="a feature such as intensity or color_code, or "
+                             "combined (default)")
+    parser.add_argument('-k', type=int, default=10,
+                        help="results per query")
+    parser.add_argument('--output', default='-',
+                        help="the output file, '-' for standard output")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+                        help="the output format, guessed from the output "
+                             "file name by default")
+    parser.add_argument('--img-dir', default='images/',
+                        help="the folder containing the database images")
+    parser.add_argument('--block-size', type=int, default=QUERY_BLOCK,
+                        help="queries scored together")
+    args = parser.parse_args(argv)
+    if args.k < 1:
+        parser.error("-k must be at least 1")
+    if args.block_size < 1:
+        parser.error("--block-size must be at least 1")
+
+    sources = list(args.queries)
+    if args.query_list:
+        sources.extend(read_query_list(args.query_list))
+    if not sources:
+        parser.error("no query images given")
+    output_format = args.format or \
+        ('parquet' if args.output.endswith('.parquet') else 'jsonl')
+    if output_format == 'parquet' and args.output == '-':
+        parser.error("Parquet output needs an output file")
+
+    start = time.perf_counter()
+    data = data_layer.DataLayer(args.img_dir)
+    methods = [name for name in data.engine.store.features] + [COMBINED]
+    if args.method not in methods:
+        parser.error("unknown method " + repr(args.method) +
+                     ", expected one of " + ', '.join(methods))
+    results = search_batch(data, iter_query_paths(sources), args.method,
+                           args.k, args.block_size)
+    if output_format == 'parquet':
+        count = write_parquet(results, args.output, args.method,
+                              args.block_size)
+    elif args.output == '-':
+        count = write_jsonl(results, sys.stdout, args.method)
+    else:
+        with open(args.output, 'w') as file:
+            count = write_jsonl(results, file, args.method)
+    if count < 0:
+        return 1
+    elapsed = time.perf_counter() - start
+    print("Answered {} queries in {:.2f}s".format(count, elapsed),
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
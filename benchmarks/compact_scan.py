@@ -0,0 +1,207 @@
+"""
+Measures how much memory the compact copies of the normalization matrix
+save (float16, uint8 and sparse, see indexes.QuantizedIndex), how fast
+they are to search, and how close their rankings are to the float64
+search, with and without the exact re-rank.
+
+Run from the repository root:
+
+    python benchmarks/compact_scan.py [--sizes 100000 1000000] [--json out.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cbir_methods
+import data_layer
+import indexes
+import search
+from draft_scale import kendall_tau
+
+KINDS = ['float16', 'uint8', 'sparse']
+
+
+def synthetic_matrix(features, size, seed=0, noise=0.2):
+    """
+    Creates a normalized matrix of random images that look like the
+    bundled ones. Each random image is a bundled image with the count of
+    every non-empty bin scaled by up to noise, so the empty bins (and the
+    sparsity of the color-code bins) are kept.
+
+    Parameters
+    ----------
+    features : numpy.ndarray
+        The (images x features) feature matrix of the bundled images
+    size : int
+        The number of images
+    seed : int
+        The seed of the random images
+    noise : float
+        How much each bin can change
+
+    Returns
+    -------
+    numpy.ndarray
+        The (images x features) normalized matrix
+    """
+
+    rng = np.random.default_rng(seed)
+    matrix = features[rng.integers(len(features), size=size)]
+    matrix = matrix * rng.uniform(1 - noise, 1 + noise, matrix.shape)
+    std = matrix.std(axis=0, ddof=1)
+    std[std == 0] = 1
+    return (matrix - matrix.mean(axis=0)) / std
+
+
+def time_queries(search_query, queries):
+    """
+    Times a search for each query.
+
+    Parameters
+    ----------
+    search_query : function
+        Searches with one query row and returns the results
+    queries : list
+        The query rows
+
+    Returns
+    -------
+    tuple
+        The results of each query and the median time per query, in
+        milliseconds
+    """
+
+    results = list()
+    latencies = list()
+    for row in queries:
+        start = time.perf_counter()
+        results.append(search_query(row))
+        latencies.append(time.perf_counter() - start)
+    return results, float(np.median(latencies) * 1000)
+
+
+def compare_catalog(name, matrix, num_queries, k):
+    """
+    Compares the compact copies of a normalized matrix with the float64
+    search.
+
+    Parameters
+    ----------
+    name : str
+        The name of the catalog
+    matrix : numpy.ndarray
+        The (images x features) normalized matrix
+    num_queries : int
+        The number of queries
+    k : int
+        The number of results per query
+
+    Returns
+    -------
+    dict
+        The results of each kind of compact copy
+    """
+
+    matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+    paths = ['images/%d.jpg' % (row + 1) for row in range(len(matrix))]
+    weight = 1 / matrix.shape[1]
+    rng = np.random.default_rng(0)
+    queries = rng.choice(len(matrix), min(num_queries, len(matrix)),
+                         replace=False).tolist()
+
+    def float_search(row):
+        distances = search.weighted_l1_distances(matrix, matrix[row], weight)
+        return search.top_k(distances, paths, k, paths[row])
+
+    expected, float_ms = time_queries(float_search, queries)
+    print("%s: %d images, float64 %.2f MB, %.3f ms per query" %
+          (name, len(matrix), matrix.nbytes / 1e6, float_ms))
+    # Kendall tau compares every pair of images, so only small catalogs
+    rank_all = len(matrix) <= 2000
+
+    results = {'images': len(matrix), 'float64_bytes': matrix.nbytes,
+               'float64_ms': float_ms}
+    for kind in KINDS:
+        start = time.perf_counter()
+        index = indexes.build_index(kind, matrix, paths)
+        build_time = time.perf_counter() - start
+        found, exact_ms = time_queries(
+            lambda row: index.query(matrix[row], k, paths[row], weight),
+            queries)
+        reranked = list()
+        for row in queries:
+            index.query(matrix[row], k, paths[row], weight)
+            reranked.append(index.last_reranked)
+
+        # The approximate distances alone, without the re-rank
+        index.rerank = 0
+        approximate, approximate_ms = time_queries(
+            lambda row: index.query(matrix[row], k, paths[row], weight),
+            queries)
+        overlap = np.mean([len(set(p for d, p in a) & set(p for d, p in e)) / k
+                           for a, e in zip(approximate, expected)])
+        taus = list()
+        if rank_all:
+            for row in queries:
+                others = np.arange(len(matrix)) != row
+                taus.append(kendall_tau(
+                    search.weighted_l1_distances(matrix, matrix[row],
+                                                 weight)[others],
+                    index.approximate(matrix[row],
+                                      np.full(matrix.shape[1],
+                                              weight))[others]))
+
+        result = {'bytes': index.nbytes,
+                  'saved': 1 - index.nbytes / matrix.nbytes,
+                  'build_s': build_time, 'exact_ms': exact_ms,
+                  'approximate_ms': approximate_ms,
+                  'identical': float(np.mean([f == e for f, e in
+                                              zip(found, expected)])),
+                  'reranked': float(np.mean(reranked)),
+                  'approximate_overlap': float(overlap),
+                  'approximate_tau': float(np.mean(taus)) if taus else None}
+        results[kind] = result
+        print("  %-8s %8.2f MB (%4.1f%% saved) exact %8.3f ms, identical %.2f,"
+              " re-ranked %8.1f | approximate %8.3f ms, top%d overlap %.3f%s" %
+              (kind, result['bytes'] / 1e6, result['saved'] * 100,
+               exact_ms, result['identical'], result['reranked'],
+               approximate_ms, k, overlap,
+               ", tau %.4f" % result['approximate_tau'] if taus else ''))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='*', default=[100000],
+                        help="sizes of the synthetic catalogs")
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    data = data_layer.DataLayer()
+    normalized = data.normalized_matrix.T.to_numpy(dtype=np.float64)
+    store = data.engine.store
+    features = np.hstack([store.feature_matrix(name)
+                          for name in cbir_methods.COMBINED_FEATURES])
+
+    report = {'bundled': compare_catalog('bundled', normalized, args.queries,
+                                         args.k)}
+    for size in args.sizes:
+        name = 'synthetic_%d' % size
+        report[name] = compare_catalog(name, synthetic_matrix(features, size),
+                                       args.queries, args.k)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
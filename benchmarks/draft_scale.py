@@ -0,0 +1,156 @@
+"""
+Measures how much decoding at a reduced resolution speeds up feature
+extraction on the bundled images, and how much it changes the rankings
+compared with full resolution.
+
+Run from the repository root:
+
+    python benchmarks/draft_scale.py [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cbir_methods
+import feature_store
+import search
+
+RESOLUTIONS = ['full', 'draft:2', 'draft:4', 'draft:8', 'max_pixels:16384']
+
+
+def kendall_tau(a, b):
+    """
+    Computes the Kendall rank correlation (tau-a) between two lists of
+    scores for the same items.
+
+    Parameters
+    ----------
+    a : numpy.ndarray
+        The first scores
+    b : numpy.ndarray
+        The second scores
+
+    Returns
+    -------
+    float
+        The correlation, from -1 (reversed order) to 1 (same order)
+    """
+
+    n = len(a)
+    upper = np.triu_indices(n, 1)
+    sign_a = np.sign(a[:, np.newaxis] - a[np.newaxis, :])[upper]
+    sign_b = np.sign(b[:, np.newaxis] - b[np.newaxis, :])[upper]
+    return float((sign_a * sign_b).sum() / len(sign_a))
+
+
+def extract_all(paths, resolution):
+    """
+    Extracts the combined features of every image at the given resolution.
+
+    Parameters
+    ----------
+    paths : list
+        The file paths of the images
+    resolution : str
+        The extraction resolution
+
+    Returns
+    -------
+    tuple
+        The (images x features) matrix and the time taken, in seconds
+    """
+
+    start = time.perf_counter()
+    matrix = np.array([cbir_methods.get_combined_features(path, None,
+                                                          resolution)
+                       for path in paths])
+    return matrix, time.perf_counter() - start
+
+
+def ranking_drift(reference, matrix, columns, k=10):
+    """
+    Compares the rankings of every query under the two feature matrices.
+
+    Parameters
+    ----------
+    reference : numpy.ndarray
+        The full resolution feature matrix
+    matrix : numpy.ndarray
+        The feature matrix to compare
+    columns : slice
+        The columns of the feature to rank by
+    k : int
+        The number of top results compared for the overlap
+
+    Returns
+    -------
+    tuple
+        The mean Kendall tau and the mean top k overlap over all queries
+    """
+
+    taus = list()
+    overlaps = list()
+    for query in range(len(reference)):
+        others = np.arange(len(reference)) != query
+        full = search.l1_distances(reference[:, columns],
+                                   reference[query, columns])[others]
+        scaled = search.l1_distances(matrix[:, columns],
+                                     matrix[query, columns])[others]
+        taus.append(kendall_tau(full, scaled))
+        top_full = set(np.argsort(full, kind='stable')[:k])
+        top_scaled = set(np.argsort(scaled, kind='stable')[:k])
+        overlaps.append(len(top_full & top_scaled) / k)
+    return float(np.mean(taus)), float(np.mean(overlaps))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--img-dir', default='images/')
+    parser.add_argument('--resolutions', nargs='*', default=RESOLUTIONS)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    paths = sorted(feature_store.get_image_paths(args.img_dir))
+    dims = feature_store.get_feature_dims(cbir_methods.FEATURES.keys())
+    columns = dict()
+    start = 0
+    for name, dim in dims.items():
+        columns[name] = slice(start, start + dim)
+        start += dim
+
+    # Reads every file once so the first timed run does not pay for a cold
+    # disk cache
+    extract_all(paths, 'draft:8')
+    reference, full_time = extract_all(paths, 'full')
+    results = list()
+    print("%-18s %9s %8s" % ('resolution', 'time (s)', 'speedup') +
+          ''.join(" %14s %9s" % (name + ' tau', 'top10') for name in dims))
+    for resolution in args.resolutions:
+        if resolution == 'full':
+            matrix, elapsed = reference, full_time
+        else:
+            matrix, elapsed = extract_all(paths, resolution)
+        result = {'resolution': resolution, 'seconds': elapsed,
+                  'speedup': full_time / elapsed}
+        line = "%-18s %9.3f %7.2fx" % (resolution, elapsed, full_time / elapsed)
+        for name in dims:
+            tau, overlap = ranking_drift(reference, matrix, columns[name])
+            result[name] = {'kendall_tau': tau, 'top10_overlap': overlap}
+            line += " %14.4f %9.3f" % (tau, overlap)
+        results.append(result)
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'images': len(paths), 'results': results}, file,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    main()
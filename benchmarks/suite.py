@@ -0,0 +1,423 @@
+"""
+Benchmarks feature extraction, indexing and query latency on the bundled
+images and on synthetic catalogs of random histograms, and compares the
+results with a stored baseline. The recall of the approximate (LSH) index
+against a brute-force scan is reported with its query latency.
+
+Run from the repository root:
+
+    python benchmarks/suite.py [--sizes 10000 100000 1000000] [--json out.json]
+    python benchmarks/suite.py --save-baseline
+
+Exits with status 1 if any benchmark is slower than the baseline by more
+than the tolerance, or if the recall dropped.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cbir_methods
+import feature_store
+import indexes
+import relevance_feedback as rf
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baseline.json')
+DEFAULT_SIZES = [10000, 100000]
+# Relevant images picked for the relevance feedback benchmarks
+RELEVANT_IMAGES = 5
+# The recall of the approximate index is measured on this many results
+RECALL_K = 10
+# Largest drop of the recall below the baseline that is not reported
+RECALL_TOLERANCE = 0.05
+
+
+def summarize(latencies):
+    """
+    Summarizes the latencies of repeated calls.
+
+    Parameters
+    ----------
+    latencies : list
+        The time taken by each call, in seconds
+
+    Returns
+    -------
+    dict
+        The number of calls, the calls per second and the 50th, 95th and
+        99th percentile latencies, in milliseconds
+    """
+
+    latencies = np.array(latencies)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {'calls': len(latencies),
+            'throughput': float(len(latencies) / latencies.sum()),
+            'p50_ms': float(p50), 'p95_ms': float(p95),
+            'p99_ms': float(p99)}
+
+
+def run_case(calls, repeat, warmup=1):
+    """
+    Times a benchmark and measures its peak memory.
+
+    Parameters
+    ----------
+    calls : list
+        Functions without arguments, one call each. They are run in turn
+        until repeat calls are timed
+    repeat : int
+        The number of timed calls
+    warmup : int
+        The number of untimed calls made first
+
+    Returns
+    -------
+    dict
+        The summary of the latencies (see summarize) and the peak memory
+        allocated by one call, in bytes
+    """
+
+    for i in range(warmup):
+        calls[i % len(calls)]()
+
+    latencies = list()
+    for i in range(repeat):
+        start = time.perf_counter()
+        calls[i % len(calls)]()
+        latencies.append(time.perf_counter() - start)
+
+    # Measured on its own call, since tracing slows the calls down
+    tracemalloc.start()
+    calls[0]()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = summarize(latencies)
+    result['peak_bytes'] = peak
+    return result
+
+
+def bundled_cases(img_dir, repeat):
+    """
+    Creates the benchmarks of the bundled images.
+
+    Parameters
+    ----------
+    img_dir : str
+        The folder containing the images
+    repeat : int
+        The number of timed calls of each benchmark
+
+    Yields
+    ------
+    tuple
+        The name of the benchmark, its calls and the number of timed calls
+    """
+
+    paths = sorted(feature_store.get_image_paths(img_dir))
+    with tempfile.TemporaryDirectory() as store_dir:
+        store = feature_store.FeatureStore(store_dir,
+                                           cbir_methods.COMBINED_FEATURES)
+        store.sync(paths)
+        normalized_matrix = normalized_frame(store.normalized_matrix(),
+                                             store.paths)
+        index = rf.build_feedback_index(normalized_matrix)
+
+        yield ('bundled/calculate_intensity',
+               [lambda path=path: cbir_methods.calculate_intensity(path)
+                for path in paths], repeat)
+        yield ('bundled/calculate_color_code',
+               [lambda path=path: cbir_methods.calculate_color_code(path)
+                for path in paths], repeat)
+        for case in catalog_cases('bundled', store, normalized_matrix,
+                                  index, repeat):
+            yield case
+
+
+def catalog_cases(prefix, store, normalized_matrix, index, repeat):
+    """
+    Creates the query benchmarks of a catalog.
+
+    Parameters
+    ----------
+    prefix : str
+        Added in front of the benchmark names
+    store : feature_store.FeatureStore
+        The store of the catalog
+    normalized_matrix : pandas.DataFrame
+        The normalization matrix of the catalog
+    index : indexes.WeightedBoxIndex
+        The feedback index of the catalog
+    repeat : int
+        The number of timed calls of each benchmark
+
+    Yields
+    ------
+    tuple
+        The name of the benchmark, its calls and the number of timed calls,
+        followed for an approximate index by a dict with its recall
+    """
+
+    rng = np.random.default_rng(0)
+    paths = store.paths
+    queries = [paths[row] for row in rng.choice(len(paths), repeat)]
+    img_nums = [rf.get_img_num(path) for path in queries]
+    relevant = [set(paths[row] for row in
+                    rng.choice(len(paths), RELEVANT_IMAGES, replace=False))
+                for query in queries]
+    weight = 1 / len(normalized_matrix.index)
+
+    yield (prefix + '/get_distance',
+           [lambda path=path: cbir_methods.get_distance(
+               path, cbir_methods.calculate_intensity, store)
+            for path in queries], repeat)
+    yield (prefix + '/rf.calculate_distance',
+           [lambda num=num: rf.calculate_distance(normalized_matrix, num,
+                                                  weight, None, 100)
+            for num in img_nums], repeat)
+    yield (prefix + '/rf.calculate_distance[index]',
+           [lambda num=num: rf.calculate_distance(normalized_matrix, num,
+                                                  weight, index, 100)
+            for num in img_nums], repeat)
+    yield (prefix + '/rf.calculate_updated_weight',
+           [lambda num=num, imgs=imgs: rf.calculate_updated_weight(
+               imgs, normalized_matrix, num, None, 100)
+            for num, imgs in zip(img_nums, relevant)], repeat)
+    yield (prefix + '/rf.calculate_updated_weight[index]',
+           [lambda num=num, imgs=imgs: rf.calculate_updated_weight(
+               imgs, normalized_matrix, num, index, 100)
+            for num, imgs in zip(img_nums, relevant)], repeat)
+
+    lsh_index = indexes.build_index('lsh', normalized_matrix.T.to_numpy(),
+                                    paths)
+    rows = dict((path, row) for row, path in enumerate(paths))
+    recall = indexes.recall_at_k(lsh_index, queries, RECALL_K)
+    yield (prefix + '/lsh.query',
+           [lambda path=path: lsh_index.query(lsh_index.matrix[rows[path]],
+                                              100, path)
+            for path in queries], repeat, {'recall': recall})
+
+
+def normalized_frame(normalized, paths):
+    """
+    Puts a normalized matrix in the layout relevance_feedback uses.
+
+    Parameters
+    ----------
+    normalized : numpy.ndarray
+        The (images x features) normalized matrix
+    paths : list
+        The image path of each row, in the format 'images/{number}.jpg'
+
+    Returns
+    -------
+    pandas.DataFrame
+        The (features x images) normalization matrix
+    """
+
+    index = [str(col) for col in range(normalized.shape[1])]
+    columns = [rf.get_img_num(path) for path in paths]
+    return pd.DataFrame(normalized.T, index=index, columns=columns)
+
+
+def make_synthetic_store(store_dir, size, seed=0, batch_size=100000):
+    """
+    Fills a feature store with random histograms of the features of the
+    "Intensity + Color-Code" method.
+
+    Parameters
+    ----------
+    store_dir : str
+        The folder of the store
+    size : int
+        The number of images
+    seed : int
+        The seed of the random histograms
+    batch_size : int
+        The number of images written at a time
+
+    Returns
+    -------
+    feature_store.FeatureStore
+        The store
+    """
+
+    rng = np.random.default_rng(seed)
+    store = feature_store.FeatureStore(store_dir,
+                                       cbir_methods.COMBINED_FEATURES)
+    dims = feature_store.get_feature_dims(store.features)
+    for start in range(0, size, batch_size):
+        count = min(batch_size, size - start)
+        # Each histogram is divided by the image size, so it sums to 1
+        blocks = list()
+        for name in store.features:
+            block = rng.random((count, dims[name])) ** 4
+            blocks.append(block / block.sum(axis=1, keepdims=True))
+        matrix = np.hstack(blocks)
+        store.update(({'path': 'images/%d.jpg' % (start + row + 1),
+                       'mtime': 0, 'size': 0, 'pixels': 1}, matrix[row])
+                     for row in range(count))
+    return store
+
+
+def synthetic_cases(size, repeat):
+    """
+    Creates the benchmarks of a synthetic catalog.
+
+    Parameters
+    ----------
+    size : int
+        The number of images in the catalog
+    repeat : int
+        The number of timed calls of each query benchmark
+
+    Yields
+    ------
+    tuple
+        The name of the benchmark, its calls and the number of timed calls
+    """
+
+    prefix = 'synthetic_%d' % size
+    # Larger catalogs take longer per query, so are queried fewer times
+    repeat = max(3, min(repeat, repeat * 100000 // size))
+    with tempfile.TemporaryDirectory() as store_dir:
+        store = make_synthetic_store(store_dir, size)
+        normalized_matrix = normalized_frame(store.normalized_matrix(),
+                                             store.paths)
+        # The index built by the benchmark is the one queried next
+        built = dict()
+
+        def build():
+            built['index'] = rf.build_feedback_index(normalized_matrix)
+
+        yield (prefix + '/build_feedback_index', [build], 1)
+        for case in catalog_cases(prefix, store, normalized_matrix,
+                                  built['index'], repeat):
+            yield case
+
+
+def compare(results, baseline, tolerance, min_ms=1.0):
+    """
+    Finds the benchmarks that got slower than the baseline.
+
+    Parameters
+    ----------
+    results : dict
+        The results of each benchmark
+    baseline : dict
+        The baseline results of each benchmark
+    tolerance : float
+        How much slower a benchmark can be, e.g. 1.0 for twice as slow
+    min_ms : float
+        Slowdowns smaller than this, in milliseconds, are never reported,
+        since sub-millisecond timings are easily disturbed
+
+    Returns
+    -------
+    list
+        A message for each regression
+    """
+
+    regressions = list()
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        # The tail percentiles are reported but too noisy to fail on. The
+        # mean latency is the inverse of the throughput
+        for stat, value, base_value in [
+                ('p50', result['p50_ms'], base['p50_ms']),
+                ('mean', 1000 / result['throughput'],
+                 1000 / base['throughput'])]:
+            if value > base_value * (1 + tolerance) and \
+                    value - base_value > min_ms:
+                regressions.append('%s: %s %.3f ms, baseline %.3f ms' %
+                                   (name, stat, value, base_value))
+        if 'recall' in result and 'recall' in base and \
+                result['recall'] < base['recall'] - RECALL_TOLERANCE:
+            regressions.append('%s: recall@%d %.3f, baseline %.3f' %
+                               (name, RECALL_K, result['recall'],
+                                base['recall']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--img-dir', default='images/')
+    parser.add_argument('--sizes', type=int, nargs='*', default=DEFAULT_SIZES,
+                        help="sizes of the synthetic catalogs")
+    parser.add_argument('--repeat', type=int, default=50,
+                        help="timed calls of each benchmark")
+    parser.add_argument('--skip-bundled', action='store_true')
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="save the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help="allowed slowdown before failing (default 1.0, "
+                             "i.e. twice as slow)")
+    parser.add_argument('--min-ms', type=float, default=1.0,
+                        help="smallest slowdown reported, in milliseconds")
+    args = parser.parse_args(argv)
+
+    cases = list()
+    if not args.skip_bundled:
+        cases.append(bundled_cases(args.img_dir, args.repeat))
+    for size in args.sizes:
+        cases.append(synthetic_cases(size, args.repeat))
+
+    results = dict()
+    print("%-50s %8s %12s %9s %9s %9s %10s" %
+          ('benchmark', 'calls', 'per second', 'p50 ms', 'p95 ms', 'p99 ms',
+           'peak MB'))
+    for group in cases:
+        for name, calls, repeat, *info in group:
+            result = run_case(calls, repeat, warmup=0 if repeat == 1 else 1)
+            for values in info:
+                result.update(values)
+            results[name] = result
+            print("%-50s %8d %12.1f %9.3f %9.3f %9.3f %10.2f" %
+                  (name, result['calls'], result['throughput'],
+                   result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                   result['peak_bytes'] / 1e6))
+            if 'recall' in result:
+                print("    recall@%d against a brute-force scan: %.3f" %
+                      (RECALL_K, result['recall']))
+
+    report = {'python': sys.version.split()[0], 'numpy': np.__version__,
+              'results': results}
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+        print("Saved the baseline to " + args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at " + args.baseline + ", nothing to compare")
+        return 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)['results']
+    regressions = compare(results, baseline, args.tolerance, args.min_ms)
+    if regressions:
+        print("\nREGRESSIONS against " + args.baseline + ":")
+        for message in regressions:
+            print("  " + message)
+        return 1
+    print("\nNo regressions against " + args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,7 @@
 from PIL import Image as img
 import numpy as np
-import os, json
+import os, json, collections, math
+import metrics
 #import streamlit as st
 
 def get_intensity(vals):
@@ -21,6 +22,687 @@ def get_intensity(vals):
     return (.299*vals[0]) + (.587*vals[1]) + (.114 * vals[2])
 
 
+INTENSITY_BINS = list(range(0, 250, 10)) + [255]
+
+
+# Extraction resolutions: 'full' decodes every pixel, 'draft:N' decodes at
+# 1/N scale (N is 2, 4 or 8) and 'max_pixels:N' decodes to at most N pixels
+FULL_RESOLUTION = 'full'
+
+
+def parse_resolution(resolution):
+    """
+    Splits an extraction resolution into its mode and value.
+
+    Parameters
+    ----------
+    resolution : str
+        'full', 'draft:N' with N in 2, 4 or 8, or 'max_pixels:N'
+
+    Returns
+    -------
+    tuple
+        The mode ('full', 'draft' or 'max_pixels') and its value (None for
+        'full')
+    """
+
+    if resolution == FULL_RESOLUTION:
+        return (FULL_RESOLUTION, None)
+    mode, sep, value = resolution.partition(':')
+    if mode == 'draft' and value in ('2', '4', '8'):
+        return (mode, int(value))
+    if mode == 'max_pixels' and value.isdigit() and int(value) > 0:
+        return (mode, int(value))
+    raise ValueError("Unknown resolution " + repr(resolution))
+
+
+@metrics.timed('decode')
+def decode_image(img_path, resolution=FULL_RESOLUTION):
+    """
+    Decodes the given image into an RGB PIL image.
+
+    A reduced resolution uses PIL's draft mode, which lets JPEGs decode
+    straight at 1/2, 1/4 or 1/8 scale. Other formats are decoded in full
+    and then reduced.
+
+    Parameters
+    ----------
+    img_path : str
+        The file path for the image
+    resolution : str
+        The extraction resolution, see parse_resolution
+
+    Returns
+    -------
+    PIL.Image.Image
+        The decoded RGB image
+    """
+
+    mode, value = parse_resolution(resolution)
+    with img.open(img_path) as pic:
+        if mode == FULL_RESOLUTION:
+            return pic.convert('RGB')
+
+        width, height = pic.size
+        if mode == 'draft':
+            target = (math.ceil(width / value), math.ceil(height / value))
+        else:
+            scale = min(1.0, math.sqrt(value / (width * height)))
+            target = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+        pic.draft('RGB', target)
+        pic = pic.convert('RGB')
+        factor = min(pic.size[0] // target[0], pic.size[1] // target[1])
+        if factor > 1:
+            pic = pic.reduce(factor)
+        if mode == 'max_pixels' and pic.size[0] * pic.size[1] > value:
+            pic = pic.resize(target, img.BOX)
+        return pic
+
+
+def get_pixels(img_path, resolution=FULL_RESOLUTION):
+    """
+    Decodes the given image into an array of RGB pixel values.
+
+    Parameters
+    ----------
+    img_path : str
+        The file path for the image
+    resolution : str
+        The extraction resolution, see parse_resolution
+
+    Returns
+    -------
+    numpy.ndarray
+        A (height, width, 3) array of uint8 RGB values
+    """
+
+    return np.asarray(decode_image(img_path, resolution))
+
+
+# Largest number of pixels in a strip yielded by iter_pixel_strips
+STRIP_PIXELS = 1 << 16
+
+
+def iter_pixel_strips(img_path, resolution=FULL_RESOLUTION,
+                      strip_pixels=STRIP_PIXELS):
+    """
+    Decodes the given image and yields its pixel values a strip of rows at
+    a time, so the arrays built from them stay small however large the
+    image is.
+
+    Parameters
+    ----------
+    img_path : str
+        The file path for the image
+    resolution : str
+        The extraction resolution, see parse_resolution
+    strip_pixels : int
+        The largest number of pixels in a strip. A strip always holds at
+        least one row
+
+    Yields
+    ------
+    numpy.ndarray
+        A (rows, width, 3) array of uint8 RGB values
+    """
+
+    pic = decode_image(img_path, resolution)
+    for top, pixels in iter_image_strips(pic, strip_pixels):
+        yield pixels
+
+
+def iter_image_strips(pic, strip_pixels=STRIP_PIXELS):
+    """
+    Yields the pixel values of a decoded image a strip of rows at a time,
+    along with the row each strip starts at.
+
+    Parameters
+    ----------
+    pic : PIL.Image.Image
+        The decoded RGB image
+    strip_pixels : int
+        The largest number of pixels in a strip. A strip always holds at
+        least one row
+
+    Yields
+    ------
+    tuple
+        The first row of the strip and a (rows, width, 3) array of its
+        uint8 RGB values
+    """
+
+    width, height = pic.size
+    rows = max(1, strip_pixels // max(1, width))
+    for top in range(0, height, rows):
+        yield top, np.asarray(pic.crop((0, top, width,
+                                        min(height, top + rows))))
+
+
+def get_intensity_bins(pixels):
+    """
+    Finds the intensity histogram bin of each pixel, the same bin
+    np.histogram puts its intensity in with INTENSITY_BINS.
+
+    The bin is found from the integer 299*R + 587*G + 114*B, which is 1000
+    times the intensity, so no float array is built. A few colors have an
+    intensity exactly on a bin edge that the float formula of get_intensity
+    rounds to just below it; those pixels are moved down a bin.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        A (..., 3) array of uint8 RGB values
+
+    Returns
+    -------
+    numpy.ndarray
+        A flat array containing the bin of each pixel
+    """
+
+    # Cast first, since older NumPy would compute uint8 * 299 in uint16
+    pixels = pixels.reshape(-1, 3).astype(np.int32)
+    sums = pixels[:, 0]*299 + pixels[:, 1]*587 + pixels[:, 2]*114
+    # Every bin but the last one is 10 wide
+    bins, rest = np.divmod(sums, 10000)
+    on_edge = np.flatnonzero((rest == 0) & (bins > 0))
+    if len(on_edge):
+        edge_pixels = pixels[on_edge].astype(np.float64)
+        intensities = (.299*edge_pixels[:, 0]) + (.587*edge_pixels[:, 1]) + \
+                      (.114*edge_pixels[:, 2])
+        bins[on_edge] -= intensities < bins[on_edge] * 10
+    return np.minimum(bins, len(INTENSITY_BINS) - 2)
+
+
+def intensity_histogram(pixels):
+    """
+    Creates the intensity histogram for an array of RGB pixel values.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        A (..., 3) array of uint8 RGB values
+
+    Returns
+    -------
+    numpy.ndarray
+        The 25 bin intensity histogram
+    """
+
+    return np.bincount(get_intensity_bins(pixels),
+                       minlength=len(INTENSITY_BINS) - 1)
+
+
+def get_color_codes(pixels):
+    """
+    Transforms an array of RGB pixel values into 6-bit color codes, made of
+    the two most significant bits of each channel.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        A (..., 3) array of uint8 RGB values
+
+    Returns
+    -------
+    numpy.ndarray
+        A flat array containing the color code of each pixel
+    """
+
+    pixels = pixels.reshape(-1, 3)
+    return ((pixels[:, 0] >> 6) << 4) | ((pixels[:, 1] >> 6) << 2) | \
+           (pixels[:, 2] >> 6)
+
+
+def color_code_histogram(pixels):
+    """
+    Creates the color-code histogram for an array of RGB pixel values, binned
+    the same way as calculate_color_code.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        A (..., 3) array of uint8 RGB values
+
+    Returns
+    -------
+    numpy.ndarray
+        The 64 bin color-code histogram
+    """
+
+    return color_code_counts_to_histogram(color_code_counts(pixels))
+
+
+def color_code_counts(pixels):
+    """
+    Counts the pixels for each of the 64 possible 6-bit color codes. This is
+    the color-code histogram used by the feature matrix ('colorCode.xlsx').
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        A (..., 3) array of uint8 RGB values
+
+    Returns
+    -------
+    numpy.ndarray
+        The 64 bin color-code histogram, H1: 000000 ... H64: 111111
+    """
+
+    return np.bincount(get_color_codes(pixels), minlength=64)
+
+
+def color_code_counts_to_histogram(counts):
+    """
+    Bins the counts of each color code the way np.histogram(codes, bins=64)
+    bins the codes themselves: 64 equal bins between the smallest and the
+    largest code present.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        The number of pixels with each of the 64 color codes
+
+    Returns
+    -------
+    numpy.ndarray
+        The 64 bin color-code histogram
+    """
+
+    codes = np.flatnonzero(counts)
+    if len(codes) == 0:
+        return np.zeros(64, dtype=np.int64)
+    hist, bin_edges = np.histogram(codes, bins=64,
+                                   range=(codes[0], codes[-1]),
+                                   weights=counts[codes])
+    return hist.astype(np.int64)
+
+
+# Bins of the HSV histogram for hue, saturation and value
+HSV_BINS = (16, 4, 4)
+# The spatial grid histogram splits the image into GRID_SIZE x GRID_SIZE
+# cells
+GRID_SIZE = 2
+
+
+def get_fine_color_codes(pixels):
+    """
+    Transforms an array of RGB pixel values into 12-bit color codes, made
+    of the four most significant bits of each channel.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        A (..., 3) array of uint8 RGB values
+
+    Returns
+    -------
+    numpy.ndarray
+        A flat array containing the color code of each pixel
+    """
+
+    pixels = pixels.reshape(-1, 3).astype(np.int32)
+    return ((pixels[:, 0] >> 4) << 8) | ((pixels[:, 1] >> 4) << 4) | \
+           (pixels[:, 2] >> 4)
+
+
+def get_hsv_bins(pixels):
+    """
+    Finds the HSV histogram bin of each pixel. The pixels are converted with
+    PIL, which gives the hue, saturation and value from 0 to 255, and each
+    of them is split into the number of bins in HSV_BINS.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        A (rows, width, 3) array of uint8 RGB values
+
+    Returns
+    -------
+    numpy.ndarray
+        A flat array containing the bin of each pixel
+    """
+
+    hsv = np.asarray(img.fromarray(np.ascontiguousarray(pixels), 'RGB')
+                     .convert('HSV')).reshape(-1, 3).astype(np.int32)
+    hue_bins, sat_bins, val_bins = HSV_BINS
+    return ((hsv[:, 0] * hue_bins) >> 8) * sat_bins * val_bins + \
+           ((hsv[:, 1] * sat_bins) >> 8) * val_bins + \
+           ((hsv[:, 2] * val_bins) >> 8)
+
+
+class PixelStrip:
+    """
+    A strip of rows of a decoded image, handed to every feature extractor.
+    Arrays computed from the pixels that several features use, such as the
+    color codes, are computed once per strip and shared between them, so
+    every feature is computed in the same pass over the pixels.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        A (rows, width, 3) array of uint8 RGB values
+    top : int
+        The row of the image the strip starts at
+    height : int, optional
+        The height of the whole image. Defaults to the height of the strip
+    """
+
+    def __init__(self, pixels, top=0, height=None):
+        self.pixels = pixels
+        self.top = top
+        self.height = len(pixels) if height is None else height
+        self.width = pixels.shape[1]
+        self.cache = dict()
+
+    def get(self, name, compute):
+        """
+        Returns an array computed from the pixels, computing it the first
+        time it is asked for.
+
+        Parameters
+        ----------
+        name : str
+            The name the array is kept under
+        compute : function
+            Takes the (rows, width, 3) pixel array and returns the array
+
+        Returns
+        -------
+        numpy.ndarray
+            The array
+        """
+
+        if name not in self.cache:
+            self.cache[name] = compute(self.pixels)
+        return self.cache[name]
+
+
+def extract_color_code(strip):
+    """
+    Extractor of the 'color_code' feature, see color_code_counts.
+
+    Parameters
+    ----------
+    strip : PixelStrip
+        The pixels
+
+    Returns
+    -------
+    numpy.ndarray
+        The 64 bin color-code histogram of the strip
+    """
+
+    return np.bincount(strip.get('color_codes', get_color_codes),
+                       minlength=64)
+
+
+def extract_intensity(strip):
+    """
+    Extractor of the 'intensity' feature, see intensity_histogram.
+
+    Parameters
+    ----------
+    strip : PixelStrip
+        The pixels
+
+    Returns
+    -------
+    numpy.ndarray
+        The 25 bin intensity histogram of the strip
+    """
+
+    return np.bincount(strip.get('intensity_bins', get_intensity_bins),
+                       minlength=len(INTENSITY_BINS) - 1)
+
+
+def extract_hsv(strip):
+    """
+    Extractor of the 'hsv' feature, see get_hsv_bins.
+
+    Parameters
+    ----------
+    strip : PixelStrip
+        The pixels
+
+    Returns
+    -------
+    numpy.ndarray
+        The HSV histogram of the strip
+    """
+
+    return np.bincount(strip.get('hsv_bins', get_hsv_bins),
+                       minlength=int(np.prod(HSV_BINS)))
+
+
+def extract_fine_color_code(strip):
+    """
+    Extractor of the 'color_code_4bit' feature, see get_fine_color_codes.
+
+    Parameters
+    ----------
+    strip : PixelStrip
+        The pixels
+
+    Returns
+    -------
+    numpy.ndarray
+        The 4096 bin color-code histogram of the strip
+    """
+
+    return np.bincount(strip.get('fine_color_codes', get_fine_color_codes),
+                       minlength=4096)
+
+
+def extract_grid_color_code(strip):
+    """
+    Extractor of the 'grid_color_code' feature: a 64 bin color-code
+    histogram for each cell of a GRID_SIZE x GRID_SIZE grid over the image,
+    cell by cell from the top left. The cell of each row is found from the
+    row's position in the whole image, so the strips add up.
+
+    Parameters
+    ----------
+    strip : PixelStrip
+        The pixels
+
+    Returns
+    -------
+    numpy.ndarray
+        The grid histogram of the strip
+    """
+
+    rows = (strip.top + np.arange(len(strip.pixels))) * GRID_SIZE // \
+        strip.height
+    cols = np.arange(strip.width) * GRID_SIZE // strip.width
+    cells = (rows[:, np.newaxis] * GRID_SIZE + cols[np.newaxis, :]).ravel()
+    codes = strip.get('color_codes', get_color_codes)
+    return np.bincount(cells * 64 + codes, minlength=GRID_SIZE ** 2 * 64)
+
+
+class Feature:
+    """
+    A feature computed by extract_features.
+
+    Parameters
+    ----------
+    name : str
+        The name of the feature
+    dim : int
+        The length of its histogram
+    extractor : function
+        Takes a PixelStrip and returns the histogram of its pixels, as a
+        numpy.ndarray of length dim. Images are processed a strip at a
+        time, so the histograms of the strips must add up to the histogram
+        of the image
+    label : str, optional
+        The name shown in the UI. Defaults to the name
+    """
+
+    def __init__(self, name, dim, extractor, label=None):
+        self.name = name
+        self.dim = dim
+        self.extractor = extractor
+        self.label = name if label is None else label
+
+
+# Features computed by extract_features, by name, in the column order of
+# the feature store
+FEATURES = collections.OrderedDict()
+
+
+def register_feature(name, extractor, dim, label=None):
+    """
+    Adds a feature to the ones computed by extract_features. It is then
+    stored in the feature store and can be searched like the others.
+
+    Parameters
+    ----------
+    name : str
+        The name of the feature
+    extractor : function
+        Takes a PixelStrip and returns its histogram, see Feature
+    dim : int
+        The length of the histogram
+    label : str, optional
+        The name shown in the UI
+    """
+
+    FEATURES[name] = Feature(name, dim, extractor, label)
+
+
+register_feature('color_code', extract_color_code, 64, "Color-Code")
+register_feature('intensity', extract_intensity, len(INTENSITY_BINS) - 1,
+                 "Intensity")
+register_feature('hsv', extract_hsv, int(np.prod(HSV_BINS)), "HSV")
+register_feature('color_code_4bit', extract_fine_color_code, 4096,
+                 "Color-Code (4-bit)")
+register_feature('grid_color_code', extract_grid_color_code,
+                 GRID_SIZE ** 2 * 64, "Color-Code Grid")
+
+# The features of the "Intensity + Color-Code" method, in the column order
+# of the feature matrix and the normalization matrix
+COMBINED_FEATURES = ['color_code', 'intensity']
+
+# The features stored by default: the ones the methods of the UI search. The
+# other registered features add thousands of columns to every image, so they
+# are only extracted when named in the CBIR_FEATURES environment variable or
+# the --features option of the scripts, as a comma-separated list
+DEFAULT_FEATURES = list(COMBINED_FEATURES)
+
+
+def parse_features(text):
+    """
+    Parses a comma-separated list of feature names, such as
+    'color_code,intensity,hsv'.
+
+    Parameters
+    ----------
+    text : str
+        The feature names, separated by commas
+
+    Returns
+    -------
+    list
+        The names of the features, each registered in FEATURES
+    """
+
+    features = [name.strip() for name in text.split(',') if name.strip()]
+    for name in features:
+        if name not in FEATURES:
+            raise ValueError("Unknown feature " + repr(name) +
+                             ", expected one of " + ', '.join(FEATURES))
+    if not features:
+        raise ValueError("No features given")
+    return features
+
+
+def get_configured_features():
+    """
+    Returns the features to store: the ones named in the CBIR_FEATURES
+    environment variable, or DEFAULT_FEATURES when it is not set.
+
+    Returns
+    -------
+    list
+        The names of the features, each registered in FEATURES
+    """
+
+    text = os.environ.get('CBIR_FEATURES')
+    if text is None:
+        return list(DEFAULT_FEATURES)
+    return parse_features(text)
+
+
+def extract_features(img_path, features=None, resolution=FULL_RESOLUTION):
+    """
+    Decodes the given image once and computes every requested feature from
+    the same pixels, in a single pass. The histograms are added up a strip
+    of rows at a time (see iter_image_strips), so no per-pixel array of the
+    whole image is built.
+
+    Parameters
+    ----------
+    img_path : str
+        The file path for the image
+    features : list, optional
+        The names of the features to compute. All registered features are
+        computed by default
+    resolution : str
+        The extraction resolution, see parse_resolution. The returned image
+        size is the number of pixels decoded
+
+    Returns
+    -------
+    tuple
+        The first value contains the image size, second value is a dict
+        mapping each feature name to its histogram
+    """
+
+    if features is None:
+        features = FEATURES.keys()
+    size = 0
+    hists = collections.OrderedDict((name, 0) for name in features)
+    with metrics.timer('extract'):
+        pic = decode_image(img_path, resolution)
+        height = pic.size[1]
+        for top, pixels in iter_image_strips(pic):
+            strip = PixelStrip(pixels, top, height)
+            size += pixels.shape[0] * pixels.shape[1]
+            for name in hists:
+                hists[name] = hists[name] + FEATURES[name].extractor(strip)
+    metrics.count('images_decoded')
+    metrics.count('pixels_decoded', size)
+    return (size, hists)
+
+
+def get_combined_features(img_path, features=None,
+                          resolution=FULL_RESOLUTION):
+    """
+    Creates the combined feature vector for the given image, where each
+    histogram is divided by the image size. With COMBINED_FEATURES this is
+    the row (64 color-code + 25 intensity) of the feature matrix.
+
+    Parameters
+    ----------
+    img_path : str
+        The file path for the image
+    features : list, optional
+        The names of the features to combine. All registered features are
+        used by default
+    resolution : str
+        The extraction resolution, see parse_resolution
+
+    Returns
+    -------
+    numpy.ndarray
+        The combined feature vector
+    """
+
+    size, hists = extract_features(img_path, features, resolution)
+    return np.concatenate([hist / size for hist in hists.values()])
+
+
 def calculate_intensity(img_path):
     """
     Calculates the intensity for each pixel of the given image and creates
@@ -38,24 +720,64 @@ def calculate_intensity(img_path):
         intensity histogram
     """
 
+    size, hists = extract_features(img_path, ['intensity'])
+    return (size, hists['intensity'])
+
+
+def calculate_color_code(img_path):
+    """
+    Calculates the color-code for each pixel of the given image and creates
+    a histogram.
+    
+    Parameters
+    ----------
+    img_path : str
+        The file path for the image
+    
+    Returns
+    -------
+    tuple
+        The first value contains the image size, second value contains the
+        color-code histogram
+    """
+
+    size, hists = extract_features(img_path, ['color_code'])
+    return (size, color_code_counts_to_histogram(hists['color_code']))
+
+
+def calculate_intensity_reference(img_path):
+    """
+    Pixel by pixel version of calculate_intensity. Much slower, kept as a
+    reference to check the vectorized version against.
+    
+    Parameters
+    ----------
+    img_path : str
+        The file path for the image
+    
+    Returns
+    -------
+    tuple
+        The first value contains the image size, second value contains the
+        intensity histogram
+    """
+
     pic = img.open(img_path)
     width, height = pic.size
     intensities = list()
-    bins = list(range(0,250,10))
-    bins.append(255)
 
     for i in range(width):
         for j in range(height):
             intensities.append(get_intensity(pic.getpixel((i,j))))
 
-    hist, bin_edges = np.histogram(intensities, bins=bins)
+    hist, bin_edges = np.histogram(intensities, bins=INTENSITY_BINS)
     return (width*height, hist)
 
     
-def calculate_color_code(img_path):
+def calculate_color_code_reference(img_path):
     """
-    Calculates the color-code for each pixel of the given image and creates
-    a histogram.
+    Pixel by pixel version of calculate_color_code. Much slower, kept as a
+    reference to check the vectorized version against.
     
     Parameters
     ----------
@@ -66,7 +788,7 @@ def calculate_color_code(img_path):
     -------
     tuple
         The first value contains the image size, second value contains the
-        intensity histogram
+        color-code histogram
     """
 
     pic = img.open(img_path)
@@ -119,17 +841,123 @@ def calculate_manhattan(img1, img2):
         result += abs((h_i / size_i) - (h_k / size_k))
     return result
 
-def get_distance(selected_img, method):
+# The stored feature used in place of each CBIR method
+METHOD_FEATURES = {
+    calculate_intensity: 'intensity',
+    calculate_color_code: 'color_code',
+}
+
+
+def get_feature_store(img_dir='images/', features=None):
+    """
+    Opens the default feature store and brings it up to date with the images
+    in the given folder. Only new or modified images are decoded.
+
+    Parameters
+    ----------
+    img_dir : str
+        The folder containing the images
+    features : list, optional
+        The names of the features to store. The configured features (see
+        get_configured_features) are stored by default
+
+    Returns
+    -------
+    feature_store.FeatureStore
+        The up to date feature store
+    """
+
+    # Imported here since feature_store uses this module
+    import feature_store
+
+    store = feature_store.FeatureStore(features=features)
+    store.sync(feature_store.get_image_paths(img_dir))
+    return store
+
+
+def get_distance(selected_img, method, store=None, workers=None):
     """
     Calcuates the Manhattan Distance between the selected image and all other
     images in the "images/" directory based on the chosen CBIR method.
 
+    The histograms are read from the feature store, so no database image is
+    decoded. Methods without a stored feature are computed image by image.
+
+    Parameters
+    ----------
+    selected_img : str
+        The file path of the selected image
+    method : function or str
+        The chosen CBIR method (either calculate_intensity or calculate_color_code),
+        or the name of any feature in FEATURES
+    store : feature_store.FeatureStore, optional
+        The feature store to use. The default store is synced with the
+        "images/" directory if none is given
+    workers : int, optional
+        Splits the scan into shards scored on this many threads, see
+        search.ShardedScan. The result is the same
+    
+    Returns
+    -------
+    list
+        A sorted list of tuples containing all of the distances. The first
+        value in each tuple is the distance. The second is the image path.
+        The list is sorted in ascending order based on distance.
+    """
+
+    if method in FEATURES:
+        name = method
+    elif method in METHOD_FEATURES:
+        name = METHOD_FEATURES[method]
+    else:
+        return get_distance_reference(selected_img, method)
+
+    if store is None:
+        store = get_feature_store()
+    with metrics.timer('feature_lookup'):
+        if selected_img in store:
+            selected = store.get(selected_img, name)
+        else:
+            selected = get_combined_features(selected_img, [name],
+                                             store.resolution)
+        matrix = store.feature_matrix(name)
+
+    if workers:
+        # Imported here since search uses this module
+        import search
+
+        with metrics.timer('distance'):
+            with search.ShardedScan(matrix, store.paths, workers) as scan:
+                result = scan.query(selected, exclude=selected_img)
+        metrics.count('queries')
+        metrics.count('images_scanned', scan.last_scanned)
+        return result
+
+    with metrics.timer('distance'):
+        distances = np.abs(matrix - selected).sum(axis=1)
+    metrics.count('queries')
+    metrics.count('images_scanned', len(distances))
+
+    with metrics.timer('sort'):
+        result = list()
+        for distance, path in zip(distances.tolist(), store.paths):
+            if path != selected_img:
+                result.append((distance, path))
+        return sorted(result)
+
+
+def get_distance_reference(selected_img, method):
+    """
+    Calcuates the Manhattan Distance between the selected image and all other
+    images in the "images/" directory by running the chosen CBIR method on
+    every image.
+
     Parameters
     ----------
     selected_img : str
         The file path of the selected image
     method : function
-        The chosen CBIR method (either calculate_intensity or calculate_color_code)
+        The chosen CBIR method
     
     Returns
     -------
@@ -151,36 +979,41 @@ def get_distance(selected_img, method):
             result.append((distance, path))
     return sorted(result)
 
-def intensity_data_to_json():
+def intensity_data_to_json(img_dir='images/'):
     """
     Computes the Manhattan Distance between every image in the 'images/'
     folder using the Intensity method. Stores all of this data in JSON file.
+
+    Parameters
+    ----------
+    img_dir : str
+        The folder containing the images
     """
+    store = get_feature_store(img_dir)
     intensity_data = dict()
-    for img in os.listdir("images/"):
-        if img == 'Thumbs.db':
-            continue
-        path = 'images/' + img
-        result = get_distance(path, calculate_intensity)
+    for path in store.paths:
+        result = get_distance(path, calculate_intensity, store)
         intensity_data[path] = result
 
     with open('intensity_data.json', 'w') as file:
         json.dump(intensity_data, file)
 
-def color_code_data_to_json():
+def color_code_data_to_json(img_dir='images/'):
     """
     Computes the Manhattan Distance between every image in the 'images/'
     folder using the Color-code method. Stores all of this data in
     JSON file.
+
+    Parameters
+    ----------
+    img_dir : str
+        The folder containing the images
     """
+    store = get_feature_store(img_dir)
     color_code_data = dict()
-    for img in os.listdir("images/"):
-        if img == 'Thumbs.db':
-            continue
-        path = 'images/' + img
-        result = get_distance(path, calculate_color_code)
+    for path in store.paths:
+        result = get_distance(path, calculate_color_code, store)
         color_code_data[path] = result
 
     with open('color_code_data.json', 'w') as file:
         json.dump(color_code_data, file)
-
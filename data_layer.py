@@ -0,0 +1,298 @@
+import hashlib
+import os
+import time
+import pandas as pd
+import relevance_feedback as rf
+import search
+import feature_format
+import result_cache
+import thumbnails
+
+# The "Intensity + Color-Code" method, which searches the normalization
+# matrix
+COMBINED = 'combined'
+
+
+class DataLayer:
+    """
+    Loads the data the UI searches: the query engine, the normalization
+    matrix and the relevance feedback index. Each one is loaded the first
+    time it is used and then kept, and the time each load took is recorded
+    in load_times. The normalization matrix is built from the feature
+    store, and built again (with the feedback index) when the store
+    changes, so images added to the store are searched by every method.
+    Also holds the thumbnail cache of the result grid and the cache of
+    recent query results.
+
+    Parameters
+    ----------
+    img_dir : str
+        The folder containing the images
+    index_kind : str
+        The kind of relevance feedback index, see
+        relevance_feedback.build_feedback_index. 'uint8' or 'sparse' scan
+        a compact copy of the normalization matrix, which uses less memory
+        on large catalogs
+    engine : search.QueryEngine, optional
+        The query engine to search, such as one over another feature
+        store. One searching img_dir is created on first use by default
+    """
+
+    def __init__(self, img_dir='images/', index_kind='box', engine=None):
+        self.img_dir = img_dir
+        self.index_kind = index_kind
+        self.load_times = dict()
+        self._engine = engine
+        self._normalized_matrix = None
+        # The store version the normalization matrix was built from
+        self._normalized_version = None
+        # Goes up every time the normalization matrix is built, so results
+        # of an older matrix can be told apart
+        self.normalized_generation = 0
+        self._feedback_index = None
+        self.thumbnails = thumbnails.ThumbnailCache()
+        self.results = result_cache.ResultCache()
+
+    def timed(self, name, load):
+        """
+        Runs a load function and records how long it took.
+
+        Parameters
+        ----------
+        name : str
+            The name of the data being loaded
+        load : function
+            Loads and returns the data
+
+        Returns
+        -------
+        object
+            The loaded data
+        """
+
+        start = time.perf_counter()
+        data = load()
+        self.load_times[name] = time.perf_counter() - start
+        return data
+
+    @property
+    def engine(self):
+        """
+        search.QueryEngine : The query engine for the Intensity and
+        Color-Code methods
+        """
+
+        if self._engine is None:
+            self._engine = self.timed(
+                'engine', lambda: search.QueryEngine(img_dir=self.img_dir))
+        return self._engine
+
+    @property
+    def normalized_matrix(self):
+        """
+        pandas.DataFrame : The normalization matrix, built from the feature
+        store of the engine, see store_normalized_matrix
+        """
+
+        store = self.engine.store
+        if self._normalized_matrix is None or \
+                self._normalized_version != store.version:
+            self._normalized_matrix = self.timed(
+                'normalized_matrix', lambda: store_normalized_matrix(store))
+            self._normalized_version = store.version
+            self.normalized_generation += 1
+            self._feedback_index = None
+        return self._normalized_matrix
+
+    @property
+    def feedback_index(self):
+        """
+        indexes.BruteForceIndex : The index used for the Intensity +
+        Color-Code method, of the kind index_kind
+        """
+
+        matrix = self.normalized_matrix
+        if self._feedback_index is None:
+            self._feedback_index = self.timed(
+                'feedback_index',
+                lambda: rf.build_feedback_index(matrix, self.index_kind))
+        return self._feedback_index
+
+    def total_load_time(self):
+        """
+        Returns the time spent loading data so far.
+
+        Returns
+        -------
+        float
+            The total load time, in seconds
+        """
+
+        return sum(self.load_times.values())
+
+    def query_example(self, source, method, k=None, relevant_imgs=None):
+        """
+        Finds the images closest to a query image that does not have to be
+        in the database, such as an uploaded image. The database is not
+        changed.
+
+        Parameters
+        ----------
+        source : str or bytes
+            The file path of the image, or its encoded content
+        method : str
+            The name of a feature in cbir_methods.FEATURES (such as
+            'intensity' or 'color_code'), or 'combined' (Intensity +
+            Color-Code)
+        k : int, optional
+            The number of results. All images are returned by default
+        relevant_imgs : set or RelevantImages, optional
+            The relevant images chosen by the user, used to weight the
+            combined method
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        if method != COMBINED:
+            return self.engine.query_example(source, method, k)
+
+        features = [name for name, dim in feature_format.COMBINED_FEATURES]
+        query_features = self.engine.normalized_example(source, features)
+        if relevant_imgs:
+            weight = rf.get_feedback_weights(relevant_imgs,
+                                             self.normalized_matrix)
+        else:
+            weight = 1 / len(query_features)
+        return rf.calculate_vector_distance(self.normalized_matrix,
+                                            query_features, weight,
+                                            self.feedback_index, k)
+
+    def index_version(self, method):
+        """
+        Returns the version of the data searched by a method. For the
+        combined method it is the generation of the normalization matrix
+        (and of the feedback index built from it), which is built again
+        when the feature store changes. For the other methods it is the
+        version of the feature store.
+
+        Parameters
+        ----------
+        method : str
+            The name of a feature in cbir_methods.FEATURES, or 'combined'
+
+        Returns
+        -------
+        tuple
+            The version
+        """
+
+        if method == COMBINED:
+            # Builds the matrix again first if the store changed
+            self.normalized_matrix
+            return (COMBINED, self.normalized_generation)
+        return ('store', self.engine.store.version)
+
+    def search(self, query, method, k=None, relevant_imgs=None):
+        """
+        Finds the images closest to a query, serving repeated queries from
+        the result cache.
+
+        Parameters
+        ----------
+        query : str or bytes
+            The image path of an image in the database, or the encoded
+            content of any image
+        method : str
+            The name of a feature in cbir_methods.FEATURES (such as
+            'intensity' or 'color_code'), or 'combined' (Intensity +
+            Color-Code)
+        k : int, optional
+            The number of results. All images are returned by default
+        relevant_imgs : set or RelevantImages, optional
+            The relevant images chosen by the user, used to weight the
+            combined method
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        if method != COMBINED:
+            relevant_imgs = None
+        query_key = hashlib.sha256(query).hexdigest() \
+            if isinstance(query, bytes) else query
+        key = result_cache.make_key(query_key, method, relevant_imgs)
+        version = self.index_version(method)
+        results = self.results.get(key, k, version)
+        if results is not None:
+            return results
+
+        if isinstance(query, bytes):
+            results = self.query_example(query, method, k, relevant_imgs)
+        elif method != COMBINED:
+            results = self.engine.query(query, method, k)
+        elif relevant_imgs:
+            results = rf.calculate_updated_weight(
+                relevant_imgs, self.normalized_matrix, rf.get_img_num(query),
+                self.feedback_index, k)
+        else:
+            results = rf.calculate_distance(
+                self.normalized_matrix, rf.get_img_num(query),
+                1 / len(self.normalized_matrix.index), self.feedback_index, k)
+        self.results.put(key, results, k, version)
+        return results
+
+
+def store_normalized_matrix(store):
+    """
+    Builds the normalization matrix of the Intensity + Color-Code method
+    from a feature store, in the layout relevance_feedback uses. The
+    features are normalized with the running mean and standard deviation
+    of the store. relevance_feedback finds images by number, so images not
+    named '{number}.jpg' are left out.
+
+    Parameters
+    ----------
+    store : feature_store.FeatureStore
+        The feature store, holding the features of the method
+
+    Returns
+    -------
+    pandas.DataFrame
+        The (features x images) normalization matrix
+    """
+
+    features = [name for name, dim in feature_format.COMBINED_FEATURES]
+    paths = store.paths
+    rows = [row for row, path in enumerate(paths)
+            if os.path.splitext(os.path.basename(path))[0].isdigit()]
+    matrix = store.normalized_matrix(features)[rows]
+    index = [str(col) for col in range(matrix.shape[1])]
+    columns = [rf.get_img_num(paths[row]) for row in rows]
+    return pd.DataFrame(matrix.T, index=index, columns=columns)
+
+
+# Streamlit only re-runs the UI script, imported modules are kept, so this
+# is shared by every rerun and session of the process
+_data_layer = None
+
+
+def get_data_layer():
+    """
+    Returns the data layer of this process, creating it on first use. No
+    data is loaded until it is used.
+
+    Returns
+    -------
+    DataLayer
+        The data layer
+    """
+
+    global _data_layer
+    if _data_layer is None:
+        _data_layer = DataLayer()
+    return _data_layer
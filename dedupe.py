@@ -0,0 +1,454 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import cbir_methods
+import feature_store
+
+STATE_FILE = 'dedupe.json'
+KEYS_FILE = 'dedupe-keys.npy'
+
+# Images whose combined histograms (each summing to 1) are this close are
+# duplicates. Re-encoded, resized and slightly cropped copies of the
+# bundled images are within 0.3 of the original, different images are
+# further apart
+DEFAULT_THRESHOLD = 0.3
+DEFAULT_BUCKET_WIDTH = 0.2
+DEFAULT_TABLES = 16
+# Candidate pairs scored at a time
+PAIR_BLOCK = 65536
+
+
+def find(parents, item):
+    """
+    Finds the cluster of an item in a disjoint-set forest, shortening the
+    path to the root on the way.
+
+    Parameters
+    ----------
+    parents : dict
+        The parent of each item. Items missing from it are roots
+    item : object
+        The item
+
+    Returns
+    -------
+    object
+        The root item of the cluster
+    """
+
+    root = item
+    while parents.get(root, root) != root:
+        root = parents[root]
+    while item != root:
+        parents[item], item = root, parents[item]
+    return root
+
+
+def union(parents, first, second):
+    """
+    Merges the clusters of two items.
+
+    Parameters
+    ----------
+    parents : dict
+        The parent of each item, see find
+    first, second : object
+        The items
+
+    Returns
+    -------
+    bool
+        Whether the items were in different clusters
+    """
+
+    first, second = find(parents, first), find(parents, second)
+    if first == second:
+        return False
+    parents[max(first, second)] = min(first, second)
+    return True
+
+
+def hash_histograms(vectors, offsets, multipliers, bucket_width):
+    """
+    Hashes quantized histograms. In each hash table every bin is cut into
+    buckets of the given width, shifted by the table's random offset, and
+    the bucket numbers of all the bins are hashed into one key. Two
+    histograms a Manhattan Distance d apart get a different key with a
+    probability of at most d / bucket_width.
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        The (images x features) histograms
+    offsets : numpy.ndarray
+        The (tables x features) random offsets, between 0 and bucket_width
+    multipliers : numpy.ndarray
+        The (tables x features) random odd uint64 numbers the bucket
+        numbers are hashed with
+    bucket_width : float
+        The width of each bucket
+
+    Returns
+    -------
+    numpy.ndarray
+        The (images x tables) uint64 keys
+    """
+
+    vectors = np.asarray(vectors, dtype=np.float64)
+    keys = np.empty((len(vectors), len(offsets)), dtype=np.uint64)
+    for table in range(len(offsets)):
+        codes = np.floor((vectors + offsets[table]) / bucket_width)
+        # The products wrap around, which is what the hash wants
+        keys[:, table] = (codes.astype(np.uint64) *
+                          multipliers[table]).sum(axis=1, dtype=np.uint64)
+    return keys
+
+
+def candidate_pairs(keys, start):
+    """
+    Finds the pairs of images sharing a key in at least one hash table,
+    where at least one of the two is new.
+
+    Parameters
+    ----------
+    keys : numpy.ndarray
+        The (images x tables) keys, see hash_histograms
+    start : int
+        The new images are the rows from this one on
+
+    Returns
+    -------
+    numpy.ndarray
+        A (pairs x 2) array of row numbers, the larger first, each pair
+        listed once
+    """
+
+    new_rows = np.arange(start, len(keys))
+    found = list()
+    for table in range(keys.shape[1]):
+        order = np.argsort(keys[:, table], kind='stable')
+        sorted_keys = keys[order, table]
+        lows = np.searchsorted(sorted_keys, keys[start:, table], 'left')
+        counts = np.searchsorted(sorted_keys, keys[start:, table],
+                                 'right') - lows
+        # Every row in the bucket of each new row
+        firsts = np.repeat(new_rows, counts)
+        seconds = order[np.arange(counts.sum()) +
+                        np.repeat(lows - np.cumsum(counts) + counts, counts)]
+        # Pairs of two new rows are found from both sides, so only the
+        # pair with the larger row first is kept
+        keep = seconds < firsts
+        found.append(firsts[keep] * len(keys) + seconds[keep])
+    if not found:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.unique(np.concatenate(found))
+    return np.stack([pairs // len(keys), pairs % len(keys)], axis=1)
+
+
+class DuplicateFinder:
+    """
+    Finds the duplicate and near-duplicate images of a feature store.
+    Candidate pairs are the images sharing a bucket of quantized
+    histograms (see hash_histograms) in one of the hash tables, so the work
+    grows with the number of images rather than the number of pairs. Each
+    candidate pair is verified with calculate_manhattan, and the pairs
+    within the threshold are linked into clusters (an image is in a cluster
+    if it is within the threshold of any of its other images).
+
+    The keys and the verified pairs are saved in the store's folder, so
+    each update only hashes and verifies the images ingested (or modified)
+    since the last one.
+
+    Parameters
+    ----------
+    store_dir : str
+        The folder of the feature store
+    features : list, optional
+        The names of the features compared. Defaults to the features of
+        the "Intensity + Color-Code" method
+    threshold : float
+        The largest Manhattan Distance between duplicates
+    bucket_width : float
+        The width of the hash buckets. Wider buckets miss fewer duplicates
+        but give more candidate pairs
+    num_tables : int
+        The number of hash tables. More tables miss fewer duplicates but
+        give more candidate pairs
+    seed : int
+        The seed of the random hashes
+    """
+
+    def __init__(self, store_dir=feature_store.DEFAULT_STORE_DIR,
+                 features=None, threshold=DEFAULT_THRESHOLD,
+                 bucket_width=DEFAULT_BUCKET_WIDTH, num_tables=DEFAULT_TABLES,
+                 seed=0):
+        if features is None:
+            features = cbir_methods.COMBINED_FEATURES
+        self.store_dir = store_dir
+        self.features = list(features)
+        self.params = {'features': self.features, 'threshold': threshold,
+                       'bucket_width': bucket_width, 'num_tables': num_tables,
+                       'seed': seed}
+        width = sum(feature_store.get_feature_dims(self.features).values())
+        rng = np.random.default_rng(seed)
+        self.offsets = rng.uniform(0, bucket_width, (num_tables, width))
+        self.multipliers = rng.integers(0, 2 ** 63, (num_tables, width),
+                                        dtype=np.uint64) * 2 + 1
+        # The images already checked, with their file keys
+        self.paths = list()
+        self.file_keys = list()
+        self.keys = np.zeros((0, num_tables), dtype=np.uint64)
+        # The verified (path, path, distance) pairs linking the clusters
+        self.links = list()
+        self.load()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def load(self):
+        """
+        Loads the saved keys and pairs. A state saved with different
+        parameters is ignored, so every image is checked again.
+        """
+
+        state_path = os.path.join(self.store_dir, STATE_FILE)
+        keys_path = os.path.join(self.store_dir, KEYS_FILE)
+        if not os.path.exists(state_path) or not os.path.exists(keys_path):
+            return
+        with open(state_path) as file:
+            state = json.load(file)
+        if state['params'] != self.params:
+            return
+        self.paths = state['paths']
+        self.file_keys = [tuple(key) for key in state['file_keys']]
+        self.links = [tuple(link) for link in state['links']]
+        self.keys = np.load(keys_path)
+
+    def save(self):
+        """
+        Writes the keys and pairs into the store's folder. Each file is
+        replaced atomically.
+        """
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        keys_path = os.path.join(self.store_dir, KEYS_FILE)
+        tmp_keys = keys_path + '.tmp.npy'
+        np.save(tmp_keys, self.keys)
+        os.replace(tmp_keys, keys_path)
+
+        state_path = os.path.join(self.store_dir, STATE_FILE)
+        tmp_state = state_path + '.tmp'
+        with open(tmp_state, 'w') as file:
+            json.dump({'params': self.params, 'paths': self.paths,
+                       'file_keys': self.file_keys, 'links': self.links},
+                      file)
+        os.replace(tmp_state, state_path)
+
+    def forget(self, paths):
+        """
+        Drops images and their pairs, so they are checked again by the next
+        update. The other images of their clusters are dropped too, since
+        a cluster may split without them.
+
+        Parameters
+        ----------
+        paths : set
+            The file paths of the images
+
+        Returns
+        -------
+        int
+            The number of images dropped
+        """
+
+        parents = self.get_parents()
+        roots = set(find(parents, path) for path in paths)
+        drop = set(path for path in self.paths
+                   if path in paths or find(parents, path) in roots)
+        if not drop:
+            return 0
+        keep = [row for row, path in enumerate(self.paths)
+                if path not in drop]
+        self.paths = [self.paths[row] for row in keep]
+        self.file_keys = [self.file_keys[row] for row in keep]
+        self.keys = self.keys[keep]
+        self.links = [link for link in self.links
+                      if link[0] not in drop and link[1] not in drop]
+        return len(drop)
+
+    def update(self, store):
+        """
+        Checks the images added to the store (or modified) since the last
+        update against every image, and forgets the images removed from
+        it. The state is saved if anything changed.
+
+        Parameters
+        ----------
+        store : feature_store.FeatureStore
+            The feature store, holding the features compared
+
+        Returns
+        -------
+        dict
+            The number of images checked, candidate pairs found and
+            duplicate pairs linked
+        """
+
+        counts = {'checked': 0, 'candidates': 0, 'linked': 0}
+        missing = [name for name in self.features if name not in store.dims]
+        if missing:
+            print("Error, the store does not hold the features " +
+                  ', '.join(missing))
+            return counts
+
+        def get_file_key(path):
+            entry = store.entries[store.rows[path]]
+            return (entry['mtime'], entry['size'])
+
+        stale = set(path for path, file_key in zip(self.paths, self.file_keys)
+                    if path not in store or get_file_key(path) != file_key)
+        self.forget(stale)
+        known = set(self.paths)
+        new_paths = [path for path in store.paths if path not in known]
+        if not new_paths and not stale:
+            return counts
+
+        start = len(self.paths)
+        self.paths.extend(new_paths)
+        self.file_keys.extend(get_file_key(path) for path in new_paths)
+        store_rows = np.array([store.rows[path] for path in self.paths],
+                              dtype=np.int64)
+        self.keys = np.concatenate([self.keys, hash_histograms(
+            self.get_vectors(store, store_rows[start:]), self.offsets,
+            self.multipliers, self.params['bucket_width'])])
+
+        pairs = candidate_pairs(self.keys, start)
+        parents = self.get_parents()
+        threshold = self.params['threshold']
+        for block in range(0, len(pairs), PAIR_BLOCK):
+            block_pairs = pairs[block:block + PAIR_BLOCK]
+            rows, inverse = np.unique(block_pairs, return_inverse=True)
+            vectors = self.get_vectors(store, store_rows[rows])
+            inverse = inverse.reshape(block_pairs.shape)
+            distances = np.abs(vectors[inverse[:, 0]] -
+                               vectors[inverse[:, 1]]).sum(axis=1)
+            # calculate_manhattan has the final say, the margin only covers
+            # the rounding of the two sums
+            for pair in np.flatnonzero(distances <= threshold + 1e-9):
+                first, second = self.paths[block_pairs[pair, 0]], \
+                    self.paths[block_pairs[pair, 1]]
+                if find(parents, first) == find(parents, second):
+                    continue
+                distance = cbir_methods.calculate_manhattan(
+                    (1, vectors[inverse[pair, 0]]),
+                    (1, vectors[inverse[pair, 1]]))
+                if distance <= threshold:
+                    union(parents, first, second)
+                    self.links.append((first, second, float(distance)))
+                    counts['linked'] += 1
+
+        counts['checked'] = len(new_paths)
+        counts['candidates'] = len(pairs)
+        self.save()
+        return counts
+
+    def get_vectors(self, store, rows):
+        """
+        Reads the compared features of rows of the store.
+
+        Parameters
+        ----------
+        store : feature_store.FeatureStore
+            The feature store
+        rows : numpy.ndarray
+            The row numbers in the store's matrices
+
+        Returns
+        -------
+        numpy.ndarray
+            The (rows x features) histograms
+        """
+
+        return np.hstack([np.asarray(store.matrices[name][rows])
+                          for name in self.features])
+
+    def get_parents(self):
+        """
+        Links the verified pairs into a disjoint-set forest.
+
+        Returns
+        -------
+        dict
+            The parent of each linked image, see find
+        """
+
+        parents = dict()
+        for first, second, distance in self.links:
+            union(parents, first, second)
+        return parents
+
+    def clusters(self):
+        """
+        Returns the clusters of duplicate images.
+
+        Returns
+        -------
+        list
+            The sorted file paths of each cluster's images, largest
+            cluster first
+        """
+
+        parents = self.get_parents()
+        clusters = dict()
+        for path in set(path for link in self.links for path in link[:2]):
+            clusters.setdefault(find(parents, path), list()).append(path)
+        return sorted((sorted(paths) for paths in clusters.values()),
+                      key=lambda paths: (-len(paths), paths))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Find the duplicate and near-duplicate images of the "
+                    "feature store. Only the images ingested since the "
+                    "last run are checked.")
+    parser.add_argument('--store-dir', default=feature_store.DEFAULT_STORE_DIR,
+                        help="the folder of the feature store")
+    parser.add_argument('--features', type=cbir_methods.parse_features,
+                        help="comma-separated features the store holds "
+                             "(default: CBIR_FEATURES, or color_code,"
+                             "intensity)")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="largest Manhattan Distance between duplicates")
+    parser.add_argument('--bucket-width', type=float,
+                        default=DEFAULT_BUCKET_WIDTH,
+                        help="width of the hash buckets")
+    parser.add_argument('--tables', type=int, default=DEFAULT_TABLES,
+                        help="number of hash tables")
+    parser.add_argument('--output', help="write the clusters to this JSON "
+                                         "file instead of printing them")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    store = feature_store.FeatureStore(args.store_dir, args.features)
+    finder = DuplicateFinder(args.store_dir, threshold=args.threshold,
+                             bucket_width=args.bucket_width,
+                             num_tables=args.tables)
+    counts = finder.update(store)
+    clusters = finder.clusters()
+    elapsed = time.perf_counter() - start
+    print("Checked {checked} images: {candidates} candidate pairs, "
+          "{linked} duplicates".format(**counts))
+    print("Took {:.2f}s, {} clusters among {} images".format(
+        elapsed, len(clusters), len(finder)))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(clusters, file, indent=2)
+    else:
+        for paths in clusters:
+            print(' '.join(paths))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+import os, json
+import numpy as np
+import pandas as pd
+import cbir_methods
+import relevance_feedback as rf
+
+MAGIC = b'CBIRFEAT'
+VERSION = 1
+ALIGNMENT = 64
+
+# Column layout of the combined feature vectors in the existing artifacts
+COMBINED_FEATURES = [[name, cbir_methods.FEATURES[name].dim]
+                     for name in cbir_methods.COMBINED_FEATURES]
+
+
+def align(offset):
+    """
+    Rounds the offset up to the next multiple of ALIGNMENT.
+
+    Parameters
+    ----------
+    offset : int
+        A byte offset
+
+    Returns
+    -------
+    int
+        The aligned offset
+    """
+
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_feature_file(file_path, matrix, ids, features=None, dtype='float32',
+                       extra=None):
+    """
+    Saves a feature matrix in the binary feature format. The file holds:
+
+    - the magic bytes 'CBIRFEAT', the format version (uint16) and the
+      length of the JSON header (uint32)
+    - the JSON header: number of rows and columns, dtype, feature layout,
+      and the byte offsets of the matrix and of the id table
+    - the matrix, row-major and little-endian, aligned to 64 bytes
+    - the id table: (rows + 1) uint64 offsets into a UTF-8 blob of the ids
+
+    The file is replaced atomically.
+
+    Parameters
+    ----------
+    file_path : str
+        The file path to save to
+    matrix : numpy.ndarray
+        The (images x features) matrix
+    ids : list
+        The id (usually the image path) of each row
+    features : list, optional
+        The [name, length] of each feature, in column order
+    dtype : str
+        The type the matrix is stored as, 'float32' or 'float64'
+    extra : dict, optional
+        Any other JSON data to keep in the header
+    """
+
+    matrix = np.ascontiguousarray(matrix, dtype=np.dtype(dtype).newbyteorder('<'))
+    if matrix.ndim != 2 or len(matrix) != len(ids):
+        raise ValueError("The matrix must have one row per id")
+
+    blobs = [str(row_id).encode('utf-8') for row_id in ids]
+    offsets = np.zeros(len(blobs) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(blob) for blob in blobs])
+
+    header = {'rows': matrix.shape[0], 'cols': matrix.shape[1],
+              'dtype': np.dtype(dtype).name, 'features': features,
+              'extra': extra or dict()}
+    # The offsets depend on the header length, so compute them until the
+    # header stops growing
+    header['matrix_offset'] = header['ids_offset'] = 0
+    while True:
+        encoded = json.dumps(header).encode('utf-8')
+        matrix_offset = align(len(MAGIC) + 6 + len(encoded))
+        ids_offset = align(matrix_offset + matrix.nbytes)
+        if (header['matrix_offset'], header['ids_offset']) == \
+                (matrix_offset, ids_offset):
+            break
+        header['matrix_offset'] = matrix_offset
+        header['ids_offset'] = ids_offset
+
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(np.array(VERSION, dtype='<u2').tobytes())
+        file.write(np.array(len(encoded), dtype='<u4').tobytes())
+        file.write(encoded)
+        file.write(b'\0' * (matrix_offset - file.tell()))
+        file.write(matrix.tobytes())
+        file.write(b'\0' * (ids_offset - file.tell()))
+        file.write(offsets.tobytes())
+        file.write(b''.join(blobs))
+    os.replace(tmp_path, file_path)
+
+
+class FeatureFile:
+    """
+    A feature matrix saved with write_feature_file. The matrix is
+    memory-mapped, so opening the file does not read or copy it.
+
+    Parameters
+    ----------
+    file_path : str
+        The file path of the feature file
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(file_path + " is not a feature file")
+            version = int(np.frombuffer(file.read(2), dtype='<u2')[0])
+            if version > VERSION:
+                raise ValueError("Unsupported feature file version " +
+                                 str(version))
+            length = int(np.frombuffer(file.read(4), dtype='<u4')[0])
+            self.header = json.loads(file.read(length).decode('utf-8'))
+        self.version = version
+
+        rows = self.header['rows']
+        dtype = np.dtype(self.header['dtype']).newbyteorder('<')
+        self.matrix = np.memmap(file_path, dtype=dtype, mode='r',
+                                offset=self.header['matrix_offset'],
+                                shape=(rows, self.header['cols']))
+        self.offsets = np.memmap(file_path, dtype='<u8', mode='r',
+                                 offset=self.header['ids_offset'],
+                                 shape=(rows + 1,))
+        self.blob_offset = self.header['ids_offset'] + self.offsets.nbytes
+        self._ids = None
+
+    def __len__(self):
+        return self.header['rows']
+
+    @property
+    def features(self):
+        """
+        list : The [name, length] of each feature, in column order
+        """
+
+        return self.header['features']
+
+    @property
+    def ids(self):
+        """
+        list : The id of each row, read from the file the first time
+        """
+
+        if self._ids is None:
+            with open(self.file_path, 'rb') as file:
+                file.seek(self.blob_offset)
+                blob = file.read(int(self.offsets[-1]))
+            offsets = self.offsets.tolist()
+            self._ids = [blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+                         for i in range(len(self))]
+        return self._ids
+
+
+def get_image_path(img_num):
+    """
+    Creates the file path for the given image number.
+
+    Parameters
+    ----------
+    img_num : int
+        The image number
+
+    Returns
+    -------
+    str
+        The file path, in the form of "images/<img_num>.jpg"
+    """
+
+    return 'images/' + str(int(img_num)) + '.jpg'
+
+
+def load_normalized_frame(file_path):
+    """
+    Loads a normalized matrix feature file in the layout UI.py and
+    relevance_feedback use: one column per image number and one row per
+    feature. The data is not copied out of the memory-mapped file.
+
+    Parameters
+    ----------
+    file_path : str
+        The file path of the feature file
+
+    Returns
+    -------
+    pandas.DataFrame
+        The (features x images) normalization matrix
+    """
+
+    features = FeatureFile(file_path)
+    img_nums = [rf.get_img_num(path) for path in features.ids]
+    index = [str(col) for col in range(features.matrix.shape[1])]
+    return pd.DataFrame(features.matrix.T, index=index, columns=img_nums,
+                        copy=False)
+
+
+def convert_normalized_csv(csv_path='normalized_matrix.csv',
+                           file_path='normalized_matrix.cbf',
+                           dtype='float32'):
+    """
+    Converts the normalized matrix CSV into a feature file.
+
+    Parameters
+    ----------
+    csv_path : str
+        The normalized matrix CSV, one row per image number
+    file_path : str
+        The feature file to create
+    dtype : str
+        The type the matrix is stored as
+    """
+
+    df = pd.read_csv(csv_path, index_col=0)
+    ids = [get_image_path(img_num) for img_num in df.index]
+    write_feature_file(file_path, df.to_numpy(), ids, COMBINED_FEATURES,
+                       dtype, {'normalized': True})
+
+
+def convert_excel(file_path='feature_matrix.cbf', color_path='colorCode.xlsx',
+                  intensity_path='intensity.xlsx', dtype='float32'):
+    """
+    Converts the Excel histogram sheets into a feature file holding the
+    feature matrix built by relevance_feedback.get_feature_matrix.
+
+    Parameters
+    ----------
+    file_path : str
+        The feature file to create
+    color_path : str
+        The color-code histogram sheet
+    intensity_path : str
+        The intensity histogram sheet
+    dtype : str
+        The type the matrix is stored as
+    """
+
+    df = rf.get_feature_matrix(color_path, intensity_path)
+    ids = [get_image_path(img_num) for img_num in df.index]
+    write_feature_file(file_path, df.to_numpy(), ids, COMBINED_FEATURES,
+                       dtype, {'normalized': False})
+
+
+def convert_distance_json(json_path, file_path, dtype='float32'):
+    """
+    Converts an all-pairs distance JSON file (such as 'intensity_data.json')
+    into a feature file holding the square distance matrix. Row i, column j
+    is the distance between images i and j, in the order of the ids.
+
+    Parameters
+    ----------
+    json_path : str
+        The all-pairs distance JSON file
+    file_path : str
+        The feature file to create
+    dtype : str
+        The type the matrix is stored as
+    """
+
+    with open(json_path) as file:
+        data = json.load(file)
+    ids = sorted(data)
+    cols = dict((path, col) for col, path in enumerate(ids))
+    matrix = np.zeros((len(ids), len(ids)))
+    for row, path in enumerate(ids):
+        for distance, retrieved in data[path]:
+            matrix[row, cols[retrieved]] = distance
+    write_feature_file(file_path, matrix, ids, None, dtype,
+                       {'distances': True})
+
+
+def convert_feature_store(store, file_path, normalized=False,
+                          dtype='float32'):
+    """
+    Exports a feature store into a feature file.
+
+    Parameters
+    ----------
+    store : feature_store.FeatureStore
+        The feature store
+    file_path : str
+        The feature file to create
+    normalized : bool
+        Export the normalized matrix instead of the raw features
+    dtype : str
+        The type the matrix is stored as
+    """
+
+    matrix = store.normalized_matrix() if normalized \
+        else store.feature_matrix()
+    features = [[name, store.dims[name]] for name in store.features]
+    write_feature_file(file_path, matrix, store.paths, features, dtype,
+                       {'normalized': normalized})
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Convert the CSV, Excel and JSON artifacts into the "
+                    "binary feature format.")
+    parser.add_argument('kind', choices=['csv', 'excel', 'json'],
+                        help="the kind of artifact to convert")
+    parser.add_argument('source', nargs='*',
+                        help="the artifact(s) to convert (csv: the normalized "
+                             "matrix, excel: the color-code and intensity "
+                             "sheets, json: an all-pairs distance file)")
+    parser.add_argument('-o', '--output', required=True,
+                        help="the feature file to create")
+    parser.add_argument('--dtype', default='float32',
+                        choices=['float32', 'float64'])
+    args = parser.parse_args(argv)
+
+    if args.kind == 'csv':
+        convert_normalized_csv(*args.source[:1], file_path=args.output,
+                               dtype=args.dtype)
+    elif args.kind == 'excel':
+        convert_excel(args.output, *args.source[:2], dtype=args.dtype)
+    else:
+        convert_distance_json(args.source[0], args.output, args.dtype)
+
+
+if __name__ == '__main__':
+    main()
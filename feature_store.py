@@ -0,0 +1,804 @@
+import os, json, collections
+import numpy as np
+import cbir_methods
+
+DEFAULT_STORE_DIR = 'feature_store/'
+# Each feature has its own matrix file, named after the feature
+MATRIX_FILE = 'features-%s.npy'
+INDEX_FILE = 'index.json'
+STATS_FILE = 'stats.npz'
+
+# Images written into the store at a time by sync
+BATCH_SIZE = 10000
+# Rows copied at a time when a matrix file is rewritten
+COPY_ROWS = 65536
+# A full matrix file grows to at least this many times its rows, so
+# appending rows rewrites the header of each file only now and then
+GROWTH_FACTOR = 2
+# Most values read at a time when the statistics are computed from the
+# matrices, so the combined feature matrix is never held in memory
+STATS_ELEMENTS = 1 << 22
+
+
+def get_image_paths(img_dir='images/'):
+    """
+    Lists the image paths in the given folder.
+
+    Parameters
+    ----------
+    img_dir : str
+        The folder containing the images
+
+    Returns
+    -------
+    list
+        The path of every image in the folder, e.g. 'images/1.jpg'
+    """
+
+    paths = list()
+    for img in os.listdir(img_dir):
+        if img == 'Thumbs.db':
+            continue
+        paths.append(os.path.join(img_dir, img))
+    return paths
+
+
+def get_file_key(path):
+    """
+    Returns the values used to tell if an image changed since its features
+    were stored.
+
+    Parameters
+    ----------
+    path : str
+        The file path of the image
+
+    Returns
+    -------
+    tuple
+        The modification time (in ns) and the size (in bytes) of the file
+    """
+
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class RunningStats:
+    """
+    Running mean and variance of the feature vectors, used for the Gaussian
+    normalization of the feature matrix. Rows can be added and removed in
+    batches (Welford's method, merged with Chan's formula) without going
+    over the rest of the matrix.
+
+    Parameters
+    ----------
+    width : int
+        The length of the feature vectors
+    """
+
+    def __init__(self, width):
+        self.count = 0
+        self.mean = np.zeros(width)
+        self.m2 = np.zeros(width)
+
+    def add(self, rows):
+        """
+        Adds rows to the statistics.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            A (rows x features) matrix
+        """
+
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(self.mean))
+        if len(rows) == 0:
+            return
+        count = self.count + len(rows)
+        rows_mean = rows.mean(axis=0)
+        rows_m2 = ((rows - rows_mean) ** 2).sum(axis=0)
+        delta = rows_mean - self.mean
+        self.m2 = self.m2 + rows_m2 + delta ** 2 * self.count * len(rows) / count
+        self.mean = self.mean + delta * len(rows) / count
+        self.count = count
+
+    def remove(self, rows):
+        """
+        Removes rows that were added before from the statistics.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            A (rows x features) matrix
+        """
+
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(self.mean))
+        if len(rows) == 0:
+            return
+        count = self.count - len(rows)
+        if count <= 0:
+            self.__init__(len(self.mean))
+            return
+        rows_mean = rows.mean(axis=0)
+        rows_m2 = ((rows - rows_mean) ** 2).sum(axis=0)
+        mean = (self.mean * self.count - rows_mean * len(rows)) / count
+        delta = rows_mean - mean
+        self.m2 = np.maximum(self.m2 - rows_m2 -
+                             delta ** 2 * count * len(rows) / self.count, 0)
+        self.mean = mean
+        self.count = count
+
+    def std(self):
+        """
+        Returns the sample standard deviation of each feature. Features with
+        no variance (up to rounding errors left by removals) have a
+        standard deviation of 0.
+
+        Returns
+        -------
+        numpy.ndarray
+            The standard deviation of each feature
+        """
+
+        if self.count < 2:
+            return np.zeros(len(self.mean))
+        tol = 64 * np.finfo(np.float64).eps * \
+              (self.count * self.mean ** 2 + self.m2)
+        m2 = np.where(self.m2 <= tol, 0, self.m2)
+        return np.sqrt(m2 / (self.count - 1))
+
+    def normalize(self, rows, columns=None):
+        """
+        Applies the Gaussian normalization to the given rows. Features with a
+        standard deviation of 0 are set to 0.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            A (rows x features) matrix or a single feature vector
+        columns : numpy.ndarray, optional
+            The features the rows hold, when not all of them
+
+        Returns
+        -------
+        numpy.ndarray
+            The normalized rows
+        """
+
+        std = self.std()
+        mean = self.mean
+        if columns is not None:
+            std, mean = std[columns], mean[columns]
+        safe_std = np.where(std == 0, 1, std)
+        return np.where(std == 0, 0, (np.asarray(rows) - mean) / safe_std)
+
+
+class FeatureStore:
+    """
+    On-disk store of the image features. Each histogram, divided by the
+    image size, is one row of its feature's matrix. Every feature has its
+    own matrix saved as a '.npy' file, which is memory-mapped when loaded,
+    so searching one feature only reads that feature's file. An index file
+    maps each row to its image path, modification time and size, so
+    unchanged images are never decoded again. All the features of an image
+    are extracted together, in one pass over its pixels.
+
+    Images can be added, updated and removed one at a time. New rows are
+    appended to the matrix files in place, which are grown ahead of time,
+    and the index records how many rows are used. A modified image is
+    written into a new row, so a row the index refers to is never written
+    again and an interrupted update leaves the saved store as it was. The
+    mean and standard deviation used to normalize the features are kept up
+    to date incrementally, so no other row changes. Removed and modified
+    images leave an unused row behind until compact is called.
+
+    Parameters
+    ----------
+    store_dir : str
+        The folder the store is saved in
+    features : list, optional
+        The names of the features to store. The configured features (see
+        cbir_methods.get_configured_features) are stored by default, which
+        are the Intensity and Color-Code histograms unless more are asked
+        for
+    resolution : str
+        The resolution the images are decoded at, see
+        cbir_methods.parse_resolution. Features extracted at different
+        resolutions are never mixed in one store
+    """
+
+    def __init__(self, store_dir=DEFAULT_STORE_DIR, features=None,
+                 resolution=cbir_methods.FULL_RESOLUTION):
+        if features is None:
+            features = cbir_methods.get_configured_features()
+        cbir_methods.parse_resolution(resolution)
+        self.store_dir = store_dir
+        self.features = list(features)
+        self.resolution = resolution
+        self.dims = get_feature_dims(self.features)
+        # feature name -> memory-mapped matrix
+        self.matrices = dict()
+        self.entries = list()
+        self.rows = dict()
+        self.stats = None
+        # Goes up every time the store is saved, so results computed from
+        # an older version can be told apart
+        self.version = 0
+        self.load()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, path):
+        return path in self.rows
+
+    @property
+    def paths(self):
+        """
+        list : The image path of each row of the matrix
+        """
+
+        return [entry['path'] for entry in self.entries
+                if not entry.get('deleted')]
+
+    @property
+    def width(self):
+        """
+        int : The length of the combined feature vectors
+        """
+
+        return sum(self.dims[name] for name in self.features)
+
+    def matrix_path(self, name):
+        """
+        Returns the file path of a feature's matrix.
+
+        Parameters
+        ----------
+        name : str
+            The name of the feature
+
+        Returns
+        -------
+        str
+            The file path
+        """
+
+        return os.path.join(self.store_dir, MATRIX_FILE % name)
+
+    def live_rows(self):
+        """
+        Returns the rows of the matrix that hold an image, leaving out the
+        rows of removed images.
+
+        Returns
+        -------
+        numpy.ndarray
+            The row numbers, in the order of paths
+        """
+
+        return np.array([row for row, entry in enumerate(self.entries)
+                         if not entry.get('deleted')], dtype=np.int64)
+
+    def load(self):
+        """
+        Loads the store from disk. A store saved with different features
+        (or feature lengths) or at a different resolution is ignored and
+        will be rebuilt by the next sync.
+        """
+
+        index_path = os.path.join(self.store_dir, INDEX_FILE)
+        if not os.path.exists(index_path) or not all(
+                os.path.exists(self.matrix_path(name))
+                for name in self.features):
+            return
+
+        with open(index_path) as file:
+            index = json.load(file)
+        if index['features'] != [[name, self.dims[name]]
+                                 for name in self.features]:
+            return
+        if index.get('resolution', cbir_methods.FULL_RESOLUTION) != \
+                self.resolution:
+            return
+
+        self.version = index.get('version', 0)
+        self.entries = index['images']
+        self.rows = dict((entry['path'], row)
+                         for row, entry in enumerate(self.entries)
+                         if not entry.get('deleted'))
+        self.load_matrices()
+
+        stats_path = os.path.join(self.store_dir, STATS_FILE)
+        if os.path.exists(stats_path):
+            self.stats = RunningStats(self.width)
+            with np.load(stats_path) as data:
+                self.stats.count = int(data['count'])
+                self.stats.mean = data['mean']
+                self.stats.m2 = data['m2']
+        else:
+            self.compute_stats()
+
+    def load_matrices(self):
+        """
+        Memory-maps the matrix file of every feature. Only the rows the
+        index refers to are kept, the rest of a file is room to grow.
+        """
+
+        self.matrices = dict((name, np.load(self.matrix_path(name),
+                                            mmap_mode='r')[:len(self.entries)])
+                             for name in self.features)
+
+    def save(self):
+        """
+        Writes the index and the statistics to disk. Each file is replaced
+        atomically so a reader never sees a partial file. The matrix files
+        are written by update and compact before the index refers to their
+        rows.
+        """
+
+        self.version += 1
+        os.makedirs(self.store_dir, exist_ok=True)
+        index_path = os.path.join(self.store_dir, INDEX_FILE)
+        stats_path = os.path.join(self.store_dir, STATS_FILE)
+
+        # np.savez appends '.npz' to names that do not end with it
+        tmp_stats = stats_path + '.tmp.npz'
+        np.savez(tmp_stats, count=self.stats.count, mean=self.stats.mean,
+                 m2=self.stats.m2)
+        os.replace(tmp_stats, stats_path)
+
+        index = {
+            'features': [[name, self.dims[name]] for name in self.features],
+            'resolution': self.resolution,
+            'version': self.version,
+            'images': self.entries,
+        }
+        tmp_index = index_path + '.tmp'
+        with open(tmp_index, 'w') as file:
+            json.dump(index, file)
+        os.replace(tmp_index, index_path)
+
+    def columns(self, name):
+        """
+        Returns the columns of the combined feature vectors holding the
+        given feature.
+
+        Parameters
+        ----------
+        name : str
+            The name of the feature
+
+        Returns
+        -------
+        slice
+            The columns of the feature
+        """
+
+        start = 0
+        for feature in self.features:
+            if feature == name:
+                return slice(start, start + self.dims[name])
+            start += self.dims[feature]
+        raise KeyError(name)
+
+    def feature_matrix(self, name=None):
+        """
+        Returns the stored feature matrix.
+
+        Parameters
+        ----------
+        name : str, optional
+            Only return the matrix of this feature. This reads no other
+            feature. By default the matrices of every feature are copied
+            side by side, in the column order of the combined feature
+            vectors
+
+        Returns
+        -------
+        numpy.ndarray
+            The (images x features) matrix, one row per entry of paths
+        """
+
+        if name is None:
+            return np.hstack([self.feature_matrix(feature)
+                              for feature in self.features])
+        matrix = self.matrices.get(name)
+        if matrix is None:
+            return np.zeros((0, self.dims[name]))
+        if len(self.rows) != len(self.entries):
+            matrix = matrix[self.live_rows()]
+        return matrix
+
+    def get_rows(self, rows):
+        """
+        Returns the combined feature vectors of rows of the matrices.
+
+        Parameters
+        ----------
+        rows : list
+            The row numbers
+
+        Returns
+        -------
+        numpy.ndarray
+            A (rows x features) matrix
+        """
+
+        if not rows:
+            return np.zeros((0, self.width))
+        return np.hstack([np.asarray(self.matrices[name][rows])
+                          for name in self.features])
+
+    def compute_stats(self):
+        """
+        Computes the normalization statistics from scratch, reading the
+        matrices a block of rows at a time.
+        """
+
+        self.stats = RunningStats(self.width)
+        live = self.live_rows() if self.matrices else []
+        block = max(1, STATS_ELEMENTS // max(1, self.width))
+        for start in range(0, len(live), block):
+            self.stats.add(self.get_rows(list(live[start:start + block])))
+
+    def normalized_matrix(self, features=None):
+        """
+        Returns the Gaussian normalized feature matrix, using the running
+        mean and standard deviation of the stored images.
+
+        Parameters
+        ----------
+        features : list, optional
+            Only normalize these features, in this order. Every feature is
+            normalized by default
+
+        Returns
+        -------
+        numpy.ndarray
+            The (images x features) normalized matrix, one row per entry of
+            paths
+        """
+
+        if features is None:
+            features = self.features
+        columns = np.concatenate([np.arange(self.width)[self.columns(name)]
+                                  for name in features])
+        matrix = np.hstack([self.feature_matrix(name) for name in features])
+        return self.stats.normalize(matrix, columns)
+
+    def get(self, path, name=None):
+        """
+        Returns the stored feature vector of an image.
+
+        Parameters
+        ----------
+        path : str
+            The file path of the image
+        name : str, optional
+            Only return this feature
+
+        Returns
+        -------
+        numpy.ndarray
+            The feature vector of the image
+        """
+
+        row = self.rows[path]
+        if name is not None:
+            return self.matrices[name][row]
+        return np.concatenate([self.matrices[feature][row]
+                               for feature in self.features])
+
+    def is_current(self, path):
+        """
+        Checks if the store holds the features of the image as it is now on
+        disk.
+
+        Parameters
+        ----------
+        path : str
+            The file path of the image
+
+        Returns
+        -------
+        bool
+            True if the image is stored and unchanged
+        """
+
+        if path not in self.rows:
+            return False
+        mtime, size = get_file_key(path)
+        entry = self.entries[self.rows[path]]
+        return entry['mtime'] == mtime and entry['size'] == size
+
+    def update(self, results):
+        """
+        Writes extracted features into the store and saves it. The rows of
+        the images are appended to the matrix files, so only they are
+        written. Images already in the store leave their old row unused.
+
+        Parameters
+        ----------
+        results : iterable
+            The (entry, vector) pairs returned by extract_entry
+
+        Returns
+        -------
+        int
+            The number of images written
+        """
+
+        updates = collections.OrderedDict()
+        for entry, vector in results:
+            updates[entry['path']] = (entry, vector)
+        if not updates:
+            return 0
+
+        if self.stats is None:
+            self.stats = RunningStats(self.width)
+        old_rows = [self.rows[path] for path in updates if path in self.rows]
+        self.stats.remove(self.get_rows(old_rows))
+
+        start = len(self.entries)
+        for path, (entry, vector) in updates.items():
+            if path in self.rows:
+                row = self.rows[path]
+                self.entries[row] = dict(self.entries[row], deleted=True)
+            self.rows[path] = len(self.entries)
+            self.entries.append(entry)
+        vectors = np.array([vector for entry, vector in updates.values()])
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        for name in self.features:
+            matrix = grow_matrix_file(self.matrix_path(name),
+                                      len(self.entries), self.dims[name])
+            matrix[start:len(self.entries)] = vectors[:, self.columns(name)]
+            matrix.flush()
+            del matrix
+        self.stats.add(vectors)
+
+        self.save()
+        self.load_matrices()
+        return len(updates)
+
+    def remove(self, paths):
+        """
+        Removes images from the store. Their rows are left unused until
+        compact is called, so the matrix file is not rewritten.
+
+        Parameters
+        ----------
+        paths : list
+            The file paths of the images
+
+        Returns
+        -------
+        int
+            The number of images removed
+        """
+
+        rows = [self.rows.pop(path) for path in paths if path in self.rows]
+        if not rows:
+            return 0
+        self.stats.remove(self.get_rows(rows))
+        for row in rows:
+            self.entries[row] = dict(self.entries[row], deleted=True)
+        self.save()
+        return len(rows)
+
+    def compact(self):
+        """
+        Drops the rows of removed images and recomputes the normalization
+        statistics from scratch, clearing any rounding drift left by the
+        incremental updates.
+        """
+
+        if not self.matrices:
+            return
+        live = self.live_rows()
+        for name in self.features:
+            copy_matrix_file(self.matrix_path(name), self.matrices[name],
+                             live)
+        self.entries = [self.entries[row] for row in live]
+        self.rows = dict((entry['path'], row)
+                         for row, entry in enumerate(self.entries))
+        self.load_matrices()
+        self.compute_stats()
+        self.save()
+
+    def sync(self, paths, prune=False, batch_size=BATCH_SIZE):
+        """
+        Makes sure the store holds up to date features for the given images.
+        Only images that are new or whose modification time or size changed
+        are decoded. The store is saved if anything changed.
+
+        Parameters
+        ----------
+        paths : list
+            The file paths of the images
+        prune : bool
+            Also remove the stored images that are not in paths
+        batch_size : int
+            The number of images written into the store at a time
+
+        Returns
+        -------
+        int
+            The number of images that were decoded
+        """
+
+        if prune:
+            keep = set(paths)
+            self.remove([path for path in self.paths if path not in keep])
+        stale = (path for path in paths if not self.is_current(path))
+        results = (extract_entry(path, self.features, self.resolution)
+                   for path in stale)
+        return sum(self.update(batch)
+                   for batch in iter_batches(results, batch_size))
+
+
+def copy_matrix_file(matrix_path, matrix, rows, capacity=None):
+    """
+    Replaces a matrix file with a copy of some of the rows of a matrix. The
+    rows are copied a block at a time straight into the new file, so the
+    matrix is never held in memory, and the file is replaced atomically.
+
+    Parameters
+    ----------
+    matrix_path : str
+        The file path of the matrix
+    matrix : numpy.ndarray
+        The matrix copied from, usually memory-mapped from the same file
+    rows : numpy.ndarray
+        The rows copied, in order
+    capacity : int, optional
+        The number of rows of the new file, at least len(rows). Defaults to
+        len(rows)
+
+    Returns
+    -------
+    numpy.memmap
+        The new matrix, opened for writing
+    """
+
+    if capacity is None:
+        capacity = len(rows)
+    # open_memmap keeps the name as it is, unlike np.save
+    tmp_matrix = matrix_path + '.tmp.npy'
+    copy = np.lib.format.open_memmap(tmp_matrix, mode='w+', dtype=np.float64,
+                                     shape=(capacity, matrix.shape[1]))
+    for start in range(0, len(rows), COPY_ROWS):
+        copy[start:start + COPY_ROWS] = matrix[rows[start:start + COPY_ROWS]]
+    copy.flush()
+    del copy
+    os.replace(tmp_matrix, matrix_path)
+    return np.load(matrix_path, mmap_mode='r+')
+
+
+def grow_matrix_file(matrix_path, rows, dim):
+    """
+    Opens a matrix file for writing, making room for at least the given
+    number of rows. A missing file is created. A full file grows to
+    GROWTH_FACTOR times its rows in place: its header is rewritten with the
+    new shape and the file is extended, so the rows already in it are
+    neither copied nor changed. The file is only copied when the new
+    header does not fit in the space of the old one.
+
+    Parameters
+    ----------
+    matrix_path : str
+        The file path of the matrix
+    rows : int
+        The number of rows needed
+    dim : int
+        The number of columns
+
+    Returns
+    -------
+    numpy.memmap
+        The matrix of the whole file, opened for writing
+    """
+
+    if not os.path.exists(matrix_path):
+        return np.lib.format.open_memmap(matrix_path, mode='w+',
+                                         dtype=np.float64, shape=(rows, dim))
+
+    matrix = np.load(matrix_path, mmap_mode='r+')
+    if len(matrix) >= rows:
+        return matrix
+    capacity = max(rows, GROWTH_FACTOR * len(matrix))
+    offset = matrix.offset
+
+    header = repr({'descr': np.lib.format.dtype_to_descr(matrix.dtype),
+                   'fortran_order': False,
+                   'shape': (capacity, dim)}).encode('latin1')
+    with open(matrix_path, 'r+b') as file:
+        major, minor = np.lib.format.read_magic(file)
+        # The magic string and version, then the length of the header in 2
+        # bytes (version 1.0) or 4 bytes
+        start = file.tell() + (2 if major == 1 else 4)
+        space = offset - start
+        if len(header) + 1 <= space:
+            file.seek(start)
+            file.write(header + b' ' * (space - len(header) - 1) + b'\n')
+            file.truncate(offset + capacity * dim * matrix.itemsize)
+            del matrix
+            return np.load(matrix_path, mmap_mode='r+')
+    return copy_matrix_file(matrix_path, matrix, np.arange(len(matrix)),
+                            capacity)
+
+
+def iter_batches(items, batch_size):
+    """
+    Groups the items of an iterable into lists, without reading more than
+    one list ahead.
+
+    Parameters
+    ----------
+    items : iterable
+        The items to group
+    batch_size : int
+        The largest number of items in a list
+
+    Yields
+    ------
+    list
+        The next batch_size items (fewer for the last list)
+    """
+
+    batch = list()
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def extract_entry(path, features, resolution=cbir_methods.FULL_RESOLUTION):
+    """
+    Decodes an image and builds its feature store row.
+
+    Parameters
+    ----------
+    path : str
+        The file path of the image
+    features : list
+        The names of the features to compute
+    resolution : str
+        The resolution the image is decoded at
+
+    Returns
+    -------
+    tuple
+        The index entry of the image (path, mtime, size and number of
+        pixels) and its combined feature vector
+    """
+
+    mtime, size = get_file_key(path)
+    pixels, hists = cbir_methods.extract_features(path, features, resolution)
+    vector = np.concatenate([hists[name] / pixels for name in features])
+    entry = {'path': path, 'mtime': mtime, 'size': size,
+             'pixels': int(pixels)}
+    return entry, vector
+
+
+def get_feature_dims(features):
+    """
+    Returns the length of each feature's histogram, as declared when it was
+    registered.
+
+    Parameters
+    ----------
+    features : list
+        The names of the features
+
+    Returns
+    -------
+    dict
+        The length of each feature
+    """
+
+    return dict((name, cbir_methods.FEATURES[name].dim) for name in features)
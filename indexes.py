@@ -0,0 +1,1039 @@
+import abc
+import json
+import numpy as np
+import search
+
+
+class BruteForceIndex:
+    """
+    Exact index that scans every vector of the matrix for each query.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    paths : list
+        The image path of each row of the matrix
+    """
+
+    kind = 'brute'
+
+    def __init__(self, matrix, paths):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.paths = list(paths)
+
+    @classmethod
+    def build(cls, matrix, paths, **params):
+        """
+        Builds the index over the given feature matrix.
+
+        Parameters
+        ----------
+        matrix : numpy.ndarray
+            The (images x features) feature matrix
+        paths : list
+            The image path of each row of the matrix
+
+        Returns
+        -------
+        BruteForceIndex
+            The built index
+        """
+
+        return cls(matrix, paths)
+
+    def get_params(self):
+        """
+        Returns the parameters and arrays needed to save the index.
+
+        Returns
+        -------
+        tuple
+            A dict of parameters and a dict of arrays
+        """
+
+        return dict(), dict()
+
+    @classmethod
+    def from_params(cls, matrix, paths, params, arrays):
+        """
+        Recreates a saved index.
+
+        Parameters
+        ----------
+        matrix : numpy.ndarray
+            The (images x features) feature matrix
+        paths : list
+            The image path of each row of the matrix
+        params : dict
+            The parameters returned by get_params
+        arrays : dict
+            The arrays returned by get_params
+
+        Returns
+        -------
+        BruteForceIndex
+            The index
+        """
+
+        return cls(matrix, paths)
+
+    def candidates(self, vector):
+        """
+        Returns the rows that may be close to the query vector.
+
+        Parameters
+        ----------
+        vector : numpy.ndarray
+            The feature vector of the query
+
+        Returns
+        -------
+        numpy.ndarray
+            The row numbers of the candidates
+        """
+
+        return np.arange(len(self.matrix))
+
+    def query(self, vector, k=10, exclude=None, weight=None):
+        """
+        Finds the k images closest to the query vector. Every index takes
+        the same arguments. The candidates are chosen without the weights,
+        so an approximate index stays approximate under weights.
+
+        Parameters
+        ----------
+        vector : numpy.ndarray
+            The feature vector of the query
+        k : int
+            The number of results
+        exclude : str, optional
+            An image path to leave out of the results
+        weight : float or numpy.ndarray, optional
+            A single weight used for every feature, or one weight per
+            feature, of the weighted Manhattan Distance. The plain
+            Manhattan Distance is used by default
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        vector = np.asarray(vector, dtype=np.float64)
+        rows = self.candidates(vector)
+        if weight is None:
+            distances = search.l1_distances(self.matrix[rows], vector)
+        else:
+            distances = search.weighted_l1_distances(self.matrix[rows],
+                                                     vector, weight)
+        return search.top_k(distances, [self.paths[row] for row in rows],
+                            k, exclude)
+
+    def save(self, index_path):
+        """
+        Saves the index into a '.npz' file.
+
+        Parameters
+        ----------
+        index_path : str
+            The file path to save the index to
+        """
+
+        params, arrays = self.get_params()
+        meta = json.dumps({'kind': self.kind, 'params': params})
+        with open(index_path, 'wb') as file:
+            np.savez(file, matrix=self.matrix, paths=np.array(self.paths),
+                     meta=np.array(meta), **arrays)
+
+
+class L1LSHIndex(BruteForceIndex):
+    """
+    Approximate index using locality sensitive hashing for the Manhattan
+    Distance. Each hash projects the vector onto a random direction drawn
+    from a Cauchy distribution (which is 1-stable, so projected distances
+    follow the L1 distance) and cuts the line into buckets. A query only
+    computes the exact distance to the images sharing a bucket with it in
+    at least one of the hash tables.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    paths : list
+        The image path of each row of the matrix
+    projections : numpy.ndarray
+        The (tables x hashes x features) random projections
+    offsets : numpy.ndarray
+        The (tables x hashes) random bucket offsets
+    bucket_width : float
+        The width of each bucket
+    min_candidates : int
+        Falls back to scanning every image when a query finds fewer
+        candidates than this
+    """
+
+    kind = 'lsh'
+
+    def __init__(self, matrix, paths, projections, offsets, bucket_width,
+                 min_candidates=0):
+        super().__init__(matrix, paths)
+        self.projections = projections
+        self.offsets = offsets
+        self.bucket_width = bucket_width
+        self.min_candidates = min_candidates
+        self.tables = list()
+        codes = self.hash(self.matrix)
+        for table in range(len(projections)):
+            buckets = dict()
+            for row, key in enumerate(codes[table]):
+                buckets.setdefault(key.tobytes(), list()).append(row)
+            self.tables.append(dict((key, np.array(rows))
+                                    for key, rows in buckets.items()))
+
+    @classmethod
+    def build(cls, matrix, paths, num_tables=16, num_hashes=8,
+              bucket_width=None, min_candidates=0, seed=0):
+        """
+        Builds the index over the given feature matrix.
+
+        Parameters
+        ----------
+        matrix : numpy.ndarray
+            The (images x features) feature matrix
+        paths : list
+            The image path of each row of the matrix
+        num_tables : int
+            The number of hash tables. More tables raise the recall and
+            the number of candidates scanned
+        num_hashes : int
+            The number of hashes combined in each table. More hashes make
+            the buckets smaller
+        bucket_width : float, optional
+            The width of each bucket. Defaults to twice the median
+            distance between sampled pairs of images
+        min_candidates : int
+            Falls back to scanning every image when a query finds fewer
+            candidates than this
+        seed : int
+            The seed of the random projections
+
+        Returns
+        -------
+        L1LSHIndex
+            The built index
+        """
+
+        matrix = np.asarray(matrix, dtype=np.float64)
+        rng = np.random.default_rng(seed)
+        if bucket_width is None:
+            sample = rng.integers(0, len(matrix), size=(256, 2))
+            bucket_width = 2 * float(np.median(search.l1_distances(
+                matrix[sample[:, 0]], matrix[sample[:, 1]]))) or 1.0
+        projections = rng.standard_cauchy(
+            (num_tables, num_hashes, matrix.shape[1]))
+        offsets = rng.uniform(0, bucket_width, (num_tables, num_hashes))
+        return cls(matrix, paths, projections, offsets, bucket_width,
+                   min_candidates)
+
+    def get_params(self):
+        params = {'bucket_width': self.bucket_width,
+                  'min_candidates': self.min_candidates}
+        arrays = {'projections': self.projections, 'offsets': self.offsets}
+        return params, arrays
+
+    @classmethod
+    def from_params(cls, matrix, paths, params, arrays):
+        return cls(matrix, paths, arrays['projections'], arrays['offsets'],
+                   params['bucket_width'], params['min_candidates'])
+
+    def hash(self, vectors):
+        """
+        Computes the bucket of each vector in each hash table.
+
+        Parameters
+        ----------
+        vectors : numpy.ndarray
+            A (vectors x features) matrix
+
+        Returns
+        -------
+        numpy.ndarray
+            The (tables x vectors x hashes) bucket numbers
+        """
+
+        projected = np.einsum('thd,nd->tnh', self.projections, vectors)
+        projected += self.offsets[:, np.newaxis, :]
+        return np.floor(projected / self.bucket_width).astype(np.int64)
+
+    def candidates(self, vector):
+        codes = self.hash(vector[np.newaxis, :])
+        found = [table.get(codes[i, 0].tobytes())
+                 for i, table in enumerate(self.tables)]
+        found = [rows for rows in found if rows is not None]
+        rows = np.unique(np.concatenate(found)) if found else np.array([], int)
+        if len(rows) < self.min_candidates:
+            return np.arange(len(self.matrix))
+        return rows
+
+
+class WeightedBoxIndex(BruteForceIndex):
+    """
+    Exact index for the weighted Manhattan Distance that stays valid for any
+    non-negative weights, so it can be used for every relevance feedback
+    round. The images are grouped into clusters and the smallest and
+    largest value of each feature is kept for each cluster. The weighted
+    distance from the query to a cluster's box is a lower bound of the
+    distance to any image in it, so clusters are scanned from the closest
+    box and the scan stops once no remaining box can hold a top k image.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    paths : list
+        The image path of each row of the matrix
+    labels : numpy.ndarray
+        The cluster number of each row of the matrix
+    """
+
+    kind = 'box'
+
+    def __init__(self, matrix, paths, labels):
+        super().__init__(matrix, paths)
+        self.labels = np.asarray(labels)
+        self.members = list()
+        lows = list()
+        highs = list()
+        for cluster in np.unique(self.labels):
+            rows = np.flatnonzero(self.labels == cluster)
+            self.members.append(rows)
+            lows.append(self.matrix[rows].min(axis=0))
+            highs.append(self.matrix[rows].max(axis=0))
+        self.lows = np.array(lows).reshape(-1, self.matrix.shape[1])
+        self.highs = np.array(highs).reshape(-1, self.matrix.shape[1])
+        self.last_scanned = 0
+
+    @classmethod
+    def build(cls, matrix, paths, num_clusters=None, iterations=10, seed=0):
+        """
+        Builds the index over the given feature matrix, grouping the images
+        with k-means.
+
+        Parameters
+        ----------
+        matrix : numpy.ndarray
+            The (images x features) feature matrix
+        paths : list
+            The image path of each row of the matrix
+        num_clusters : int, optional
+            The number of clusters. Defaults to the square root of the
+            number of images
+        iterations : int
+            The number of k-means iterations
+        seed : int
+            The seed used to pick the initial cluster centers
+
+        Returns
+        -------
+        WeightedBoxIndex
+            The built index
+        """
+
+        matrix = np.asarray(matrix, dtype=np.float64)
+        if num_clusters is None:
+            num_clusters = max(1, int(np.sqrt(len(matrix))))
+        num_clusters = min(num_clusters, len(matrix))
+        rng = np.random.default_rng(seed)
+        centers = matrix[rng.choice(len(matrix), num_clusters, replace=False)]
+
+        labels = np.zeros(len(matrix), dtype=np.int64)
+        for _ in range(iterations):
+            labels = nearest_centers(matrix, centers)
+            for cluster in range(num_clusters):
+                rows = labels == cluster
+                if rows.any():
+                    centers[cluster] = matrix[rows].mean(axis=0)
+        return cls(matrix, paths, labels)
+
+    def get_params(self):
+        return dict(), {'labels': self.labels}
+
+    @classmethod
+    def from_params(cls, matrix, paths, params, arrays):
+        return cls(matrix, paths, arrays['labels'])
+
+    def query(self, vector, k=10, exclude=None, weight=None):
+        """
+        Finds the k images closest to the query vector under the weighted
+        Manhattan Distance. The result is the same as a brute-force scan.
+
+        Parameters
+        ----------
+        vector : numpy.ndarray
+            The feature vector of the query
+        k : int
+            The number of results. All images are returned if None
+        exclude : str, optional
+            An image path to leave out of the results
+        weight : float or numpy.ndarray, optional
+            A single weight used for every feature, or one non-negative
+            weight per feature. Defaults to 1
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        vector = np.asarray(vector, dtype=np.float64)
+        weight = np.asarray(1.0 if weight is None else weight,
+                            dtype=np.float64)
+        if weight.ndim == 0:
+            weight = np.full(self.matrix.shape[1], weight)
+
+        gaps = np.maximum(self.lows - vector, 0) + \
+               np.maximum(vector - self.highs, 0)
+        bounds = gaps @ weight
+        # Allows for rounding differences between the bound and the
+        # distances so a tie is never pruned
+        slack = 1e-9 * (1 + np.abs(bounds))
+
+        rows = list()
+        distances = list()
+        kth = np.inf
+        found = 0
+        for cluster in np.argsort(bounds, kind='stable'):
+            if bounds[cluster] - slack[cluster] > kth:
+                break
+            cluster_rows = self.members[cluster]
+            rows.append(cluster_rows)
+            distances.append(search.weighted_l1_distances(
+                self.matrix[cluster_rows], vector, weight))
+            found += len(cluster_rows)
+            # The (k+1)th distance, since the excluded image may be among
+            # the k closest
+            if k is not None and found > k:
+                kth = np.partition(np.concatenate(distances), k)[k]
+
+        rows = np.concatenate(rows)
+        self.last_scanned = len(rows)
+        return search.top_k(np.concatenate(distances),
+                            [self.paths[row] for row in rows], k, exclude)
+
+
+def nearest_centers(matrix, centers, chunk_size=4096):
+    """
+    Finds the closest center (by Euclidean distance) of each row.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    centers : numpy.ndarray
+        The (clusters x features) cluster centers
+    chunk_size : int
+        The number of rows compared at a time
+
+    Returns
+    -------
+    numpy.ndarray
+        The number of the closest center of each row
+    """
+
+    labels = np.empty(len(matrix), dtype=np.int64)
+    center_norms = (centers ** 2).sum(axis=1)
+    for start in range(0, len(matrix), chunk_size):
+        chunk = matrix[start:start + chunk_size]
+        distances = center_norms - 2 * chunk @ centers.T
+        labels[start:start + chunk_size] = distances.argmin(axis=1)
+    return labels
+
+
+# Rows of a compact matrix decoded and scored at a time
+DECODE_ROWS = 4096
+
+
+def float32_l1_distances(rows, query, weight):
+    """
+    Calculates the weighted Manhattan Distance between the query vector and
+    a block of float32 rows, in float32. Quicker than
+    search.weighted_l1_distances, but the rounding depends on the BLAS
+    library, so it is only used for approximate distances. The rows are
+    overwritten.
+
+    Parameters
+    ----------
+    rows : numpy.ndarray
+        A (rows x features) float32 block, which is changed
+    query : numpy.ndarray
+        The float32 feature vector of the query
+    weight : numpy.ndarray
+        The float32 weight of each feature
+
+    Returns
+    -------
+    numpy.ndarray
+        The float32 distance to each row
+    """
+
+    rows -= query
+    np.abs(rows, out=rows)
+    return rows @ weight
+
+
+class QuantizedIndex(BruteForceIndex, abc.ABC):
+    """
+    Exact index that scans a compact copy of the matrix, which is several
+    times smaller than the float matrix and so quicker to read. The scan
+    gives approximate distances. How far a row's approximate distance can
+    be from its exact one is bounded by how much its compact copy differs
+    from the original row, so only the rows whose bounds can reach the top
+    k are scored again with the float matrix. The results are the same as
+    a brute-force scan, including the order of ties.
+
+    The float matrix is only read for the rows scored again, so it can be
+    memory-mapped. Subclasses must implement encode, to create the compact
+    copy, and decode, to rebuild blocks of rows from it.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    paths : list
+        The image path of each row of the matrix
+    arrays : dict
+        The arrays of the compact copy, as returned by encode
+    rerank : int, optional
+        The number of closest approximate rows scored again. By default
+        every row that can be in the top k is scored again, which makes the
+        results exact. With 0 the approximate results are returned as they
+        are
+    """
+
+    kind = None
+
+    def __init__(self, matrix, paths, arrays, rerank=None):
+        # Not converted to float64, so a float32 or memory-mapped matrix is
+        # not copied
+        self.matrix = np.asarray(matrix)
+        self.paths = list(paths)
+        self.arrays = dict(arrays)
+        self.rerank = rerank
+        if 'residuals' not in self.arrays:
+            self.arrays['residuals'] = self.get_residuals()
+        self.last_scanned = 0
+        self.last_reranked = 0
+
+    @classmethod
+    def build(cls, matrix, paths, rerank=None, **params):
+        """
+        Builds the index over the given feature matrix.
+
+        Parameters
+        ----------
+        matrix : numpy.ndarray
+            The (images x features) feature matrix
+        paths : list
+            The image path of each row of the matrix
+        rerank : int, optional
+            The number of rows scored again, see QuantizedIndex
+        **params
+            The parameters of the subclass's encode method
+
+        Returns
+        -------
+        QuantizedIndex
+            The built index
+        """
+
+        matrix = np.asarray(matrix)
+        return cls(matrix, paths, cls.encode(matrix, **params), rerank)
+
+    @classmethod
+    @abc.abstractmethod
+    def encode(cls, matrix):
+        """
+        Creates the compact copy of a matrix.
+
+        Parameters
+        ----------
+        matrix : numpy.ndarray
+            The (images x features) feature matrix
+
+        Returns
+        -------
+        dict
+            The arrays of the compact copy
+        """
+
+    @abc.abstractmethod
+    def decode(self, start, stop):
+        """
+        Rebuilds rows of the matrix from the compact copy.
+
+        Parameters
+        ----------
+        start : int
+            The first row
+        stop : int
+            The row after the last one
+
+        Returns
+        -------
+        numpy.ndarray
+            The decoded rows, a new float32 (or float64) array
+        """
+
+    def get_params(self):
+        return {'rerank': self.rerank}, self.arrays
+
+    @classmethod
+    def from_params(cls, matrix, paths, params, arrays):
+        return cls(matrix, paths, arrays, params.get('rerank'))
+
+    @property
+    def nbytes(self):
+        """
+        int : The memory used by the compact copy, in bytes
+        """
+
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def get_residuals(self):
+        """
+        Computes how much each decoded row differs from the original one.
+
+        Returns
+        -------
+        numpy.ndarray
+            The sum of the absolute differences of each row
+        """
+
+        residuals = np.empty(len(self.matrix))
+        for start in range(0, len(self.matrix), DECODE_ROWS):
+            stop = min(start + DECODE_ROWS, len(self.matrix))
+            rows = np.asarray(self.matrix[start:stop], dtype=np.float64)
+            residuals[start:stop] = \
+                np.abs(rows - self.decode(start, stop)).sum(axis=1)
+        return residuals
+
+    def approximate(self, vector, weight):
+        """
+        Calculates the weighted Manhattan Distance between the query vector
+        and every decoded row. The distances are computed in float32, so
+        besides the residual of each row they can be off by a rounding
+        error, see query.
+
+        Parameters
+        ----------
+        vector : numpy.ndarray
+            The feature vector of the query
+        weight : numpy.ndarray
+            The weight of each feature
+
+        Returns
+        -------
+        numpy.ndarray
+            The approximate distance to each row
+        """
+
+        query = vector.astype(np.float32)
+        weight = weight.astype(np.float32)
+        distances = np.empty(len(self.matrix))
+        for start in range(0, len(self.matrix), DECODE_ROWS):
+            stop = min(start + DECODE_ROWS, len(self.matrix))
+            distances[start:stop] = float32_l1_distances(
+                self.decode(start, stop), query, weight)
+        return distances
+
+    def query(self, vector, k=10, exclude=None, weight=None):
+        """
+        Finds the k images closest to the query vector under the weighted
+        Manhattan Distance.
+
+        Parameters
+        ----------
+        vector : numpy.ndarray
+            The feature vector of the query
+        k : int
+            The number of results. All images are returned if None
+        exclude : str, optional
+            An image path to leave out of the results
+        weight : float or numpy.ndarray, optional
+            A single weight used for every feature, or one weight per
+            feature. Defaults to 1
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        vector = np.asarray(vector, dtype=np.float64)
+        weight = np.asarray(1.0 if weight is None else weight,
+                            dtype=np.float64)
+        if weight.ndim == 0:
+            weight = np.full(self.matrix.shape[1], weight)
+
+        approximate = self.approximate(vector, weight)
+        self.last_scanned = len(approximate)
+        if self.rerank == 0:
+            self.last_reranked = 0
+            return search.top_k(approximate, self.paths, k, exclude)
+
+        if k is None or k + 1 >= len(approximate):
+            rows = np.arange(len(approximate))
+        elif self.rerank is None:
+            # |approximate - exact| <= max(weight) * residual, plus the
+            # float32 rounding of the query and of each of the sums' terms.
+            # The (k+1)th largest possible distance is used, since the
+            # excluded image may be among the k closest
+            rounding = 2 * (len(vector) + 4) * np.finfo(np.float32).eps
+            query_error = np.abs(weight) @ \
+                np.abs(vector - vector.astype(np.float32))
+            errors = self.arrays['residuals'] * np.abs(weight).max() + \
+                rounding * approximate + query_error
+            kth = np.partition(approximate + errors, k)[k]
+            # Allows for rounding differences so a tie is never left out
+            slack = 1e-9 * (1 + abs(kth))
+            rows = np.flatnonzero(approximate - errors <= kth + slack)
+        else:
+            count = min(len(approximate), max(self.rerank, k + 1))
+            rows = np.sort(np.argpartition(approximate, count - 1)[:count])
+
+        self.last_reranked = len(rows)
+        distances = search.weighted_l1_distances(self.matrix[rows], vector,
+                                                 weight)
+        return search.top_k(distances, [self.paths[row] for row in rows],
+                            k, exclude)
+
+
+class Float16Index(QuantizedIndex):
+    """
+    Exact index scanning a float16 copy of the matrix, a quarter of the
+    size of the float64 matrix. See QuantizedIndex.
+    """
+
+    kind = 'float16'
+
+    @classmethod
+    def encode(cls, matrix):
+        codes = np.asarray(matrix).astype(np.float16)
+        if not np.isfinite(codes).all():
+            raise ValueError("The matrix has values too large for float16")
+        return {'codes': codes}
+
+    def decode(self, start, stop):
+        return self.arrays['codes'][start:stop].astype(np.float32)
+
+
+class Uint8Index(QuantizedIndex):
+    """
+    Exact index scanning a copy of the matrix quantized to one byte per
+    value, an eighth of the size of the float64 matrix. Each feature's
+    range of values is split into 255 equal steps. See QuantizedIndex.
+    """
+
+    kind = 'uint8'
+
+    @classmethod
+    def encode(cls, matrix):
+        low = np.asarray(matrix.min(axis=0), dtype=np.float32)
+        scale = ((np.asarray(matrix.max(axis=0), dtype=np.float64) - low) /
+                 255).astype(np.float32)
+        scale[scale == 0] = 1
+        codes = np.empty(matrix.shape, dtype=np.uint8)
+        for start in range(0, len(matrix), DECODE_ROWS):
+            rows = np.asarray(matrix[start:start + DECODE_ROWS],
+                              dtype=np.float64)
+            codes[start:start + DECODE_ROWS] = \
+                np.clip(np.rint((rows - low) / scale), 0, 255)
+        return {'codes': codes, 'low': low, 'scale': scale}
+
+    def decode(self, start, stop):
+        rows = np.multiply(self.arrays['codes'][start:stop],
+                           self.arrays['scale'], dtype=np.float32)
+        rows += self.arrays['low']
+        return rows
+
+
+class SparseIndex(QuantizedIndex):
+    """
+    Exact index scanning a sparse copy of the matrix. Most color-code bins
+    of an image are empty, so most values of those columns are the same
+    (0, or the normalized value of 0). A column where at least
+    1 - density of the values are the same is stored as that value plus
+    the row, column and value of each entry that differs from it, and
+    every other column is stored as float32. See QuantizedIndex.
+    """
+
+    kind = 'sparse'
+
+    @classmethod
+    def encode(cls, matrix, density=0.5):
+        fills = list()
+        sparse_cols = list()
+        for col in range(matrix.shape[1]):
+            values, counts = np.unique(matrix[:, col], return_counts=True)
+            if counts.max() >= (1 - density) * len(matrix):
+                fills.append(values[counts.argmax()])
+                sparse_cols.append(col)
+        sparse_cols = np.array(sparse_cols, dtype=np.int64)
+        dense_cols = np.setdiff1d(np.arange(matrix.shape[1]), sparse_cols)
+        fill = np.array(fills, dtype=np.float64)
+
+        dense = np.empty((len(matrix), len(dense_cols)), dtype=np.float32)
+        counts = list()
+        indices = list()
+        values = list()
+        for start in range(0, len(matrix), DECODE_ROWS):
+            rows = np.asarray(matrix[start:start + DECODE_ROWS])
+            dense[start:start + DECODE_ROWS] = rows[:, dense_cols]
+            sparse = rows[:, sparse_cols]
+            differs = sparse != fill
+            counts.append(differs.sum(axis=1))
+            indices.append(np.nonzero(differs)[1])
+            values.append(sparse[differs])
+        indptr = np.zeros(len(matrix) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.concatenate(counts))
+        index_type = np.uint8 if len(sparse_cols) <= 256 else np.uint16
+        return {'fill': fill, 'sparse_cols': sparse_cols,
+                'dense_cols': dense_cols, 'dense': dense, 'indptr': indptr,
+                'indices': np.concatenate(indices).astype(index_type),
+                'values': np.concatenate(values).astype(np.float32)}
+
+    def decode(self, start, stop):
+        arrays = self.arrays
+        rows = np.empty((stop - start, self.matrix.shape[1]))
+        rows[:, arrays['dense_cols']] = arrays['dense'][start:stop]
+        sparse = np.tile(arrays['fill'], (stop - start, 1))
+        indptr = arrays['indptr'][start:stop + 1]
+        row_nums = np.repeat(np.arange(stop - start), np.diff(indptr))
+        sparse[row_nums, arrays['indices'][indptr[0]:indptr[-1]]] = \
+            arrays['values'][indptr[0]:indptr[-1]]
+        rows[:, arrays['sparse_cols']] = sparse
+        return rows
+
+    def approximate(self, vector, weight):
+        arrays = self.arrays
+        dense_cols = arrays['dense_cols']
+        distances = np.zeros(len(self.matrix))
+        if len(dense_cols):
+            query = vector[dense_cols].astype(np.float32)
+            dense_weight = weight[dense_cols].astype(np.float32)
+            for start in range(0, len(self.matrix), DECODE_ROWS):
+                distances[start:start + DECODE_ROWS] = float32_l1_distances(
+                    arrays['dense'][start:start + DECODE_ROWS].copy(),
+                    query, dense_weight)
+
+        # Every sparse column adds the distance of its common value, and the
+        # entries that differ from it replace that part. There are few of
+        # them, so they are summed in float64
+        query = vector[arrays['sparse_cols']]
+        sparse_weight = weight[arrays['sparse_cols']]
+        base = sparse_weight * np.abs(arrays['fill'] - query)
+        distances += base.sum()
+        indptr = arrays['indptr']
+        for start in range(0, len(self.matrix), DECODE_ROWS):
+            stop = min(start + DECODE_ROWS, len(self.matrix))
+            first, last = indptr[start], indptr[stop]
+            if first == last:
+                continue
+            cols = arrays['indices'][first:last]
+            delta = sparse_weight[cols] * \
+                np.abs(arrays['values'][first:last] - query[cols]) - base[cols]
+            # Rows with no entries are left out, as reduceat would give
+            # them the next row's first entry
+            starts = indptr[start:stop]
+            filled = np.flatnonzero(np.diff(indptr[start:stop + 1]))
+            distances[start + filled] += \
+                np.add.reduceat(delta, starts[filled] - first)
+        return distances
+
+
+class ShardedIndex(BruteForceIndex):
+    """
+    Exact index that scans every vector of the matrix on several cores,
+    with a search.ShardedScan. The results are the same as a brute-force
+    scan, including the order of ties. Call close to stop the workers.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    paths : list
+        The image path of each row of the matrix
+    workers : int, optional
+        The number of threads or processes. Defaults to the number of CPUs
+    processes : bool
+        Use processes sharing the matrix instead of threads
+    """
+
+    kind = 'sharded'
+
+    def __init__(self, matrix, paths, workers=None, processes=False):
+        super().__init__(matrix, paths)
+        self.scan = search.ShardedScan(self.matrix, self.paths, workers,
+                                       processes)
+        self.last_scanned = 0
+
+    @classmethod
+    def build(cls, matrix, paths, workers=None, processes=False):
+        """
+        Builds the index over the given feature matrix.
+
+        Parameters
+        ----------
+        matrix : numpy.ndarray
+            The (images x features) feature matrix
+        paths : list
+            The image path of each row of the matrix
+        workers : int, optional
+            The number of threads or processes
+        processes : bool
+            Use processes instead of threads
+
+        Returns
+        -------
+        ShardedIndex
+            The built index
+        """
+
+        return cls(matrix, paths, workers, processes)
+
+    def get_params(self):
+        return {'workers': self.scan.workers,
+                'processes': self.scan.processes}, dict()
+
+    @classmethod
+    def from_params(cls, matrix, paths, params, arrays):
+        return cls(matrix, paths, **params)
+
+    def close(self):
+        """
+        Stops the workers of the scan.
+        """
+
+        self.scan.close()
+
+    def query(self, vector, k=10, exclude=None, weight=None):
+        """
+        Finds the k images closest to the query vector.
+
+        Parameters
+        ----------
+        vector : numpy.ndarray
+            The feature vector of the query
+        k : int
+            The number of results. All images are returned if None
+        exclude : str, optional
+            An image path to leave out of the results
+        weight : float or numpy.ndarray, optional
+            The weights of the weighted Manhattan Distance. The plain
+            Manhattan Distance is used if None
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        results = self.scan.query(vector, k, exclude, weight)
+        self.last_scanned = self.scan.last_scanned
+        return results
+
+
+# The available index backends, by kind
+INDEXES = {
+    BruteForceIndex.kind: BruteForceIndex,
+    L1LSHIndex.kind: L1LSHIndex,
+    WeightedBoxIndex.kind: WeightedBoxIndex,
+    Float16Index.kind: Float16Index,
+    Uint8Index.kind: Uint8Index,
+    SparseIndex.kind: SparseIndex,
+    ShardedIndex.kind: ShardedIndex,
+}
+
+
+def build_index(kind, matrix, paths, **params):
+    """
+    Builds an index of the given kind.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of index, one of the keys of INDEXES
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    paths : list
+        The image path of each row of the matrix
+    **params
+        The parameters of the index's build method
+
+    Returns
+    -------
+    BruteForceIndex
+        The built index
+    """
+
+    return INDEXES[kind].build(matrix, paths, **params)
+
+
+def load_index(index_path):
+    """
+    Loads an index saved with its save method.
+
+    Parameters
+    ----------
+    index_path : str
+        The file path of the saved index
+
+    Returns
+    -------
+    BruteForceIndex
+        The loaded index, of the kind it was saved as
+    """
+
+    with np.load(index_path) as data:
+        meta = json.loads(str(data['meta']))
+        arrays = dict((name, data[name]) for name in data.files
+                      if name not in ('matrix', 'paths', 'meta'))
+        matrix = data['matrix']
+        paths = data['paths'].tolist()
+    return INDEXES[meta['kind']].from_params(matrix, paths, meta['params'],
+                                             arrays)
+
+
+def recall_at_k(index, queries, k=10):
+    """
+    Measures how many of the exact k nearest images the index returns,
+    compared with a brute-force scan of the same matrix. Each query is a
+    row of the index and is left out of its own results.
+
+    Parameters
+    ----------
+    index : BruteForceIndex
+        The index to evaluate
+    queries : list
+        The image paths to query with
+    k : int
+        The number of results per query
+
+    Returns
+    -------
+    float
+        The fraction of the exact top k results found, between 0 and 1
+    """
+
+    exact = BruteForceIndex(index.matrix, index.paths)
+    rows = dict((path, row) for row, path in enumerate(index.paths))
+    found = 0
+    total = 0
+    for path in queries:
+        vector = index.matrix[rows[path]]
+        expected = set(p for d, p in exact.query(vector, k, exclude=path))
+        retrieved = set(p for d, p in index.query(vector, k, exclude=path))
+        found += len(expected & retrieved)
+        total += len(expected)
+    return found / total if total else 1.0
@@ -0,0 +1,329 @@
+import argparse
+import collections
+import concurrent.futures
+import functools
+import os
+import time
+from PIL import Image as img
+import cbir_methods
+import dedupe
+import feature_store
+import thumbnails
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff')
+# Raised for images that cannot be read. PIL raises SyntaxError for some
+# broken headers and DecompressionBombError for images too large to decode
+READ_ERRORS = (OSError, ValueError, SyntaxError, img.DecompressionBombError)
+
+
+def iter_images(root):
+    """
+    Yields the images anywhere under the given folder as they are found.
+    The entries of each folder are visited in sorted order.
+
+    Parameters
+    ----------
+    root : str
+        The folder to scan
+
+    Yields
+    ------
+    str
+        The file path of each image
+    """
+
+    with os.scandir(root) as scan:
+        entries = sorted(scan, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from iter_images(entry.path)
+        elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+            yield entry.path
+
+
+def find_images(root):
+    """
+    Lists the images anywhere under the given folder.
+
+    Parameters
+    ----------
+    root : str
+        The folder to scan
+
+    Returns
+    -------
+    list
+        The sorted file paths of the images
+    """
+
+    return sorted(iter_images(root))
+
+
+def try_extract_entry(path, features, resolution, thumbnail_dir=None):
+    """
+    Runs feature_store.extract_entry, returning None instead of raising if
+    the image cannot be read.
+
+    Parameters
+    ----------
+    path : str
+        The file path of the image
+    features : list
+        The names of the features to compute
+    resolution : str
+        The resolution the image is decoded at
+    thumbnail_dir : str, optional
+        Also creates the image's thumbnail in this thumbnail cache
+
+    Returns
+    -------
+    tuple or None
+        The (entry, vector) pair of the image, or None if it failed
+    """
+
+    try:
+        result = feature_store.extract_entry(path, features, resolution)
+    except READ_ERRORS:
+        return None
+    # The features are kept even if the thumbnail cannot be made, it is
+    # made again when it is first shown
+    if thumbnail_dir is not None:
+        try:
+            thumbnails.make_thumbnail(path, thumbnail_dir)
+        except READ_ERRORS:
+            print("Error, could not create the thumbnail of " + path)
+    return result
+
+
+def extract_chunk(paths, features, resolution, thumbnail_dir=None):
+    """
+    Runs try_extract_entry on each of the given images.
+
+    Parameters
+    ----------
+    paths : list
+        The file paths of the images
+    features : list
+        The names of the features to compute
+    resolution : str
+        The resolution the images are decoded at
+    thumbnail_dir : str, optional
+        Also creates the thumbnail of each image in this thumbnail cache
+
+    Returns
+    -------
+    list
+        The result of try_extract_entry for each image
+    """
+
+    return [try_extract_entry(path, features, resolution, thumbnail_dir)
+            for path in paths]
+
+
+def iter_stale(paths, store, counts):
+    """
+    Yields the images the store does not hold up to date features for.
+
+    Parameters
+    ----------
+    paths : iterable
+        The file paths of the images
+    store : feature_store.FeatureStore
+        The feature store
+    counts : dict
+        Its 'found' and 'unchanged' numbers are increased as images are
+        read
+
+    Yields
+    ------
+    str
+        The file path of each new or modified image
+    """
+
+    for path in paths:
+        counts['found'] += 1
+        if store.is_current(path):
+            counts['unchanged'] += 1
+        else:
+            yield path
+
+
+def iter_extracted(paths, extract, pool=None, chunk_size=16, max_pending=16):
+    """
+    Yields the features of each image, in the order of paths. With a pool,
+    chunks of images are extracted in parallel, but at most max_pending
+    chunks are sent ahead of the ones being read, so the paths and results
+    waiting in memory stay bounded.
+
+    Parameters
+    ----------
+    paths : iterable
+        The file paths of the images
+    extract : function
+        Takes a list of paths and returns the result for each of them, see
+        extract_chunk
+    pool : concurrent.futures.Executor, optional
+        Runs the extraction. It runs in this process if not given
+    chunk_size : int
+        The number of images sent to the pool at a time
+    max_pending : int
+        The most chunks sent to the pool and not read yet
+
+    Yields
+    ------
+    tuple
+        The file path of the image and the result of try_extract_entry
+    """
+
+    chunks = feature_store.iter_batches(paths, chunk_size)
+    if pool is None:
+        for chunk in chunks:
+            yield from zip(chunk, extract(chunk))
+        return
+
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append((chunk, pool.submit(extract, chunk)))
+        if len(pending) >= max_pending:
+            chunk, future = pending.popleft()
+            yield from zip(chunk, future.result())
+    while pending:
+        chunk, future = pending.popleft()
+        yield from zip(chunk, future.result())
+
+
+def write_batches(results, store, batch_size, counts):
+    """
+    Writes extracted features into the store a batch at a time, so an
+    interrupted run keeps its progress and only one batch is held in
+    memory. Each batch is appended to the store's matrix files (see
+    feature_store.FeatureStore.update), so the rows of earlier batches are
+    never written again.
+
+    Parameters
+    ----------
+    results : iterable
+        The (path, result) pairs yielded by iter_extracted
+    store : feature_store.FeatureStore
+        The store to write the features into
+    batch_size : int
+        The number of images written into the store at a time
+    counts : dict
+        Its 'ingested' and 'failed' numbers are increased as images are
+        written
+    """
+
+    def iter_entries():
+        for path, result in results:
+            if result is None:
+                print("Error, could not read " + path)
+                counts['failed'] += 1
+            else:
+                yield result
+
+    for batch in feature_store.iter_batches(iter_entries(), batch_size):
+        counts['ingested'] += store.update(batch)
+
+
+def ingest(root, store, workers=None, chunk_size=16, batch_size=10000,
+           thumbnail_dir=None):
+    """
+    Extracts the features of every new or modified image under the given
+    folder and writes them into the store. Runs as a pipeline of
+    generators (finding the images, skipping the unchanged ones, decoding
+    and extracting them across a pool of processes, writing batches), so
+    memory use does not grow with the number of images.
+
+    Parameters
+    ----------
+    root : str
+        The folder to scan
+    store : feature_store.FeatureStore
+        The store to write the features into
+    workers : int, optional
+        The number of processes. Defaults to the number of CPUs, 0 extracts
+        in this process
+    chunk_size : int
+        The number of images sent to a process at a time
+    batch_size : int
+        The number of images written into the store at a time, so an
+        interrupted run keeps its progress
+    thumbnail_dir : str, optional
+        Also creates the thumbnail of each ingested image in this thumbnail
+        cache
+
+    Returns
+    -------
+    dict
+        The number of images found, skipped as unchanged, ingested and
+        failed
+    """
+
+    counts = {'found': 0, 'unchanged': 0, 'ingested': 0, 'failed': 0}
+    extract = functools.partial(extract_chunk, features=store.features,
+                                resolution=store.resolution,
+                                thumbnail_dir=thumbnail_dir)
+    stale = iter_stale(iter_images(root), store, counts)
+
+    if workers == 0:
+        write_batches(iter_extracted(stale, extract, None, chunk_size),
+                      store, batch_size, counts)
+        return counts
+
+    # Keeps every process busy while the results are read in order
+    max_pending = 4 * (workers or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        write_batches(iter_extracted(stale, extract, pool, chunk_size,
+                                     max_pending),
+                      store, batch_size, counts)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extract the features of every image under a folder "
+                    "into the feature store.")
+    parser.add_argument('root', help="the folder to scan for images")
+    parser.add_argument('--store-dir', default=feature_store.DEFAULT_STORE_DIR,
+                        help="the folder of the feature store")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of processes (default: number of CPUs, "
+                             "0: extract in this process)")
+    parser.add_argument('--chunk-size', type=int, default=16,
+                        help="images sent to a process at a time")
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help="images written into the store at a time")
+    parser.add_argument('--features', type=cbir_methods.parse_features,
+                        help="comma-separated features to store (default: "
+                             "CBIR_FEATURES, or color_code,intensity)")
+    parser.add_argument('--resolution', default='full',
+                        help="extraction resolution: full, draft:2, draft:4, "
+                             "draft:8 or max_pixels:N")
+    parser.add_argument('--thumbnail-dir', default=thumbnails.DEFAULT_CACHE_DIR,
+                        help="the thumbnail cache to fill")
+    parser.add_argument('--no-thumbnails', action='store_true',
+                        help="do not create thumbnails")
+    parser.add_argument('--dedupe', action='store_true',
+                        help="then find the duplicates of the new images")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    store = feature_store.FeatureStore(args.store_dir, args.features,
+                                       args.resolution)
+    thumbnail_dir = None if args.no_thumbnails else args.thumbnail_dir
+    counts = ingest(args.root, store, args.workers, args.chunk_size,
+                    args.batch_size, thumbnail_dir)
+    elapsed = time.perf_counter() - start
+    print("Found {found} images: {ingested} ingested, {unchanged} unchanged, "
+          "{failed} failed".format(**counts))
+    print("Took {:.2f}s, store holds {} images".format(elapsed, len(store)))
+    if args.dedupe:
+        finder = dedupe.DuplicateFinder(args.store_dir)
+        counts = finder.update(store)
+        print("Checked {checked} images for duplicates: {linked} found, "
+              "{clusters} clusters in all".format(
+                  clusters=len(finder.clusters()), **counts))
+
+
+if __name__ == '__main__':
+    main()
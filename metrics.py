@@ -0,0 +1,320 @@
+import collections
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+# Metrics are only recorded when enabled, either by calling enable() or by
+# setting the CBIR_METRICS environment variable to 1. While disabled every
+# function below returns right away, so the instrumented code runs at full
+# speed.
+ENABLED = os.environ.get('CBIR_METRICS') == '1'
+
+_lock = threading.Lock()
+_counters = collections.defaultdict(float)
+# name -> [number of calls, total seconds, longest call in seconds]
+_timers = dict()
+
+
+def enable():
+    """
+    Starts recording metrics.
+    """
+
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    """
+    Stops recording metrics. The recorded values are kept.
+    """
+
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    """
+    Clears every recorded metric.
+    """
+
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def count(name, value=1):
+    """
+    Adds to a counter.
+
+    Parameters
+    ----------
+    name : str
+        The name of the counter, e.g. 'images_scanned'
+    value : int or float
+        The amount to add
+    """
+
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] += value
+
+
+def record_time(name, seconds):
+    """
+    Records one timed call of a pipeline stage.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage, e.g. 'decode'
+    seconds : float
+        The time the call took
+    """
+
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+
+class _Timer:
+    """
+    Times the code of a with block. See timer.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+# Used while disabled, does nothing
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def timer(name):
+    """
+    Times the code of a with block as one call of a pipeline stage:
+
+        with metrics.timer('distance'):
+            ...
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage
+
+    Returns
+    -------
+    context manager
+        The timer, or a context manager that does nothing while metrics
+        are disabled
+    """
+
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as a pipeline stage.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage
+
+    Returns
+    -------
+    function
+        The decorator
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """
+    Returns the recorded metrics. Besides the raw counters and timers, the
+    hit rate of every cache (counters ending in '_hits' and '_misses') and
+    the number of images scanned per query are computed.
+
+    Returns
+    -------
+    dict
+        'counters' maps each counter to its value, 'timers' maps each stage
+        to its number of calls, total, mean and longest time in seconds,
+        and 'rates' holds the computed rates
+    """
+
+    with _lock:
+        counters = dict(_counters)
+        timers = dict((name, {'count': calls, 'total': total,
+                              'mean': total / calls if calls else 0.0,
+                              'max': longest})
+                      for name, (calls, total, longest) in _timers.items())
+
+    rates = dict()
+    for name in counters:
+        if name.endswith('_hits'):
+            cache = name[:-len('_hits')]
+            lookups = counters[name] + counters.get(cache + '_misses', 0)
+            if lookups:
+                rates[cache + '_hit_rate'] = counters[name] / lookups
+    if counters.get('queries'):
+        rates['images_scanned_per_query'] = \
+            counters.get('images_scanned', 0) / counters['queries']
+    return {'counters': counters, 'timers': timers, 'rates': rates}
+
+
+def to_json(indent=2):
+    """
+    Exports the recorded metrics as JSON.
+
+    Parameters
+    ----------
+    indent : int
+        The indentation of the JSON text
+
+    Returns
+    -------
+    str
+        The JSON text of snapshot()
+    """
+
+    return json.dumps(snapshot(), indent=indent, sort_keys=True)
+
+
+def to_prometheus(prefix='cbir_'):
+    """
+    Exports the recorded metrics in the Prometheus text format. Counters
+    become '<prefix><name>_total', stages become a summary
+    '<prefix><name>_seconds' (count and sum) and a gauge of the longest
+    call, and rates become gauges.
+
+    Parameters
+    ----------
+    prefix : str
+        Added in front of every metric name
+
+    Returns
+    -------
+    str
+        The metrics, one per line
+    """
+
+    data = snapshot()
+    lines = list()
+    for name, value in sorted(data['counters'].items()):
+        metric = prefix + name + '_total'
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %r' % (metric, float(value)))
+    for name, timer in sorted(data['timers'].items()):
+        metric = prefix + name + '_seconds'
+        lines.append('# TYPE %s summary' % metric)
+        lines.append('%s_count %d' % (metric, timer['count']))
+        lines.append('%s_sum %r' % (metric, timer['total']))
+        lines.append('# TYPE %s_max gauge' % metric)
+        lines.append('%s_max %r' % (metric, timer['max']))
+    for name, value in sorted(data['rates'].items()):
+        metric = prefix + name
+        lines.append('# TYPE %s gauge' % metric)
+        lines.append('%s %r' % (metric, float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class ProfileCapture:
+    """
+    The cProfile statistics of the code run inside capture_profile.
+
+    Attributes
+    ----------
+    profile : cProfile.Profile
+        The raw profile, which can be saved with dump_stats
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def text(self, sort='cumulative', limit=30):
+        """
+        Formats the slowest functions of the profile.
+
+        Parameters
+        ----------
+        sort : str
+            The pstats sort key
+        limit : int
+            The number of functions listed
+
+        Returns
+        -------
+        str
+            The pstats report
+        """
+
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=output)
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+
+@contextlib.contextmanager
+def capture_profile(path=None):
+    """
+    Profiles the code of a with block with cProfile, e.g. a single query:
+
+        with metrics.capture_profile() as capture:
+            data.search(...)
+        print(capture.text())
+
+    Profiling does not depend on the metrics being enabled.
+
+    Parameters
+    ----------
+    path : str, optional
+        Also saves the raw profile to this file, for snakeviz or pstats
+
+    Yields
+    ------
+    ProfileCapture
+        The capture, filled in when the block ends
+    """
+
+    capture = ProfileCapture()
+    capture.profile.enable()
+    try:
+        yield capture
+    finally:
+        capture.profile.disable()
+        if path is not None:
+            capture.profile.dump_stats(path)
@@ -1,6 +1,11 @@
 import collections
+import os
 import numpy as np
 import pandas as pd
+import cbir_methods
+import indexes
+import metrics
+import search
 
 def get_img_num(img_path):
     """
@@ -17,34 +22,37 @@ def get_img_num(img_path):
         The image's number
     """
     
-    if len(img_path) == 12:
-        return int(img_path[7:8])
-    elif len(img_path) == 13:
-        return int(img_path[7:9])
-    else:
-        return int(img_path[7:10])
+    return int(os.path.splitext(os.path.basename(img_path))[0])
 
-def get_feature_matrix():
+def get_feature_matrix(color_path='colorCode.xlsx',
+                       intensity_path='intensity.xlsx'):
     """
     Creates the feature matrix for all images in the 'images/' folder.
     The histogram data used is the data in Professor Chen's excel sheets;
     'colorCode.xlsx' and 'intensity.xlsx'.
 
+    Parameters
+    ----------
+    color_path : str
+        The color-code histogram sheet
+    intensity_path : str
+        The intensity histogram sheet
+
     Returns
     -------
     pandas.DataFrame
         A Dataframe containing the feature data. The rows are the images
-        and the columns are the features. Has shape 100 x 89
+        and the columns are the features. Has shape (number of images) x 89
     """
     
-    color = pd.read_excel('colorCode.xlsx', header=None, index_col=0).T
-    intens = pd.read_excel('intensity.xlsx', header=None, index_col=0).T
+    color = pd.read_excel(color_path, header=None, index_col=0).T
+    intens = pd.read_excel(intensity_path, header=None, index_col=0).T
     
     color = color.to_dict(orient='list')
     intens = intens.to_dict(orient='list')
     combined = dict()
 
-    for i in range(1, 101, 1):
+    for i in color:
         color_img_size = color[i][0]
         intens_img_size = intens[i][0]
         color_features = list()
@@ -63,6 +71,40 @@ def get_feature_matrix():
     return df
 
 
+def compute_feature_matrix(img_dir='images/'):
+    """
+    Creates the feature matrix by extracting the features of the
+    "Intensity + Color-Code" method (cbir_methods.COMBINED_FEATURES)
+    directly from the images in the given folder. Each image is decoded
+    only once for all of its features. The images must be named
+    '{number}.jpg'.
+
+    Parameters
+    ----------
+    img_dir : str
+        The folder containing the images
+
+    Returns
+    -------
+    pandas.DataFrame
+        A Dataframe containing the feature data, in the same layout as
+        get_feature_matrix. The rows are the images and the columns are the
+        features.
+    """
+
+    combined = dict()
+    for img in os.listdir(img_dir):
+        if img == 'Thumbs.db':
+            continue
+        img_num = int(os.path.splitext(img)[0])
+        combined[img_num] = cbir_methods.get_combined_features(
+            os.path.join(img_dir, img), cbir_methods.COMBINED_FEATURES)
+
+    combined = collections.OrderedDict(sorted(combined.items()))
+    df = pd.DataFrame(combined).T.fillna(0)
+    return df
+
+
 def get_normalized_matrix(feature_matrix):
     """
     Creates the normalized matrix and saves it into a CSV file.
@@ -123,7 +165,40 @@ def calculate_weighted_dist(query, retrieved, weight):
 
 
 
-def calculate_distance(normalized_matrix, query_num, weight):
+def build_feedback_index(normalized_matrix, kind='box', **params):
+    """
+    Builds the index used to search the normalized matrix with the weights
+    of any relevance feedback round.
+
+    Parameters
+    ----------
+    normalized_matrix : pandas.DataFrame
+        The normalization matrix for all images
+    kind : str
+        The kind of index: 'box' (indexes.WeightedBoxIndex), 'float16',
+        'uint8' or 'sparse' to scan a compact copy of the matrix (see
+        indexes.QuantizedIndex), 'sharded' to scan the whole matrix on
+        several cores (see indexes.ShardedIndex) or 'brute' to scan it on
+        one. All of them give exact results but 'lsh'
+        (indexes.L1LSHIndex), which only scans the images its hash tables
+        pick
+    **params
+        The parameters of the index's build method
+
+    Returns
+    -------
+    indexes.BruteForceIndex
+        The index
+    """
+
+    paths = ['images/' + str(img_num) + '.jpg'
+             for img_num in normalized_matrix.columns]
+    return indexes.build_index(kind, normalized_matrix.T.to_numpy(), paths,
+                               **params)
+
+
+def calculate_distance(normalized_matrix, query_num, weight, index=None,
+                       k=None):
     """
     Calculates the weighted Manhattan Distance between the query image and all
     images in the database.
@@ -138,6 +213,12 @@ def calculate_distance(normalized_matrix, query_num, weight):
         The weight used in the distance calculation
         The original weight, 1/N is passed in as a float, whereas the
         normalized weights are passed in as a pandas.Series
+    index : indexes.BruteForceIndex, optional
+        An index built with build_feedback_index. When given with k, only
+        the part of the database that can hold the k closest images is
+        scanned
+    k : int, optional
+        The number of results. All images are returned by default
 
     Returns
     --------
@@ -147,72 +228,305 @@ def calculate_distance(normalized_matrix, query_num, weight):
         The list is sorted in ascending order based on distance.
     """
     
-    query_features = normalized_matrix[query_num]
-    results = list()
+    query_features = normalized_matrix[query_num].to_numpy()
+    return calculate_vector_distance(normalized_matrix, query_features,
+                                     weight, index, k)
 
-    for retrieved_num, retrieved_features in normalized_matrix.iteritems():
-        distance = calculate_weighted_dist(query_features,
-                                           retrieved_features, weight)
-        retrieved_path = 'images/' + str(retrieved_num) + '.jpg'
-        results.append((distance, retrieved_path))
-    return sorted(results)
 
+def calculate_vector_distance(normalized_matrix, query_features, weight,
+                              index=None, k=None):
+    """
+    Calculates the weighted Manhattan Distance between the normalized
+    features of a query and all images in the database. The query does not
+    have to be in the database.
 
+    Parameters
+    ----------
+    normalized_matrix : pandas.DataFrame
+        The normalization matrix for all images
+    query_features : numpy.ndarray
+        The normalized features of the query
+    weight : float or pandas.Series
+        The weight used in the distance calculation, see calculate_distance
+    index : indexes.BruteForceIndex, optional
+        An index built with build_feedback_index, see calculate_distance
+    k : int, optional
+        The number of results. All images are returned by default
+
+    Returns
+    --------
+    list
+        A sorted list of (distance, image path) tuples, in ascending order
+        of distance
+    """
+
+    metrics.count('queries')
+    if index is not None:
+        with metrics.timer('index_search'):
+            results = index.query(query_features, k, weight=weight)
+        metrics.count('images_scanned', getattr(index, 'last_scanned',
+                                                len(index.paths)))
+        return results
+
+    with metrics.timer('feature_lookup'):
+        matrix = normalized_matrix.T.to_numpy()
+    with metrics.timer('distance'):
+        distances = search.weighted_l1_distances(matrix, query_features,
+                                                 weight)
+    metrics.count('images_scanned', len(distances))
+
+    with metrics.timer('sort'):
+        results = list()
+        for distance, retrieved_num in zip(distances.tolist(),
+                                           normalized_matrix.columns):
+            retrieved_path = 'images/' + str(retrieved_num) + '.jpg'
+            results.append((distance, retrieved_path))
+        results = sorted(results)
+    return results if k is None else results[:k]
+
+
+
+class RelevantImages:
+    """
+    The set of relevant images chosen by the user. Keeps a running mean and
+    variance (Welford's method) of the normalized features of the images in
+    the set, so adding or removing one image does not recompute the
+    statistics from scratch.
 
-def calculate_updated_weight(relevant_imgs, normalized_matrix, query_num):
+    Parameters
+    ----------
+    normalized_matrix : pandas.DataFrame, optional
+        The normalization matrix for all images. It can be set later, but
+        must be set before an image is added
+    """
+
+    def __init__(self, normalized_matrix=None):
+        self.normalized_matrix = normalized_matrix
+        self.paths = set()
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, img_path):
+        return img_path in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def get_features(self, img_path):
+        """
+        Returns the normalized features of the given image.
+
+        Parameters
+        ----------
+        img_path : str
+            The image path, in the format 'images/{number}.jpg'
+
+        Returns
+        -------
+        numpy.ndarray
+            The normalized features of the image
+        """
+
+        if self.normalized_matrix is None:
+            raise ValueError("The normalization matrix has not been set")
+        img_num = get_img_num(img_path)
+        return self.normalized_matrix[img_num].to_numpy(dtype=np.float64)
+
+    def add(self, img_path):
+        """
+        Adds an image to the set and updates the statistics.
+
+        Parameters
+        ----------
+        img_path : str
+            The image path, in the format 'images/{number}.jpg'
+        """
+
+        if img_path in self.paths:
+            return
+        features = self.get_features(img_path)
+        if self.mean is None:
+            self.mean = np.zeros(len(features))
+            self.m2 = np.zeros(len(features))
+        self.paths.add(img_path)
+        self.count += 1
+        delta = features - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (features - self.mean)
+
+    def remove(self, img_path):
+        """
+        Removes an image from the set and updates the statistics. Raises a
+        KeyError if the image is not in the set.
+
+        Parameters
+        ----------
+        img_path : str
+            The image path, in the format 'images/{number}.jpg'
+        """
+
+        features = self.get_features(img_path)
+        self.paths.remove(img_path)
+        self.count -= 1
+        if self.count == 0:
+            self.mean[:] = 0
+            self.m2[:] = 0
+            return
+
+        old_mean = self.mean
+        self.mean = (old_mean * (self.count + 1) - features) / self.count
+        self.m2 -= (features - self.mean) * (features - old_mean)
+
+        # Features that are now equal across the set end up with a rounding
+        # residue instead of exactly 0, which the zero-std rule relies on
+        tol = 1e-12 * self.count * (1 + self.mean ** 2)
+        constant = self.m2 <= tol
+        self.m2[constant] = 0
+        self.mean[constant] = self.get_features(next(iter(self.paths)))[constant]
+
+    def discard(self, img_path):
+        """
+        Removes an image from the set if it is in it.
+
+        Parameters
+        ----------
+        img_path : str
+            The image path, in the format 'images/{number}.jpg'
+        """
+
+        if img_path in self.paths:
+            self.remove(img_path)
+
+    def std(self):
+        """
+        Returns the sample standard deviation of each feature, which is NaN
+        with fewer than 2 images.
+
+        Returns
+        -------
+        numpy.ndarray
+            The standard deviation of each feature
+        """
+
+        if self.count < 2:
+            return np.full(len(self.normalized_matrix.index), np.nan)
+        return np.sqrt(self.m2 / (self.count - 1))
+
+
+def calculate_feedback_weights(std, avg):
+    """
+    Computes the normalized feature weights from the statistics of the
+    relevant images.
+
+    Parameters
+    ----------
+    std : numpy.ndarray
+        The standard deviation of each feature over the relevant images
+    avg : numpy.ndarray
+        The average of each feature over the relevant images
+
+    Returns
+    -------
+    pandas.Series
+        The normalized weights
+    """
+
+    std = check_std(std, avg)
+    updated_weights = compute_new_weights(std)
+    return compute_normalized_weights(updated_weights)
+
+
+@metrics.timed('feedback_weights')
+def get_feedback_weights(relevant_imgs, normalized_matrix):
+    """
+    Computes the normalized feature weights from the relevant images.
+
+    Parameters
+    ----------
+    relevant_imgs : set or RelevantImages
+        Contains the image paths of each relevant image chosen by the user.
+        The running statistics are used when given a RelevantImages
+    normalized_matrix : pandas.DataFrame
+        The normalization matrix for all images
+
+    Returns
+    -------
+    pandas.Series
+        The normalized weights
+    """
+
+    if isinstance(relevant_imgs, RelevantImages):
+        std = relevant_imgs.std()
+        avg = relevant_imgs.mean
+    else:
+        img_nums = [get_img_num(img_path) for img_path in relevant_imgs]
+        rf_matrix = normalized_matrix[img_nums].T.to_numpy(dtype=np.float64)
+        std = rf_matrix.std(axis=0, ddof=1) if len(img_nums) > 1 \
+            else np.full(rf_matrix.shape[1], np.nan)
+        avg = rf_matrix.mean(axis=0)
+        # The mean of equal values can be off by a rounding error, which
+        # would give a tiny non-zero std instead of 0
+        std[rf_matrix.max(axis=0) == rf_matrix.min(axis=0)] = 0
+
+    return calculate_feedback_weights(std, avg)
+
+
+def calculate_updated_weight(relevant_imgs, normalized_matrix, query_num,
+                             index=None, k=None):
     """
     Calculates the normalized weights based on the relevant images and returns
     the new distances.
 
     Parameters
     ----------
-    relevant_imgs : set
-        Contains the image paths of each relevant image chosen by the user
+    relevant_imgs : set or RelevantImages
+        Contains the image paths of each relevant image chosen by the user.
+        The running statistics are used when given a RelevantImages
     normalized_matrix : pandas.DataFrame
         The normalization matrix for all images
     query_num : int
         The number of the query image (1-100) 
+    index : indexes.BruteForceIndex, optional
+        An index built with build_feedback_index, see calculate_distance
+    k : int, optional
+        The number of results. All images are returned by default
     """
     
-    rf_features = dict()
-    for img_path in relevant_imgs:
-        img_num = get_img_num(img_path)
-        img_features = normalized_matrix[img_num]
-        rf_features[img_num] = img_features
-    rf_matrix = pd.DataFrame(rf_features)
-    
-    std = rf_matrix.T.std()
-    avg = rf_matrix.T.mean()
-    std = check_std(std, avg)
-
-    updated_weights = compute_new_weights(std)
-    normalized_weights = compute_normalized_weights(updated_weights)
-
-    return calculate_distance(normalized_matrix, query_num, normalized_weights)
+    normalized_weights = get_feedback_weights(relevant_imgs, normalized_matrix)
+    return calculate_distance(normalized_matrix, query_num,
+                              normalized_weights, index, k)
 
 def check_std(std, avg):
     """
     Checks if any standard deviation values are 0 and updates them accordingly.
+    A zero standard deviation whose average is not 0 is replaced with half of
+    the smallest non-zero standard deviation. Since each replacement becomes
+    the new smallest value, the n-th replacement is 0.5^n times the smallest
+    non-zero value.
 
     Parameters
     ----------
-    std : pandas.Series
+    std : array-like
         The standard deviation values computed from relevant image features
-    avg : pandas.Series
+    avg : array-like
         The average values computed from relevant image features
 
     Returns
     --------
-    list
+    numpy.ndarray
         Contains the previous standard deviations and any updated ones
     """
     
-    std_vals = std.tolist()
-    avg_vals = avg.tolist()
-    for i in range(len(std_vals)):
-        if std_vals[i] == 0:
-            if avg_vals[i] != 0:
-                std_vals[i] = 0.5 * (min(filter(None, std_vals)))
+    std_vals = np.array(std, dtype=np.float64)
+    avg_vals = np.asarray(avg, dtype=np.float64)
+    to_update = np.flatnonzero((std_vals == 0) & (avg_vals != 0))
+    if len(to_update) > 0:
+        smallest = std_vals[std_vals != 0].min()
+        std_vals[to_update] = smallest * 0.5 ** np.arange(1, len(to_update) + 1)
     return std_vals
 
 def compute_new_weights(std):
@@ -222,18 +536,19 @@ def compute_new_weights(std):
 
     Parameters
     ----------
-    std : list
+    std : numpy.ndarray
         The updated standard deviation values
     
     Returns
     -------
-    list
+    numpy.ndarray
         The updated weights
     """
     
-    new_weights = list()
-    for i in range(len(std)):
-        new_weights.append((1 / std[i]) if std[i] != 0 else 0)
+    std = np.asarray(std, dtype=np.float64)
+    new_weights = np.zeros(len(std))
+    nonzero = std != 0
+    new_weights[nonzero] = 1 / std[nonzero]
     return new_weights
 
 def compute_normalized_weights(weights):
@@ -242,7 +557,7 @@ def compute_normalized_weights(weights):
 
     Parameters
     ----------
-    weights : list
+    weights : numpy.ndarray
         The updated weights
 
     Returns
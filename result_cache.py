@@ -0,0 +1,167 @@
+import collections
+import sys
+import threading
+import numpy as np
+import metrics
+
+
+def make_key(query, method, relevant_imgs=None):
+    """
+    Creates the cache key of a query.
+
+    Parameters
+    ----------
+    query : str
+        The image path of the query, or the content hash of an uploaded
+        image
+    method : str
+        The name of the retrieval method
+    relevant_imgs : iterable, optional
+        The image paths of the relevant images chosen by the user. Their
+        order does not matter
+
+    Returns
+    -------
+    tuple
+        The key
+    """
+
+    relevant = tuple(sorted(relevant_imgs)) if relevant_imgs else ()
+    return (query, method, relevant)
+
+
+class ResultCache:
+    """
+    Keeps the results of recent queries, so asking again for the same
+    results (a page turn, the same relevance feedback submitted twice)
+    does not search the database again. Only the image paths and distances
+    of the top k results are kept, and the least recently used results are
+    dropped once they take more than max_bytes.
+
+    Every result belongs to a version of the index its method searches.
+    When a lookup or an insert uses a different version for a method, the
+    cached results of that method are dropped. The other methods keep
+    theirs, since they search other data.
+
+    The cache is shared by every session of the process, so its methods
+    can be called from several threads.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The most memory used by the cached results
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        # method -> the version of the index its results were computed with
+        self.versions = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def check_version(self, method, version):
+        """
+        Drops the cached results of a method if the index it searches
+        changed since they were computed.
+
+        Parameters
+        ----------
+        method : str
+            The name of the retrieval method
+        version : object
+            The current version of the index the method searches
+        """
+
+        with self.lock:
+            if version == self.versions.get(method):
+                return
+            self.versions[method] = version
+            for key in [key for key in self.entries if key[1] == method]:
+                self.nbytes -= self.entries.pop(key)[3]
+
+    def clear(self):
+        """
+        Removes every cached result.
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def get(self, key, k=None, version=None):
+        """
+        Returns the cached results of a query, if enough of them are
+        cached.
+
+        Parameters
+        ----------
+        key : tuple
+            The key of the query, see make_key
+        k : int, optional
+            The number of results needed. All results are needed by default
+        version : object, optional
+            The current version of the index the query's method searches
+
+        Returns
+        -------
+        list or None
+            A sorted list of (distance, image path) tuples, or None if the
+            results are not cached
+        """
+
+        with self.lock:
+            self.check_version(key[1], version)
+            entry = self.entries.get(key)
+            # Results cached for a larger k (or all of them) also hold the
+            # first k results
+            if entry is None or not (entry[0] is None or
+                                     (k is not None and k <= entry[0])):
+                self.misses += 1
+                metrics.count('result_cache_misses')
+                return None
+            self.hits += 1
+            metrics.count('result_cache_hits')
+            self.entries.move_to_end(key)
+        cached_k, distances, paths, size = entry
+        results = list(zip(distances.tolist(), paths))
+        return results if k is None else results[:k]
+
+    def put(self, key, results, k=None, version=None):
+        """
+        Caches the results of a query.
+
+        Parameters
+        ----------
+        key : tuple
+            The key of the query, see make_key
+        results : list
+            The sorted (distance, image path) tuples
+        k : int, optional
+            The number of results that was asked for, None if all of them
+        version : object, optional
+            The version of the index the results were computed with, see
+            get
+        """
+
+        distances = np.array([distance for distance, path in results],
+                             dtype=np.float64)
+        paths = tuple(path for distance, path in results)
+        size = distances.nbytes + sys.getsizeof(paths) + \
+            sum(sys.getsizeof(path) for path in paths)
+        with self.lock:
+            self.check_version(key[1], version)
+            if size > self.max_bytes:
+                return
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[3]
+            self.entries[key] = (k, distances, paths, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted[3]
@@ -0,0 +1,667 @@
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import io
+import itertools
+import os
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import cbir_methods
+import metrics
+
+
+def l1_distances(matrix, query):
+    """
+    Calculates the Manhattan Distance between the query vector and every row
+    of the matrix.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    query : numpy.ndarray
+        The feature vector of the query image
+
+    Returns
+    -------
+    numpy.ndarray
+        The distance to each row of the matrix
+    """
+
+    return np.abs(matrix - query).sum(axis=1)
+
+
+# Most elements in the temporary arrays of one block of weighted_l1_distances,
+# small enough for them to stay in the CPU cache
+BLOCK_ELEMENTS = 1 << 16
+
+
+def weighted_l1_distances(matrix, queries, weight, block_size=64):
+    """
+    Calculates the weighted Manhattan Distance between one or more query
+    vectors and every row of the matrix, as |X - q| @ w. Each row is summed
+    on its own, so a row's distance does not depend on the other rows
+    scored with it.
+
+    The matrix is scored a block of rows at a time against a block of
+    queries, so the temporary arrays stay small enough to be cached and
+    each block of rows is read once for all the queries of a block.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    queries : numpy.ndarray
+        A single query vector of shape (features,), or a stack of query
+        vectors of shape (queries x features)
+    weight : float or numpy.ndarray
+        A single weight used for every feature, one weight per feature, or
+        a (queries x features) stack with the weights of each query
+    block_size : int
+        The most queries scored at a time when given a stack
+
+    Returns
+    -------
+    numpy.ndarray
+        The distances, of shape (images,) for a single query or
+        (queries x images) for a stack
+    """
+
+    # Converted a block at a time, so a compact (float32, float16 or
+    # memory-mapped) matrix is never copied whole
+    matrix = np.asarray(matrix)
+    queries = np.asarray(queries, dtype=np.float64)
+    weight = np.asarray(weight, dtype=np.float64)
+    if weight.ndim == 0:
+        weight = np.full(matrix.shape[1], weight)
+    if queries.ndim == 1:
+        return weighted_l1_distances(matrix, queries[np.newaxis, :],
+                                     weight, block_size)[0]
+    if weight.ndim == 1:
+        weight = weight[np.newaxis, :]
+
+    distances = np.empty((len(queries), len(matrix)))
+    for start in range(0, len(queries), block_size):
+        block = queries[start:start + block_size, np.newaxis, :]
+        block_weight = weight[start:start + block_size, np.newaxis, :] \
+            if len(weight) > 1 else weight[:, np.newaxis, :]
+        rows = max(1, BLOCK_ELEMENTS // (len(block) * max(1, matrix.shape[1])))
+        for row in range(0, len(matrix), rows):
+            # Row-major order makes each row's sum independent of the others
+            tile = np.ascontiguousarray(matrix[row:row + rows],
+                                        dtype=np.float64)
+            diff = np.abs(tile[np.newaxis, :, :] - block)
+            distances[start:start + block_size, row:row + rows] = \
+                (diff * block_weight).sum(axis=-1)
+    return distances
+
+
+def top_k(distances, paths, k=None, exclude=None):
+    """
+    Returns the k closest images. Only the candidates that can be in the
+    top k are sorted, so the result is the same as sorting every distance
+    and keeping the first k, including the order of ties.
+
+    Parameters
+    ----------
+    distances : numpy.ndarray
+        The distance of each image
+    paths : list
+        The image path of each distance
+    k : int, optional
+        The number of results. All images are returned by default
+    exclude : str, optional
+        An image path to leave out of the results, usually the query image
+
+    Returns
+    -------
+    list
+        A sorted list of tuples containing the k smallest distances. The
+        first value in each tuple is the distance. The second is the image
+        path.
+    """
+
+    distances = np.asarray(distances, dtype=np.float64)
+    keep = np.ones(len(distances), dtype=bool)
+    if exclude is not None and exclude in paths:
+        keep[paths.index(exclude)] = False
+    candidates = np.flatnonzero(keep)
+
+    if k is not None and k < len(candidates):
+        if k <= 0:
+            return list()
+        part = np.argpartition(distances[candidates], k - 1)[:k]
+        kth = distances[candidates[part]].max()
+        candidates = candidates[distances[candidates] <= kth]
+
+    result = sorted(zip(distances[candidates].tolist(),
+                        [paths[row] for row in candidates]))
+    return result if k is None else result[:k]
+
+
+def shard_bounds(count, shards):
+    """
+    Splits the rows of a matrix into contiguous shards of about the same
+    size.
+
+    Parameters
+    ----------
+    count : int
+        The number of rows
+    shards : int
+        The number of shards
+
+    Returns
+    -------
+    list
+        The (first row, row after the last) of each non-empty shard
+    """
+
+    edges = np.linspace(0, count, max(1, min(shards, count)) + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(edges, edges[1:])
+            if stop > start]
+
+
+def score_shard(matrix, paths, start, stop, vector, k=None, exclude=None,
+                weight=None):
+    """
+    Finds the k closest images in one shard of the matrix. The distances
+    are computed the same way as for the whole matrix, so each one is the
+    same as in a single-threaded scan.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    paths : list
+        The image path of each row of the matrix
+    start : int
+        The first row of the shard
+    stop : int
+        The row after the last row of the shard
+    vector : numpy.ndarray
+        The feature vector of the query
+    k : int, optional
+        The number of results. All images of the shard by default
+    exclude : str, optional
+        An image path to leave out of the results
+    weight : float or numpy.ndarray, optional
+        The weights of the weighted Manhattan Distance. The plain Manhattan
+        Distance is used if None
+
+    Returns
+    -------
+    list
+        A sorted list of (distance, image path) tuples
+    """
+
+    rows = matrix[start:stop]
+    if weight is None:
+        distances = l1_distances(rows, vector)
+    else:
+        distances = weighted_l1_distances(rows, vector, weight)
+    return top_k(distances, paths[start:stop], k, exclude)
+
+
+# The shared matrix and paths of a process of a ShardedScan
+_shared = dict()
+
+
+def attach_shared_matrix(name, shape, dtype, paths):
+    """
+    Opens the shared memory holding the matrix of a ShardedScan, in each of
+    its worker processes.
+
+    Parameters
+    ----------
+    name : str
+        The name of the shared memory block
+    shape : tuple
+        The shape of the matrix
+    dtype : str
+        The type of the matrix
+    paths : list
+        The image path of each row of the matrix
+    """
+
+    block = shared_memory.SharedMemory(name=name)
+    _shared['block'] = block
+    _shared['matrix'] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    _shared['paths'] = paths
+
+
+def score_shared_shard(start, stop, vector, k=None, exclude=None,
+                       weight=None):
+    """
+    Runs score_shard on the shared matrix, in a worker process.
+
+    Parameters
+    ----------
+    start, stop, vector, k, exclude, weight
+        See score_shard
+
+    Returns
+    -------
+    list
+        A sorted list of (distance, image path) tuples
+    """
+
+    return score_shard(_shared['matrix'], _shared['paths'], start, stop,
+                       vector, k, exclude, weight)
+
+
+class ShardedScan:
+    """
+    Exact brute-force search using several cores. The matrix is split into
+    contiguous shards, the shards are scored at the same time in a pool of
+    threads (NumPy releases the GIL while it computes) or of processes
+    sharing the matrix through shared memory, and the k closest images of
+    each shard are merged. Every distance is computed the same way as in a
+    single-threaded scan and ties are ordered by image path, so the
+    results are identical to it.
+
+    Call close (or use it in a with statement) to stop the workers.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) feature matrix
+    paths : list
+        The image path of each row of the matrix
+    workers : int, optional
+        The number of threads or processes. Defaults to the number of CPUs
+    processes : bool
+        Use processes instead of threads. The matrix is copied into shared
+        memory once, not for each query
+    shards : int, optional
+        The number of shards. Defaults to the number of workers
+    """
+
+    def __init__(self, matrix, paths, workers=None, processes=False,
+                 shards=None):
+        self.paths = list(paths)
+        self.workers = workers or os.cpu_count() or 1
+        self.bounds = shard_bounds(len(self.paths), shards or self.workers)
+        self.processes = processes
+        self.shared = None
+        self.last_scanned = 0
+        matrix = np.asarray(matrix)
+        if processes:
+            self.shared = shared_memory.SharedMemory(
+                create=True, size=max(1, matrix.nbytes))
+            self.matrix = np.ndarray(matrix.shape, dtype=matrix.dtype,
+                                     buffer=self.shared.buf)
+            self.matrix[:] = matrix
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, initializer=attach_shared_matrix,
+                initargs=(self.shared.name, matrix.shape, matrix.dtype.str,
+                          self.paths))
+        else:
+            self.matrix = matrix
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Stops the workers and frees the shared memory.
+        """
+
+        self.executor.shutdown()
+        if self.shared is not None:
+            # The array must go before the memory it points to
+            self.matrix = None
+            self.shared.close()
+            self.shared.unlink()
+            self.shared = None
+
+    def query(self, vector, k=None, exclude=None, weight=None):
+        """
+        Finds the k images closest to the query vector.
+
+        Parameters
+        ----------
+        vector : numpy.ndarray
+            The feature vector of the query
+        k : int, optional
+            The number of results. All images are returned by default
+        exclude : str, optional
+            An image path to leave out of the results
+        weight : float or numpy.ndarray, optional
+            The weights of the weighted Manhattan Distance, as in
+            weighted_l1_distances. The plain Manhattan Distance (as in
+            l1_distances) is used if None
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        vector = np.asarray(vector, dtype=np.float64)
+        if weight is not None:
+            weight = np.asarray(weight, dtype=np.float64)
+        if self.processes:
+            futures = [self.executor.submit(score_shared_shard, start, stop,
+                                            vector, k, exclude, weight)
+                       for start, stop in self.bounds]
+        else:
+            futures = [self.executor.submit(score_shard, self.matrix,
+                                            self.paths, start, stop, vector,
+                                            k, exclude, weight)
+                       for start, stop in self.bounds]
+        shards = [future.result() for future in futures]
+        self.last_scanned = len(self.paths)
+
+        # Each shard is sorted by (distance, path), so merging them sorts
+        # the whole result the same way
+        merged = heapq.merge(*shards)
+        return list(merged if k is None else itertools.islice(merged, k))
+
+
+class QueryEngine:
+    """
+    Answers queries on demand from the feature store, instead of looking
+    them up in the precomputed all-pairs JSON files.
+
+    Images outside of the database can be searched too (query by example).
+    Their features are extracted once and kept by content hash, so the
+    same image uploaded again is not decoded again. The store is never
+    changed by them.
+
+    Parameters
+    ----------
+    store : feature_store.FeatureStore, optional
+        The feature store to search. The default store is synced with
+        img_dir if none is given
+    img_dir : str
+        The folder containing the images
+    max_examples : int
+        The most query images whose features are kept
+    workers : int, optional
+        Scores each query on this many cores with a ShardedScan. The
+        results are the same. A single-threaded scan is used by default
+    processes : bool
+        Use processes instead of threads for the sharded scan
+    """
+
+    def __init__(self, store=None, img_dir='images/', max_examples=256,
+                 workers=None, processes=False):
+        if store is None:
+            store = cbir_methods.get_feature_store(img_dir)
+        self.store = store
+        self.max_examples = max_examples
+        self.workers = workers
+        self.processes = processes
+        # feature name -> (store version, ShardedScan)
+        self.scans = dict()
+        # ShardedScan -> number of queries using it. A scan replaced while
+        # in use is retired and closed once its last query is done
+        self.scan_users = dict()
+        self.retired = set()
+        self.examples = collections.OrderedDict()
+        self.example_hits = 0
+        self.example_misses = 0
+        # Uploaded images may be featurized from several threads
+        self.lock = threading.Lock()
+
+    def get_scan(self, name):
+        """
+        Returns the sharded scan of a stored feature, creating it again
+        when the store has changed. Must be called with the lock held.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stored feature
+
+        Returns
+        -------
+        ShardedScan
+            The sharded scan of the feature's matrix
+        """
+
+        version, scan = self.scans.get(name, (None, None))
+        if scan is None or version != self.store.version:
+            if scan is not None:
+                # Queries may still be running on the old scan
+                if self.scan_users.get(scan):
+                    self.retired.add(scan)
+                else:
+                    scan.close()
+            scan = ShardedScan(self.store.feature_matrix(name),
+                               self.store.paths, self.workers,
+                               self.processes)
+            self.scans[name] = (self.store.version, scan)
+        return scan
+
+    @contextlib.contextmanager
+    def using_scan(self, name):
+        """
+        Lends the sharded scan of a stored feature for a query. The scan is
+        not closed while it is lent, even if the store changes meanwhile:
+
+            with engine.using_scan(name) as scan:
+                scan.query(...)
+
+        Parameters
+        ----------
+        name : str
+            The name of the stored feature
+
+        Yields
+        ------
+        ShardedScan
+            The sharded scan of the feature's matrix
+        """
+
+        with self.lock:
+            scan = self.get_scan(name)
+            self.scan_users[scan] = self.scan_users.get(scan, 0) + 1
+        try:
+            yield scan
+        finally:
+            with self.lock:
+                self.scan_users[scan] -= 1
+                if not self.scan_users[scan]:
+                    del self.scan_users[scan]
+                    if scan in self.retired:
+                        self.retired.remove(scan)
+                        scan.close()
+
+    def close(self):
+        """
+        Stops the workers of the sharded scans.
+        """
+
+        with self.lock:
+            for version, scan in self.scans.values():
+                scan.close()
+            for scan in self.retired:
+                scan.close()
+            self.scans.clear()
+            self.retired.clear()
+
+    def query_vector(self, vector, feature, k=None, exclude=None):
+        """
+        Finds the images closest to the given feature vector.
+
+        Parameters
+        ----------
+        vector : numpy.ndarray
+            The feature vector of the query
+        feature : str or function
+            The name of the stored feature, or the CBIR method using it
+        k : int, optional
+            The number of results. All images are returned by default
+        exclude : str, optional
+            An image path to leave out of the results
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        name = cbir_methods.METHOD_FEATURES.get(feature, feature)
+        if self.workers:
+            with self.using_scan(name) as scan:
+                with metrics.timer('distance'):
+                    results = scan.query(vector, k, exclude)
+            metrics.count('queries')
+            metrics.count('images_scanned', len(scan.paths))
+            return results
+
+        with metrics.timer('feature_lookup'):
+            matrix = self.store.feature_matrix(name)
+        with metrics.timer('distance'):
+            distances = l1_distances(matrix, vector)
+        metrics.count('queries')
+        metrics.count('images_scanned', len(distances))
+        with metrics.timer('sort'):
+            return top_k(distances, self.store.paths, k, exclude)
+
+    def query(self, selected_img, feature, k=None):
+        """
+        Finds the images closest to the selected image, leaving out the
+        selected image itself.
+
+        Parameters
+        ----------
+        selected_img : str
+            The file path of the selected image
+        feature : str or function
+            The name of the stored feature, or the CBIR method using it
+        k : int, optional
+            The number of results. All images are returned by default
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples, the same as
+            cbir_methods.get_distance returns for the first k images
+        """
+
+        name = cbir_methods.METHOD_FEATURES.get(feature, feature)
+        if selected_img in self.store:
+            vector = self.store.get(selected_img, name)
+        else:
+            vector = cbir_methods.get_combined_features(
+                selected_img, [name], self.store.resolution)
+        return self.query_vector(vector, name, k, exclude=selected_img)
+
+    def featurize(self, source):
+        """
+        Returns the combined feature vector of a query image, with every
+        feature of the store. It is computed the first time an image with
+        this content is seen and then kept.
+
+        Parameters
+        ----------
+        source : str or bytes
+            The file path of the image, or its encoded content
+
+        Returns
+        -------
+        tuple
+            The content hash of the image and its read-only feature vector
+        """
+
+        if not isinstance(source, bytes):
+            with open(source, 'rb') as file:
+                source = file.read()
+        digest = hashlib.sha256(source).hexdigest()
+        with self.lock:
+            if digest in self.examples:
+                self.example_hits += 1
+                metrics.count('example_cache_hits')
+                self.examples.move_to_end(digest)
+                return digest, self.examples[digest]
+            self.example_misses += 1
+            metrics.count('example_cache_misses')
+
+        vector = cbir_methods.get_combined_features(
+            io.BytesIO(source), self.store.features, self.store.resolution)
+        vector.flags.writeable = False
+        with self.lock:
+            self.examples[digest] = vector
+            while len(self.examples) > self.max_examples:
+                self.examples.popitem(last=False)
+        return digest, vector
+
+    def example_vector(self, source, feature):
+        """
+        Returns one feature of a query image, as stored in the store.
+
+        Parameters
+        ----------
+        source : str or bytes
+            The file path of the image, or its encoded content
+        feature : str or function
+            The name of the stored feature, or the CBIR method using it
+
+        Returns
+        -------
+        numpy.ndarray
+            The feature vector, divided by the image size
+        """
+
+        name = cbir_methods.METHOD_FEATURES.get(feature, feature)
+        digest, vector = self.featurize(source)
+        return vector[self.store.columns(name)]
+
+    def normalized_example(self, source, features):
+        """
+        Returns the features of a query image normalized with the mean and
+        standard deviation of the stored images, the same way as the rows
+        of the normalization matrix.
+
+        Parameters
+        ----------
+        source : str or bytes
+            The file path of the image, or its encoded content
+        features : list
+            The names of the features to return, in order
+
+        Returns
+        -------
+        numpy.ndarray
+            The normalized feature vector
+        """
+
+        digest, vector = self.featurize(source)
+        normalized = self.store.stats.normalize(vector)
+        return np.concatenate([normalized[self.store.columns(name)]
+                               for name in features])
+
+    def query_example(self, source, feature, k=None):
+        """
+        Finds the images closest to a query image that does not have to be
+        in the database.
+
+        Parameters
+        ----------
+        source : str or bytes
+            The file path of the image, or its encoded content
+        feature : str or function
+            The name of the stored feature, or the CBIR method using it
+        k : int, optional
+            The number of results. All images are returned by default
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        name = cbir_methods.METHOD_FEATURES.get(feature, feature)
+        return self.query_vector(self.example_vector(source, name), name, k)
@@ -0,0 +1,695 @@
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import json
+import urllib.parse
+import numpy as np
+import data_layer
+import feature_format
+import metrics
+import relevance_feedback as rf
+import result_cache
+import search
+
+# Methods offered by the service. Every feature held by the feature store
+# (such as 'intensity' and 'color_code') searches the store, 'combined'
+# searches the normalization matrix (the "Intensity + Color-Code" method of
+# the UI)
+COMBINED = data_layer.COMBINED
+
+MAX_BODY_BYTES = 32 * 1024 * 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    """
+    An error in a request, answered with the given HTTP status.
+
+    Parameters
+    ----------
+    status : int
+        The HTTP status code
+    message : str
+        The error message sent back
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def score_batch(matrix, paths, queries):
+    """
+    Scores a batch of queries against the matrix in one distance
+    computation.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        The (images x features) matrix searched
+    paths : list
+        The image path of each row of the matrix
+    queries : list
+        The (vector, weight, k, exclude) of each query, see
+        QueryBatcher.submit
+
+    Returns
+    -------
+    list
+        The sorted (distance, image path) results of each query
+    """
+
+    vectors = np.array([query[0] for query in queries])
+    weights = np.array([query[1] for query in queries])
+    distances = search.weighted_l1_distances(matrix, vectors, weights)
+    return [search.top_k(row, paths, k, exclude)
+            for row, (vector, weight, k, exclude) in zip(distances, queries)]
+
+
+class QueryBatcher:
+    """
+    Collects the queries made against the same matrix within a short
+    window and scores them together, so concurrent requests share one pass
+    over the matrix instead of scanning it once each.
+
+    Parameters
+    ----------
+    window : float
+        How long the first query of a batch waits for others, in seconds
+    max_batch : int
+        The most queries in a batch. A full batch is scored right away
+    executor : concurrent.futures.Executor, optional
+        Runs the distance computations, so the event loop keeps accepting
+        requests meanwhile. The loop's default executor is used if not
+        given
+    """
+
+    def __init__(self, window=0.005, max_batch=64, executor=None):
+        self.window = window
+        self.max_batch = max_batch
+        self.executor = executor
+        self.pending = dict()
+        self.batches = 0
+        self.queries = 0
+
+    async def submit(self, key, matrix, paths, vector, weight, k=None,
+                     exclude=None):
+        """
+        Adds a query to the current batch of its matrix and waits for its
+        results.
+
+        Parameters
+        ----------
+        key : str
+            The name of the matrix. Queries with the same key are batched
+            together
+        matrix : numpy.ndarray
+            The (images x features) matrix searched, C-contiguous
+        paths : list
+            The image path of each row of the matrix
+        vector : numpy.ndarray
+            The feature vector of the query
+        weight : numpy.ndarray
+            The weight of each feature
+        k : int, optional
+            The number of results. All images are returned by default
+        exclude : str, optional
+            An image path to leave out of the results
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = {'matrix': matrix, 'paths': paths, 'queries': list(),
+                     'futures': list()}
+            self.pending[key] = batch
+            loop.call_later(self.window, self.flush, key, batch)
+        batch['queries'].append((vector, weight, k, exclude))
+        batch['futures'].append(future)
+        if len(batch['queries']) >= self.max_batch:
+            self.flush(key, batch)
+        return await future
+
+    def flush(self, key, batch):
+        """
+        Starts scoring the given batch, unless it already started.
+
+        Parameters
+        ----------
+        key : str
+            The name of the matrix of the batch
+        batch : dict
+            The batch
+        """
+
+        if self.pending.get(key) is not batch:
+            return
+        del self.pending[key]
+        self.batches += 1
+        self.queries += len(batch['queries'])
+        asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch):
+        """
+        Scores a batch and hands each query its results.
+
+        Parameters
+        ----------
+        batch : dict
+            The batch
+        """
+
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, score_batch, batch['matrix'], batch['paths'],
+                batch['queries'])
+        except Exception as error:
+            for future in batch['futures']:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for future, result in zip(batch['futures'], results):
+            if not future.done():
+                future.set_result(result)
+
+
+class QueryService:
+    """
+    The retrieval flows of the UI behind an HTTP/JSON interface: query by
+    image id, query by uploaded image and relevance feedback. Concurrent
+    queries are batched by a QueryBatcher and uploaded images are decoded
+    in a pool of threads. The searched data is loaded in a thread of its
+    own, so the event loop keeps serving other connections meanwhile.
+
+    Parameters
+    ----------
+    data : data_layer.DataLayer, optional
+        The data searched. The process-wide data layer is used if not given
+    window : float
+        The batching window, in seconds
+    max_batch : int
+        The most queries scored together
+    decode_workers : int, optional
+        The number of threads decoding uploaded images
+    """
+
+    def __init__(self, data=None, window=0.005, max_batch=64,
+                 decode_workers=None):
+        if data is None:
+            data = data_layer.get_data_layer()
+        self.data = data
+        self.batcher = QueryBatcher(window, max_batch)
+        self.decoder = concurrent.futures.ThreadPoolExecutor(decode_workers)
+        # A single thread, so a matrix asked for by several requests at
+        # once is loaded once
+        self.loader = concurrent.futures.ThreadPoolExecutor(1)
+        # method -> (index version, matrix, paths, rows)
+        self.matrices = dict()
+
+    async def load(self, function, *args):
+        """
+        Runs a function that may load data (sync the feature store, build
+        the normalization matrix) in the loader thread.
+
+        Parameters
+        ----------
+        function : function
+            The function
+        *args
+            Its arguments
+
+        Returns
+        -------
+        object
+            What the function returns
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.loader, function, *args)
+
+    def get_matrix(self, method):
+        """
+        Returns the matrix searched by the given method, loading it the
+        first time. Blocks while loading, so call it through load.
+
+        Parameters
+        ----------
+        method : str
+            A feature held by the feature store, or COMBINED
+
+        Returns
+        -------
+        tuple
+            The C-contiguous (images x features) matrix, the image path of
+            each row, and a dict mapping each path to its row
+        """
+
+        methods = self.data.engine.store.features + [COMBINED]
+        if method not in methods:
+            raise RequestError(400, "Unknown method " + repr(method) +
+                               ", expected one of " + ', '.join(methods))
+        version = self.data.index_version(method)
+        if method not in self.matrices or \
+                self.matrices[method][0] != version:
+            if method == COMBINED:
+                normalized_matrix = self.data.normalized_matrix
+                matrix = normalized_matrix.T.to_numpy(dtype=np.float64)
+                paths = ['images/' + str(img_num) + '.jpg'
+                         for img_num in normalized_matrix.columns]
+            else:
+                store = self.data.engine.store
+                matrix = store.feature_matrix(method)
+                paths = store.paths
+            rows = dict((path, row) for row, path in enumerate(paths))
+            self.matrices[method] = (version,
+                                     np.ascontiguousarray(matrix, np.float64),
+                                     paths, rows)
+        return self.matrices[method][1:]
+
+    def get_image_vector(self, img_path, matrix, rows):
+        """
+        Returns the stored feature vector of an image in the database.
+
+        Parameters
+        ----------
+        img_path : str
+            The image path, in the format 'images/{number}.jpg'
+        matrix : numpy.ndarray
+            The matrix searched, see get_matrix
+        rows : dict
+            Maps each image path to its row of the matrix
+
+        Returns
+        -------
+        numpy.ndarray
+            The feature vector
+        """
+
+        if img_path not in rows:
+            raise RequestError(404, "Unknown image " + repr(img_path))
+        return matrix[rows[img_path]]
+
+    async def query_image(self, img_path, method, k=None):
+        """
+        Finds the images closest to an image in the database. The Intensity
+        and Color-Code methods leave the query image out of the results,
+        the same as the UI.
+
+        Parameters
+        ----------
+        img_path : str
+            The image path, in the format 'images/{number}.jpg'
+        method : str
+            A feature held by the feature store, or COMBINED
+        k : int, optional
+            The number of results
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        matrix, paths, rows = await self.load(self.get_matrix, method)
+        vector = self.get_image_vector(img_path, matrix, rows)
+        if method == COMBINED:
+            weight = np.full(matrix.shape[1], 1 / matrix.shape[1])
+            return await self.batcher.submit(method, matrix, paths, vector,
+                                             weight, k)
+        return await self.batcher.submit(method, matrix, paths, vector,
+                                         np.ones(matrix.shape[1]), k,
+                                         img_path)
+
+    async def query_upload(self, data, method, k=None):
+        """
+        Finds the images closest to an uploaded image. The image is
+        featurized once in the decoding threads and its features are kept
+        by the query engine, keyed by content hash.
+
+        Parameters
+        ----------
+        data : bytes
+            The encoded image
+        method : str
+            A feature held by the feature store, or COMBINED
+        k : int, optional
+            The number of results
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        matrix, paths, rows = await self.load(self.get_matrix, method)
+        engine = self.data.engine
+        if method == COMBINED:
+            features = [name for name, dim in feature_format.COMBINED_FEATURES]
+            featurize = functools.partial(engine.normalized_example, data,
+                                          features)
+            weight = np.full(matrix.shape[1], 1 / matrix.shape[1])
+        else:
+            featurize = functools.partial(engine.example_vector, data, method)
+            weight = np.ones(matrix.shape[1])
+
+        loop = asyncio.get_running_loop()
+        try:
+            vector = await loop.run_in_executor(self.decoder, featurize)
+        except (OSError, ValueError):
+            raise RequestError(400, "Could not decode the uploaded image")
+        return await self.batcher.submit(method, matrix, paths, vector,
+                                         weight, k)
+
+    async def feedback(self, img_path, relevant, k=None):
+        """
+        Finds the images closest to an image in the database with the
+        "Intensity + Color-Code" method, weighted by the relevant images
+        chosen by the user.
+
+        Parameters
+        ----------
+        img_path : str
+            The image path, in the format 'images/{number}.jpg'
+        relevant : list
+            The image paths of the relevant images, none or at least two
+        k : int, optional
+            The number of results
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        matrix, paths, rows = await self.load(self.get_matrix, COMBINED)
+        vector = self.get_image_vector(img_path, matrix, rows)
+        if not relevant:
+            return await self.query_image(img_path, COMBINED, k)
+        unknown = [path for path in relevant if path not in rows]
+        if unknown:
+            raise RequestError(404, "Unknown image " + repr(unknown[0]))
+        # The weights come from the standard deviation of the relevant
+        # images, which needs at least two of them
+        if len(set(relevant)) < 2:
+            raise RequestError(400, "Relevance feedback needs at least two "
+                                    "relevant images")
+
+        def get_weight():
+            normalized_matrix = self.data.normalized_matrix
+            relevant_imgs = rf.RelevantImages(normalized_matrix)
+            for path in relevant:
+                relevant_imgs.add(path)
+            return rf.get_feedback_weights(relevant_imgs, normalized_matrix)
+
+        weight = await self.load(get_weight)
+        return await self.batcher.submit(COMBINED, matrix, paths, vector,
+                                         weight.to_numpy(dtype=np.float64), k)
+
+    async def cached(self, query, method, relevant, k, compute):
+        """
+        Returns the results of a query from the data layer's result cache,
+        or computes and caches them.
+
+        Parameters
+        ----------
+        query : str
+            The image path of the query, or the content hash of an
+            uploaded image
+        method : str
+            A feature held by the feature store, or COMBINED
+        relevant : list
+            The image paths of the relevant images
+        k : int or None
+            The number of results
+        compute : function
+            Returns a coroutine computing the results
+
+        Returns
+        -------
+        list
+            A sorted list of (distance, image path) tuples
+        """
+
+        cache = self.data.results
+        key = result_cache.make_key(query, method, relevant)
+        version = await self.load(self.data.index_version, method)
+        results = cache.get(key, k, version)
+        if results is None:
+            results = await compute()
+            cache.put(key, results, k, version)
+        return results
+
+    async def route(self, method, target, body):
+        """
+        Answers a request.
+
+        Parameters
+        ----------
+        method : str
+            The HTTP method
+        target : str
+            The request path and query string
+        body : bytes
+            The request body
+
+        Returns
+        -------
+        dict or str
+            The JSON response, or the Prometheus text of /metrics
+        """
+
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        if url.path == '/metrics':
+            return metrics.to_prometheus()
+        if url.path == '/metrics.json':
+            return metrics.snapshot()
+        if url.path == '/stats':
+            return {'batches': self.batcher.batches,
+                    'queries': self.batcher.queries,
+                    'cache_hits': self.data.results.hits,
+                    'cache_misses': self.data.results.misses}
+        if url.path not in ('/query', '/query/upload', '/feedback'):
+            raise RequestError(404, "Unknown path " + repr(url.path))
+        if method != 'POST':
+            raise RequestError(405, "Use POST for " + url.path)
+
+        if url.path == '/query/upload':
+            k = get_k(params.get('k'))
+            query_method = params.get('method', 'intensity')
+            results = await self.cached(
+                hashlib.sha256(body).hexdigest(), query_method, None, k,
+                lambda: self.query_upload(body, query_method, k))
+            return {'results': results}
+
+        try:
+            request = json.loads(body.decode('utf-8') or '{}')
+        except ValueError:
+            raise RequestError(400, "The body is not valid JSON")
+        if not isinstance(request, dict):
+            raise RequestError(400, "The body must be a JSON object")
+        img_path = get_request_image(request)
+        k = get_k(request.get('k'))
+        if url.path == '/query':
+            query_method = request.get('method', COMBINED)
+            results = await self.cached(
+                img_path, query_method, None, k,
+                lambda: self.query_image(img_path, query_method, k))
+        else:
+            relevant = request.get('relevant', list())
+            if not isinstance(relevant, list):
+                raise RequestError(400, "'relevant' must be a list")
+            relevant = [get_request_image({'image': path})
+                        for path in relevant]
+            results = await self.cached(
+                img_path, COMBINED, relevant, k,
+                lambda: self.feedback(img_path, relevant, k))
+        return {'results': results}
+
+    async def handle(self, reader, writer):
+        """
+        Serves the HTTP requests of one connection.
+
+        Parameters
+        ----------
+        reader : asyncio.StreamReader
+            The connection's reader
+        writer : asyncio.StreamWriter
+            The connection's writer
+        """
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, sep, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    method, target, version = \
+                        request_line.decode('latin-1').split()
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY_BYTES:
+                        raise RequestError(413, "The body is too large")
+                    body = await reader.readexactly(length)
+                    status, response = 200, await self.route(method, target,
+                                                             body)
+                except RequestError as error:
+                    status, response = error.status, {'error': str(error)}
+                except ValueError:
+                    status, response = 400, {'error': "Malformed request"}
+                except Exception as error:
+                    status, response = 500, {'error': str(error)}
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def get_request_image(request):
+    """
+    Reads the query image of a request, given either as an 'image' path or
+    as an image number 'id'.
+
+    Parameters
+    ----------
+    request : dict
+        The JSON request
+
+    Returns
+    -------
+    str
+        The image path, in the format 'images/{number}.jpg'
+    """
+
+    if 'image' in request and isinstance(request['image'], str):
+        return request['image']
+    if 'id' in request and isinstance(request['id'], int):
+        return 'images/' + str(request['id']) + '.jpg'
+    raise RequestError(400, "Give the query image as 'image' or 'id'")
+
+
+def get_k(value):
+    """
+    Reads the number of results of a request.
+
+    Parameters
+    ----------
+    value : object
+        The requested number of results, or None for all of them
+
+    Returns
+    -------
+    int or None
+        The number of results
+    """
+
+    if value is None:
+        return None
+    try:
+        k = int(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, "'k' must be an integer")
+    if k < 0:
+        raise RequestError(400, "'k' must not be negative")
+    return k
+
+
+def write_response(writer, status, response, keep_alive=True):
+    """
+    Writes a JSON response, or a plain text one for the metrics.
+
+    Parameters
+    ----------
+    writer : asyncio.StreamWriter
+        The connection's writer
+    status : int
+        The HTTP status code
+    response : dict or str
+        The JSON response, or the text of a plain text response
+    keep_alive : bool
+        Whether the connection stays open for more requests
+    """
+
+    if isinstance(response, str):
+        body = response.encode('utf-8')
+        content_type = 'text/plain; version=0.0.4'
+    else:
+        body = json.dumps(response).encode('utf-8')
+        content_type = 'application/json'
+    head = ('HTTP/1.1 %d %s\r\n'
+            'Content-Type: %s\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: %s\r\n\r\n'
+            % (status, REASONS.get(status, ''), content_type, len(body),
+               'keep-alive' if keep_alive else 'close'))
+    writer.write(head.encode('latin-1') + body)
+
+
+async def serve(host='127.0.0.1', port=8080, window=0.005, max_batch=64):
+    """
+    Runs the query service until it is cancelled.
+
+    Parameters
+    ----------
+    host : str
+        The address to listen on
+    port : int
+        The port to listen on
+    window : float
+        The batching window, in seconds
+    max_batch : int
+        The most queries scored together
+    """
+
+    service = QueryService(window=window, max_batch=max_batch)
+    server = await asyncio.start_server(service.handle, host, port)
+    print("Serving on http://%s:%d" % (host, port))
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve image queries over HTTP/JSON.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--window-ms', type=float, default=5,
+                        help="how long a query waits for others to batch "
+                             "with, in milliseconds")
+    parser.add_argument('--max-batch', type=int, default=64,
+                        help="the most queries scored together")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, args.window_ms / 1000,
+                          args.max_batch))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
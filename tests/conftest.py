@@ -0,0 +1,32 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The methods read the bundled images from 'images/'
+os.chdir(ROOT)
+
+import feature_store
+
+
+@pytest.fixture(scope='session')
+def image_paths():
+    return sorted(feature_store.get_image_paths('images/'))
+
+
+@pytest.fixture(scope='session')
+def store(tmp_path_factory, image_paths):
+    store = feature_store.FeatureStore(str(tmp_path_factory.mktemp('store')))
+    store.sync(image_paths)
+    return store
+
+
+@pytest.fixture(scope='session')
+def tied_matrix(store):
+    # Every image twice, rounded so that many distances tie
+    matrix = np.round(store.feature_matrix('color_code'), 2)
+    matrix = np.vstack([matrix, matrix])
+    paths = ['images/%d.jpg' % row for row in range(len(matrix))]
+    return matrix, paths
@@ -0,0 +1,46 @@
+import shutil
+import pytest
+from PIL import Image
+import batch_search
+import data_layer
+import search
+
+
+@pytest.fixture(scope='module')
+def data(store):
+    return data_layer.DataLayer(engine=search.QueryEngine(store))
+
+
+@pytest.mark.parametrize('method', ['intensity', 'color_code',
+                                    data_layer.COMBINED])
+def test_batch_matches_single_queries(data, image_paths, method):
+    queries = image_paths[:5]
+    results = list(batch_search.search_batch(data, queries, method, 10,
+                                             block_size=2))
+    assert [query for query, found in results] == queries
+    for query, found in results:
+        assert found == data.search(query, method, 10)
+
+
+def test_unreadable_queries_are_skipped(data, image_paths, tmp_path,
+                                        monkeypatch, capsys):
+    broken = tmp_path / 'broken.jpg'
+    broken.write_bytes(b'not an image')
+    # A copy outside the database is decoded, which fails once the size
+    # limit is lowered
+    bomb = tmp_path / 'bomb.jpg'
+    shutil.copy(image_paths[0], bomb)
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 100)
+
+    queries = [str(broken), str(bomb), image_paths[1]]
+    results = list(batch_search.search_batch(data, queries, 'intensity', 10))
+    assert [query for query, found in results] == [image_paths[1]]
+    assert capsys.readouterr().err.count("Error, could not read") == 2
+
+
+@pytest.mark.parametrize('option', [['-k', '0'], ['--block-size', '0']])
+def test_sizes_below_one_are_rejected(image_paths, option, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        batch_search.main([image_paths[0]] + option)
+    assert exit_info.value.code == 2
+    assert "must be at least 1" in capsys.readouterr().err
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from PIL import Image
+import cbir_methods
+
+# Query images checked against the slow references
+QUERIES = ['images/1.jpg', 'images/37.jpg']
+
+
+@pytest.mark.parametrize('path', QUERIES)
+def test_histograms_match_reference(path):
+    size, hist = cbir_methods.calculate_intensity(path)
+    ref_size, ref_hist = cbir_methods.calculate_intensity_reference(path)
+    assert size == ref_size
+    assert np.array_equal(hist, ref_hist)
+
+    size, hist = cbir_methods.calculate_color_code(path)
+    ref_size, ref_hist = cbir_methods.calculate_color_code_reference(path)
+    assert size == ref_size
+    assert np.array_equal(hist, ref_hist)
+
+
+def color_code_counts_reference(img_path):
+    # The stored color-code feature counts the 64 codes directly instead of
+    # binning them like calculate_color_code_reference
+    pixels = np.asarray(Image.open(img_path).convert('RGB')).reshape(-1, 3)
+    codes = [((r >> 6) << 4) | ((g >> 6) << 2) | (b >> 6)
+             for r, g, b in pixels.tolist()]
+    return (len(codes), np.bincount(codes, minlength=64))
+
+
+@pytest.mark.parametrize('method, reference', [
+    (cbir_methods.calculate_intensity, cbir_methods.calculate_intensity),
+    (cbir_methods.calculate_color_code, color_code_counts_reference)])
+def test_get_distance_matches_reference(store, method, reference):
+    query = QUERIES[0]
+    result = cbir_methods.get_distance(query, method, store)
+    expected = cbir_methods.get_distance_reference(query, reference)
+    assert [path for distance, path in result] == \
+        [path for distance, path in expected]
+    assert np.allclose([distance for distance, path in result],
+                       [distance for distance, path in expected],
+                       rtol=0, atol=1e-12)
+
+
+def test_intensity_bins_of_every_color():
+    values = np.arange(1 << 24, dtype=np.uint32)
+    pixels = np.stack([values >> 16, (values >> 8) & 255, values & 255],
+                      axis=1).astype(np.uint8)
+    rgb = pixels.astype(np.float64)
+    intensities = (.299*rgb[:, 0]) + (.587*rgb[:, 1]) + (.114*rgb[:, 2])
+    expected = np.searchsorted(cbir_methods.INTENSITY_BINS, intensities,
+                               side='right') - 1
+    expected = np.minimum(expected, len(cbir_methods.INTENSITY_BINS) - 2)
+    assert np.array_equal(cbir_methods.get_intensity_bins(pixels), expected)
+
+
+def test_strips_add_up_to_the_whole_image():
+    path = QUERIES[0]
+    size, hists = cbir_methods.extract_features(path)
+    pixels = cbir_methods.get_pixels(path)
+    assert size == pixels.shape[0] * pixels.shape[1]
+    whole = cbir_methods.PixelStrip(pixels)
+    for name, feature in cbir_methods.FEATURES.items():
+        assert np.array_equal(hists[name], feature.extractor(whole))
@@ -0,0 +1,36 @@
+import numpy as np
+import data_layer
+import feature_store
+import relevance_feedback as rf
+import search
+
+FEATURES = ['color_code', 'intensity']
+
+
+def test_combined_matrix_follows_the_store(tmp_path, image_paths):
+    store = feature_store.FeatureStore(str(tmp_path), FEATURES)
+    store.sync(image_paths[:50])
+    data = data_layer.DataLayer(engine=search.QueryEngine(store))
+    query = image_paths[0]
+
+    results = data.search(query, data_layer.COMBINED)
+    assert len(results) == 50
+    assert set(path for distance, path in results) <= set(image_paths[:50])
+    matrix = store.feature_matrix()
+    std = matrix.std(axis=0, ddof=1)
+    expected = np.where(std == 0, 0, (matrix - matrix.mean(axis=0)) /
+                        np.where(std == 0, 1, std))
+    assert np.allclose(data.normalized_matrix.T.to_numpy(), expected)
+
+    # Images added to the store are searched too, with the new statistics
+    store.sync(image_paths)
+    results = data.search(query, data_layer.COMBINED)
+    assert len(results) == len(image_paths)
+    normalized_matrix = data.normalized_matrix
+    assert sorted(normalized_matrix.columns) == \
+        sorted(rf.get_img_num(path) for path in image_paths)
+    assert results == rf.calculate_distance(
+        normalized_matrix, rf.get_img_num(query),
+        1 / len(normalized_matrix.index))
+    assert data.feedback_index.paths == \
+        ['images/%d.jpg' % num for num in normalized_matrix.columns]
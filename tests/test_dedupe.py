@@ -0,0 +1,78 @@
+import itertools
+import os
+import shutil
+import pytest
+from PIL import Image
+import cbir_methods
+import dedupe
+import feature_store
+
+FEATURES = ['color_code', 'intensity']
+
+
+@pytest.fixture
+def image_dir(tmp_path, image_paths):
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    for path in image_paths[:20]:
+        shutil.copy(path, image_dir)
+    # An exact copy and a smaller copy of two of the images
+    shutil.copy(image_paths[0], image_dir / 'copy.jpg')
+    with Image.open(image_paths[1]) as image:
+        image.resize((image.width // 2, image.height // 2)).save(
+            image_dir / 'small.jpg')
+    return str(image_dir)
+
+
+def brute_force_clusters(store, threshold):
+    parents = dict()
+    linked = set()
+    matrix = store.feature_matrix()
+    for first, second in itertools.combinations(range(len(store)), 2):
+        distance = cbir_methods.calculate_manhattan((1, matrix[first]),
+                                                    (1, matrix[second]))
+        if distance <= threshold:
+            dedupe.union(parents, store.paths[first], store.paths[second])
+            linked.update([store.paths[first], store.paths[second]])
+    clusters = dict()
+    for path in linked:
+        clusters.setdefault(dedupe.find(parents, path), list()).append(path)
+    return sorted((sorted(paths) for paths in clusters.values()),
+                  key=lambda paths: (-len(paths), paths))
+
+
+def test_clusters_match_brute_force(tmp_path, image_dir):
+    store = feature_store.FeatureStore(str(tmp_path / 'store'), FEATURES)
+    store.sync(feature_store.get_image_paths(image_dir))
+    finder = dedupe.DuplicateFinder(store.store_dir, FEATURES)
+    counts = finder.update(store)
+    assert counts['checked'] == len(store)
+
+    clusters = finder.clusters()
+    assert clusters == brute_force_clusters(store, finder.params['threshold'])
+    members = set(path for cluster in clusters for path in cluster)
+    for name in ['copy.jpg', 'small.jpg']:
+        assert os.path.join(image_dir, name) in members
+    for first, second, distance in finder.links:
+        assert distance <= finder.params['threshold']
+
+
+def test_update_only_checks_new_images(tmp_path, image_dir):
+    paths = sorted(feature_store.get_image_paths(image_dir))
+    copy_path = os.path.join(image_dir, 'copy.jpg')
+    store = feature_store.FeatureStore(str(tmp_path / 'store'), FEATURES)
+    store.sync([path for path in paths if path != copy_path])
+    finder = dedupe.DuplicateFinder(store.store_dir, FEATURES)
+    finder.update(store)
+    assert finder.update(store)['checked'] == 0
+
+    store.sync(paths)
+    reloaded = dedupe.DuplicateFinder(store.store_dir, FEATURES)
+    assert len(reloaded) == len(paths) - 1
+    assert reloaded.update(store)['checked'] == 1
+    assert any(copy_path in cluster for cluster in reloaded.clusters())
+
+    store.remove([copy_path])
+    reloaded.update(store)
+    assert copy_path not in reloaded.paths
+    assert all(copy_path not in cluster for cluster in reloaded.clusters())
@@ -0,0 +1,90 @@
+import os
+import numpy as np
+import pytest
+import cbir_methods
+import feature_store
+
+FEATURES = ['color_code', 'intensity']
+
+
+def by_path(store):
+    return dict(zip(store.paths, store.feature_matrix()))
+
+
+def test_statistics_after_update_and_remove(tmp_path, image_paths):
+    store = feature_store.FeatureStore(str(tmp_path), FEATURES)
+    store.sync(image_paths[:60])
+    store.sync(image_paths)
+    store.remove(image_paths[::4])
+
+    expected = feature_store.RunningStats(store.width)
+    expected.add(store.feature_matrix())
+    assert store.stats.count == expected.count
+    assert np.allclose(store.stats.mean, expected.mean, rtol=0, atol=1e-15)
+    # Removing rows leaves a rounding error where the deviation is zero
+    assert np.allclose(store.stats.std(), expected.std(), rtol=1e-9,
+                       atol=1e-9)
+
+
+def test_update_appends_in_place(tmp_path, image_paths):
+    store = feature_store.FeatureStore(str(tmp_path), FEATURES)
+    store.sync(image_paths[:10])
+    matrix_path = store.matrix_path('intensity')
+    inode = os.stat(matrix_path).st_ino
+    first_rows = np.array(store.feature_matrix('intensity'))
+
+    for end in range(20, len(image_paths) + 10, 10):
+        store.sync(image_paths[:end])
+    assert os.stat(matrix_path).st_ino == inode
+    assert np.array_equal(store.feature_matrix('intensity')[:10],
+                          first_rows)
+
+    # A modified image moves to a new row, its old row is left unused
+    mtime = os.stat(image_paths[3]).st_mtime_ns
+    os.utime(image_paths[3], ns=(mtime + 1000, mtime + 1000))
+    try:
+        assert store.sync(image_paths) == 1
+    finally:
+        os.utime(image_paths[3], ns=(mtime, mtime))
+    assert np.array_equal(store.matrices['intensity'][:10], first_rows)
+
+    fresh = feature_store.FeatureStore(str(tmp_path / 'fresh'), FEATURES)
+    fresh.sync(image_paths)
+    reloaded = feature_store.FeatureStore(str(tmp_path), FEATURES)
+    assert len(reloaded) == len(image_paths)
+    expected = by_path(fresh)
+    for path, vector in by_path(reloaded).items():
+        assert np.array_equal(vector, expected[path])
+
+
+def test_compact(tmp_path, image_paths):
+    store = feature_store.FeatureStore(str(tmp_path), FEATURES)
+    store.sync(image_paths)
+    store.remove(image_paths[::4])
+    kept = by_path(store)
+    expected = feature_store.RunningStats(store.width)
+    expected.add(store.feature_matrix())
+
+    store.compact()
+    reloaded = feature_store.FeatureStore(str(tmp_path), FEATURES)
+    assert reloaded.paths == [path for path in image_paths
+                              if path not in image_paths[::4]]
+    assert len(reloaded.entries) == len(reloaded.paths)
+    for path, vector in by_path(reloaded).items():
+        assert np.array_equal(vector, kept[path])
+    assert np.allclose(reloaded.stats.mean, expected.mean, rtol=0,
+                       atol=1e-15)
+
+
+def test_extra_features_are_opt_in(tmp_path, monkeypatch):
+    monkeypatch.delenv('CBIR_FEATURES', raising=False)
+    store = feature_store.FeatureStore(str(tmp_path / 'default'))
+    assert store.features == cbir_methods.DEFAULT_FEATURES
+
+    monkeypatch.setenv('CBIR_FEATURES', 'color_code, intensity,hsv')
+    store = feature_store.FeatureStore(str(tmp_path / 'configured'))
+    assert store.features == ['color_code', 'intensity', 'hsv']
+
+    monkeypatch.setenv('CBIR_FEATURES', 'color_code,texture')
+    with pytest.raises(ValueError):
+        feature_store.FeatureStore(str(tmp_path / 'unknown'))
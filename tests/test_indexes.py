@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+import indexes
+import relevance_feedback as rf
+import search
+
+
+@pytest.fixture(scope='module')
+def normalized_matrix(store):
+    normalized = store.normalized_matrix(['color_code', 'intensity'])
+    return pd.DataFrame(normalized.T,
+                        columns=[rf.get_img_num(path) for path in store.paths])
+
+
+def test_lsh_returns_exact_distances(tied_matrix):
+    matrix, paths = tied_matrix
+    index = indexes.build_index('lsh', matrix, paths)
+    for row in [0, 3, 150]:
+        distances = dict(zip(paths, search.l1_distances(matrix, matrix[row])
+                             .tolist()))
+        results = index.query(matrix[row], 10, paths[row])
+        assert results == sorted(results)
+        assert all(distance == distances[path] for distance, path in results)
+        assert paths[row] not in [path for distance, path in results]
+
+
+def test_lsh_scanning_every_image_matches_brute_force(tied_matrix):
+    matrix, paths = tied_matrix
+    index = indexes.build_index('lsh', matrix, paths,
+                                min_candidates=len(matrix) + 1)
+    exact = indexes.build_index('brute', matrix, paths)
+    weight = np.linspace(0.5, 2, matrix.shape[1])
+    for row in [0, 3, 150]:
+        assert index.query(matrix[row], 10, paths[row]) == \
+            exact.query(matrix[row], 10, paths[row])
+        assert index.query(matrix[row], 10, paths[row], weight) == \
+            exact.query(matrix[row], 10, paths[row], weight)
+    assert indexes.recall_at_k(index, paths[:20]) == 1.0
+
+
+@pytest.mark.parametrize('kind', ['brute', 'lsh'])
+def test_feedback_index_takes_weights(normalized_matrix, kind):
+    index = rf.build_feedback_index(normalized_matrix, kind)
+    weight = pd.Series(np.linspace(0.5, 2, len(normalized_matrix.index)))
+    query_num = normalized_matrix.columns[0]
+    results = rf.calculate_distance(normalized_matrix, query_num, weight,
+                                    index, 10)
+    expected = rf.calculate_distance(normalized_matrix, query_num, weight)
+    if kind == 'brute':
+        assert results == expected[:10]
+    else:
+        # Only the candidates are scored, each with its exact distance
+        assert set(results) <= set(expected)
+
+
+@pytest.mark.parametrize('k', [1, 10, 50, None])
+def test_box_index_matches_brute_force(tied_matrix, k):
+    matrix, paths = tied_matrix
+    index = indexes.build_index('box', matrix, paths, num_clusters=12)
+    for weight in [None, np.linspace(0, 2, matrix.shape[1])]:
+        for row in [0, 3, 150]:
+            distances = search.weighted_l1_distances(
+                matrix, matrix[row], 1.0 if weight is None else weight)
+            assert index.query(matrix[row], k, paths[row], weight) == \
+                search.top_k(distances, paths, k, paths[row])
+
+
+def test_box_feedback_index_matches_scan(normalized_matrix):
+    index = rf.build_feedback_index(normalized_matrix, 'box')
+    relevant = set('images/%d.jpg' % num
+                   for num in normalized_matrix.columns[:5])
+    query_num = normalized_matrix.columns[0]
+    assert rf.calculate_updated_weight(relevant, normalized_matrix,
+                                       query_num, index, 10) == \
+        rf.calculate_updated_weight(relevant, normalized_matrix, query_num,
+                                    None, 10)
+
+
+@pytest.mark.parametrize('kind', ['float16', 'uint8', 'sparse'])
+def test_quantized_index_matches_brute_force(tied_matrix, kind):
+    matrix, paths = tied_matrix
+    weight = np.linspace(0.5, 2, matrix.shape[1])
+    index = indexes.build_index(kind, matrix, paths)
+    assert index.nbytes < matrix.nbytes
+    for row in [0, 3, 150]:
+        distances = search.weighted_l1_distances(matrix, matrix[row], weight)
+        for k in [1, 10, 50]:
+            assert index.query(matrix[row], k, paths[row], weight) == \
+                search.top_k(distances, paths, k, paths[row])
+
+
+@pytest.mark.parametrize('kind', ['float16', 'uint8', 'sparse'])
+def test_saved_quantized_index(tmp_path, tied_matrix, kind):
+    matrix, paths = tied_matrix
+    index = indexes.build_index(kind, matrix, paths)
+    index_path = str(tmp_path / 'index.npz')
+    index.save(index_path)
+    loaded = indexes.load_index(index_path)
+    assert type(loaded) is type(index)
+    assert loaded.query(matrix[5], 10, paths[5]) == \
+        index.query(matrix[5], 10, paths[5])
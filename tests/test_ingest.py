@@ -0,0 +1,54 @@
+import os
+import shutil
+import numpy as np
+import pytest
+import feature_store
+import ingest
+
+FEATURES = ['color_code', 'intensity']
+
+
+@pytest.fixture
+def image_dir(tmp_path, image_paths):
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    for path in image_paths[:12]:
+        shutil.copy(path, image_dir)
+    (image_dir / 'broken.jpg').write_bytes(b'not an image')
+    return str(image_dir)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_ingest_in_batches_matches_sync(tmp_path, image_dir, workers):
+    store = feature_store.FeatureStore(str(tmp_path / 'store'), FEATURES)
+    counts = ingest.ingest(image_dir, store, workers, chunk_size=2,
+                           batch_size=5)
+    assert counts == {'found': 13, 'unchanged': 0, 'ingested': 12,
+                      'failed': 1}
+
+    images = [path for path in ingest.find_images(image_dir)
+              if not path.endswith('broken.jpg')]
+    fresh = feature_store.FeatureStore(str(tmp_path / 'fresh'), FEATURES)
+    fresh.sync(images)
+    reloaded = feature_store.FeatureStore(str(tmp_path / 'store'), FEATURES)
+    assert reloaded.paths == images
+    assert np.array_equal(reloaded.feature_matrix(), fresh.feature_matrix())
+
+    counts = ingest.ingest(image_dir, reloaded, workers)
+    assert counts['unchanged'] == 12 and counts['ingested'] == 0
+
+
+def test_batches_grow_the_same_matrix_file(tmp_path, image_dir):
+    store = feature_store.FeatureStore(str(tmp_path / 'store'), FEATURES)
+    inodes = list()
+    update = store.update
+
+    def record_update(batch):
+        written = update(batch)
+        inodes.append(os.stat(store.matrix_path('intensity')).st_ino)
+        return written
+
+    store.update = record_update
+    ingest.ingest(image_dir, store, 0, batch_size=3)
+    assert len(inodes) == 4
+    assert len(set(inodes)) == 1
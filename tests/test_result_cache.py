@@ -0,0 +1,96 @@
+import threading
+import data_layer
+import feature_store
+import result_cache
+import search
+
+RESULTS = [(0.1 * rank, 'images/%d.jpg' % rank) for rank in range(1, 21)]
+
+
+def test_larger_k_serves_smaller_pages():
+    cache = result_cache.ResultCache()
+    key = result_cache.make_key('images/1.jpg', 'intensity')
+    cache.put(key, RESULTS[:10], 10)
+    assert cache.get(key, 5) == RESULTS[:5]
+    assert cache.get(key, 10) == RESULTS[:10]
+    assert cache.get(key, 11) is None
+    assert cache.get(key) is None
+    cache.put(key, RESULTS)
+    assert cache.get(key, 15) == RESULTS[:15]
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_relevant_images_order_does_not_matter():
+    assert result_cache.make_key('q', 'combined', ['b', 'a']) == \
+        result_cache.make_key('q', 'combined', {'a', 'b'})
+
+
+def test_least_recently_used_are_evicted():
+    cache = result_cache.ResultCache()
+    keys = [result_cache.make_key('images/%d.jpg' % i, 'intensity')
+            for i in range(3)]
+    for key in keys:
+        cache.put(key, RESULTS)
+    cache.max_bytes = cache.nbytes - 1
+    cache.get(keys[0])
+    cache.put(keys[2], RESULTS)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == RESULTS
+
+
+def test_versions_are_kept_per_method():
+    cache = result_cache.ResultCache()
+    intensity = result_cache.make_key('images/1.jpg', 'intensity')
+    combined = result_cache.make_key('images/1.jpg', 'combined')
+    cache.put(intensity, RESULTS, None, 1)
+    cache.put(combined, RESULTS, None, 7)
+    # A query of another method does not drop the cached results
+    assert cache.get(combined, None, 7) == RESULTS
+    assert cache.get(intensity, None, 1) == RESULTS
+    assert cache.get(combined, None, 8) is None
+    assert cache.get(intensity, None, 1) == RESULTS
+    assert len(cache) == 1
+
+
+def test_shared_between_threads():
+    cache = result_cache.ResultCache(max_bytes=20000)
+    errors = list()
+
+    def worker(start):
+        try:
+            for i in range(200):
+                key = result_cache.make_key('images/%d.jpg' % (i % 30),
+                                            'intensity')
+                cache.put(key, RESULTS, None, 1)
+                found = cache.get(key, 10, 1)
+                assert found is None or found == RESULTS[:10]
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert cache.nbytes <= cache.max_bytes
+
+
+def test_data_layer_versions(tmp_path, image_paths):
+    store = feature_store.FeatureStore(str(tmp_path),
+                                       ['color_code', 'intensity'])
+    store.sync(image_paths[:50])
+    data = data_layer.DataLayer(engine=search.QueryEngine(store))
+
+    first = data.search('images/1.jpg', data_layer.COMBINED, 5)
+    data.search('images/1.jpg', 'intensity', 5)
+    assert data.search('images/1.jpg', data_layer.COMBINED, 5) == first
+    assert data.results.hits == 1
+
+    combined = data.index_version(data_layer.COMBINED)
+    intensity = data.index_version('intensity')
+    store.sync(image_paths)
+    assert data.index_version(data_layer.COMBINED) != combined
+    assert data.index_version('intensity') != intensity
+    assert len(data.search('images/1.jpg', data_layer.COMBINED)) == \
+        len(image_paths)
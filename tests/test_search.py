@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import search
+
+
+def full_sort(distances, paths, k=None, exclude=None):
+    result = sorted((distance, path) for distance, path
+                    in zip(np.asarray(distances).tolist(), paths)
+                    if path != exclude)
+    return result if k is None else result[:k]
+
+
+@pytest.mark.parametrize('k', [None, 1, 5, 37])
+def test_top_k_matches_full_sort(tied_matrix, k):
+    matrix, paths = tied_matrix
+    distances = search.l1_distances(matrix, matrix[3])
+    assert search.top_k(distances, paths, k, paths[3]) == \
+        full_sort(distances, paths, k, paths[3])
+
+
+def test_query_engine_matches_full_sort(store):
+    engine = search.QueryEngine(store)
+    query = store.paths[0]
+    matrix = store.feature_matrix('intensity')
+    distances = search.l1_distances(matrix, store.get(query, 'intensity'))
+    assert engine.query(query, 'intensity', 10) == \
+        full_sort(distances, store.paths, 10, query)
+
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_sharded_scan_matches_single_scan(tied_matrix, processes):
+    matrix, paths = tied_matrix
+    weight = np.linspace(0.5, 2, matrix.shape[1])
+    with search.ShardedScan(matrix, paths, workers=2, processes=processes,
+                            shards=5) as scan:
+        for row in [0, 3, 150]:
+            distances = search.l1_distances(matrix, matrix[row])
+            assert scan.query(matrix[row], 10, paths[row]) == \
+                search.top_k(distances, paths, 10, paths[row])
+            distances = search.weighted_l1_distances(matrix, matrix[row],
+                                                     weight)
+            assert scan.query(matrix[row], None, None, weight) == \
+                search.top_k(distances, paths)
+
+
+def test_sharded_engine_matches_single_scan(store):
+    single = search.QueryEngine(store)
+    sharded = search.QueryEngine(store, workers=2)
+    try:
+        for query in store.paths[:5]:
+            assert sharded.query(query, 'color_code', 10) == \
+                single.query(query, 'color_code', 10)
+    finally:
+        sharded.close()
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+import pytest
+import data_layer
+import search
+import service
+
+
+@pytest.fixture
+def query_service(store):
+    data = data_layer.DataLayer(engine=search.QueryEngine(store))
+    return service.QueryService(data, window=0.001)
+
+
+def post(query_service, target, request=None, body=None):
+    if body is None:
+        body = json.dumps(request).encode('utf-8')
+    return asyncio.run(query_service.route('POST', target, body))
+
+
+def test_query_matches_the_data_layer(query_service):
+    data = query_service.data
+    for method in ['intensity', service.COMBINED]:
+        response = post(query_service, '/query',
+                        {'image': 'images/3.jpg', 'method': method, 'k': 5})
+        expected = data.search('images/3.jpg', method, 5)
+        assert [tuple(result) for result in response['results']] == \
+            [tuple(result) for result in expected]
+    response = post(query_service, '/query', {'id': 3, 'method': 'intensity',
+                                              'k': 5})
+    assert len(response['results']) == 5
+
+
+def test_upload_and_feedback(query_service):
+    with open('images/3.jpg', 'rb') as file:
+        body = file.read()
+    response = post(query_service, '/query/upload?method=color_code&k=3',
+                    body=body)
+    distance, path = response['results'][0]
+    assert (distance, path) == (0.0, 'images/3.jpg')
+
+    relevant = ['images/3.jpg', 'images/4.jpg', 'images/5.jpg']
+    response = post(query_service, '/feedback',
+                    {'image': 'images/3.jpg', 'relevant': relevant, 'k': 4})
+    expected = query_service.data.search('images/3.jpg', service.COMBINED, 4,
+                                         set(relevant))
+    assert [path for distance, path in response['results']] == \
+        [path for distance, path in expected]
+
+
+@pytest.mark.parametrize('method, target, request_body, status', [
+    ('POST', '/unknown', {}, 404),
+    ('GET', '/query', {}, 405),
+    ('POST', '/query', {'image': 'images/3.jpg', 'method': 'nope'}, 400),
+    ('POST', '/query', {'image': 'images/none.jpg',
+                        'method': 'intensity'}, 404),
+    ('POST', '/query', {'image': 'images/3.jpg', 'k': -1}, 400),
+    ('POST', '/feedback', {'image': 'images/3.jpg',
+                           'relevant': ['images/4.jpg']}, 400),
+])
+def test_request_errors(query_service, method, target, request_body, status):
+    with pytest.raises(service.RequestError) as error:
+        asyncio.run(query_service.route(
+            method, target, json.dumps(request_body).encode('utf-8')))
+    assert error.value.status == status
+
+
+def test_loading_does_not_block_other_requests(query_service):
+    get_matrix = query_service.get_matrix
+
+    def slow_get_matrix(method):
+        time.sleep(0.5)
+        return get_matrix(method)
+
+    query_service.get_matrix = slow_get_matrix
+
+    async def run():
+        start = time.perf_counter()
+        query = asyncio.ensure_future(query_service.route(
+            'POST', '/query', b'{"image": "images/3.jpg", "k": 2}'))
+        # Lets the query start loading its matrix
+        await asyncio.sleep(0.05)
+        await query_service.route('GET', '/stats', b'')
+        waited = time.perf_counter() - start
+        await query
+        return waited
+
+    assert asyncio.run(run()) < 0.3
+
+
+def test_http_connection(query_service):
+    async def run():
+        server = await asyncio.start_server(query_service.handle,
+                                            '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        body = b'{"id": 3, "method": "intensity", "k": 2}'
+        writer.write(b'POST /query HTTP/1.1\r\nContent-Length: %d\r\n'
+                     b'Connection: close\r\n\r\n%s' % (len(body), body))
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+
+    head, body = asyncio.run(run()).split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.1 200 OK')
+    assert len(json.loads(body)['results']) == 2
@@ -0,0 +1,64 @@
+import io
+import os
+import shutil
+import threading
+from PIL import Image
+import thumbnails
+
+
+def test_thumbnail_fits_and_keeps_aspect_ratio(tmp_path, image_paths):
+    thumbnail_path = thumbnails.make_thumbnail(image_paths[0], str(tmp_path),
+                                               (64, 64))
+    with Image.open(image_paths[0]) as pic, \
+            Image.open(thumbnail_path) as thumbnail:
+        assert max(thumbnail.size) == 64
+        assert abs(thumbnail.size[0] / thumbnail.size[1] -
+                   pic.size[0] / pic.size[1]) < 0.05
+    assert [name for name in os.listdir(os.path.dirname(thumbnail_path))
+            if name.endswith('.tmp')] == []
+
+
+def test_identical_images_share_a_thumbnail(tmp_path, image_paths):
+    copy = str(tmp_path / 'copy.jpg')
+    shutil.copy(image_paths[0], copy)
+    cache_dir = str(tmp_path / 'cache')
+    assert thumbnails.make_thumbnail(image_paths[0], cache_dir) == \
+        thumbnails.make_thumbnail(copy, cache_dir)
+
+
+def test_cache_hits_and_evictions(tmp_path, image_paths):
+    cache = thumbnails.ThumbnailCache(str(tmp_path), max_bytes=1,
+                                      max_digests=2)
+    first = cache.get(image_paths[0])
+    assert Image.open(io.BytesIO(first)).format == 'JPEG'
+    assert cache.get(image_paths[0]) == first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    for path in image_paths[1:4]:
+        cache.get(path)
+    # Only the latest thumbnail is kept in memory, and two content hashes
+    assert len(cache.memory) == 1
+    assert len(cache.digests) == 2
+    assert cache.get(image_paths[0]) == first
+    assert cache.misses == 5
+
+
+def test_cache_from_several_threads(tmp_path, image_paths):
+    cache = thumbnails.ThumbnailCache(str(tmp_path))
+    expected = dict((path, cache.get(path)) for path in image_paths[:8])
+    errors = list()
+
+    def worker():
+        try:
+            for path in image_paths[:8] * 5:
+                assert cache.get(path) == expected[path]
+        except AssertionError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert cache.hits == 4 * 40
@@ -0,0 +1,219 @@
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+from PIL import Image as img
+import metrics
+
+DEFAULT_CACHE_DIR = 'thumbnails/'
+THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_QUALITY = 85
+# Most content hashes kept by a ThumbnailCache
+MAX_DIGESTS = 65536
+
+
+def get_content_hash(path):
+    """
+    Computes the SHA-256 hash of a file's content.
+
+    Parameters
+    ----------
+    path : str
+        The file path
+
+    Returns
+    -------
+    str
+        The hexadecimal digest
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_thumbnail_path(digest, cache_dir=DEFAULT_CACHE_DIR,
+                       size=THUMBNAIL_SIZE):
+    """
+    Returns where the thumbnail of an image with the given content hash is
+    cached. Thumbnails are grouped into folders by the first two characters
+    of the hash.
+
+    Parameters
+    ----------
+    digest : str
+        The content hash of the image
+    cache_dir : str
+        The folder of the thumbnail cache
+    size : tuple
+        The largest width and height of the thumbnail
+
+    Returns
+    -------
+    str
+        The file path of the thumbnail
+    """
+
+    name = '%s_%dx%d.jpg' % (digest, size[0], size[1])
+    return os.path.join(cache_dir, digest[:2], name)
+
+
+def make_thumbnail(path, cache_dir=DEFAULT_CACHE_DIR, size=THUMBNAIL_SIZE,
+                   digest=None):
+    """
+    Creates the thumbnail of an image in the cache, unless an image with
+    the same content already has one. The thumbnail keeps the aspect ratio
+    of the image and fits in the given size.
+
+    Parameters
+    ----------
+    path : str
+        The file path of the image
+    cache_dir : str
+        The folder of the thumbnail cache
+    size : tuple
+        The largest width and height of the thumbnail
+    digest : str, optional
+        The content hash of the image, computed if not given
+
+    Returns
+    -------
+    str
+        The file path of the thumbnail
+    """
+
+    if digest is None:
+        digest = get_content_hash(path)
+    thumbnail_path = get_thumbnail_path(digest, cache_dir, size)
+    if os.path.exists(thumbnail_path):
+        return thumbnail_path
+
+    with img.open(path) as pic:
+        # Lets JPEGs decode straight at a reduced scale
+        pic.draft('RGB', size)
+        pic = pic.convert('RGB')
+        pic.thumbnail(size)
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        # Each writer has its own temporary file, since identical images
+        # may be thumbnailed by several processes at once
+        handle, tmp_path = tempfile.mkstemp(
+            suffix='.tmp', dir=os.path.dirname(thumbnail_path))
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                pic.save(file, format='JPEG', quality=THUMBNAIL_QUALITY)
+            os.replace(tmp_path, thumbnail_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return thumbnail_path
+
+
+class ThumbnailCache:
+    """
+    Serves the encoded thumbnails of images. Thumbnails are created on disk
+    the first time they are needed (or at ingest) and the most recently
+    used ones are kept in memory, up to max_bytes.
+
+    The cache is shared by every session of the process, so its methods
+    can be called from several threads.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The folder of the thumbnail cache
+    size : tuple
+        The largest width and height of the thumbnails
+    max_bytes : int
+        The most memory used by the encoded thumbnails kept in memory
+    max_digests : int
+        The most content hashes kept, the least recently used are dropped
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, size=THUMBNAIL_SIZE,
+                 max_bytes=32 * 1024 * 1024, max_digests=MAX_DIGESTS):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_digests = max_digests
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        # (path, mtime, file size) -> content hash, so unchanged images are
+        # not hashed again
+        self.digests = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_digest(self, path):
+        """
+        Returns the content hash of an image, hashing it only if it is new
+        or changed.
+
+        Parameters
+        ----------
+        path : str
+            The file path of the image
+
+        Returns
+        -------
+        str
+            The content hash of the image
+        """
+
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self.digests.get(key)
+            if digest is not None:
+                self.digests.move_to_end(key)
+                return digest
+        # Hashed outside the lock, so other sessions are not kept waiting
+        digest = get_content_hash(path)
+        with self.lock:
+            self.digests[key] = digest
+            while len(self.digests) > self.max_digests:
+                self.digests.popitem(last=False)
+        return digest
+
+    def get(self, path):
+        """
+        Returns the encoded thumbnail of an image.
+
+        Parameters
+        ----------
+        path : str
+            The file path of the image
+
+        Returns
+        -------
+        bytes
+            The JPEG encoded thumbnail
+        """
+
+        digest = self.get_digest(path)
+        with self.lock:
+            data = self.memory.get(digest)
+            if data is not None:
+                self.hits += 1
+                metrics.count('thumbnail_cache_hits')
+                self.memory.move_to_end(digest)
+                return data
+            self.misses += 1
+            metrics.count('thumbnail_cache_misses')
+
+        thumbnail_path = make_thumbnail(path, self.cache_dir, self.size,
+                                        digest)
+        with open(thumbnail_path, 'rb') as file:
+            data = file.read()
+
+        with self.lock:
+            if digest not in self.memory:
+                self.memory[digest] = data
+                self.memory_bytes += len(data)
+            while self.memory_bytes > self.max_bytes and len(self.memory) > 1:
+                evicted_digest, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+        return data